@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Micro-benchmark of CIGAR decoding in the SAM parser
+#
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Compares the previous per-line CIGAR decoding of the SAM parser with
+tentacle.parsers.sam.cigar_reference_length on a synthetic SAM file.
+
+Usage: benchmark_cigar.py [--lines N] [--keep FILE]
+"""
+from time import time
+import argparse
+import os
+import random
+import tempfile
+
+from tentacle.parsers import sam
+
+
+def find_end_pos_from_cigar(cigar):
+    """ The CIGAR decoding used by the SAM parser before the memo was added. """
+    import re
+    regex = r'([0-9]+[MIDNSHPX=])'
+    allowed_operators = set(['M', 'D', '=', 'X'])
+    return sum([int(operator[:-1]) for operator in re.findall(regex, cigar) if operator[-1] in allowed_operators])
+
+
+def write_synthetic_sam(filename, lines, seed=0):
+    """ Writes a SAM file where most reads share a few CIGAR strings. """
+    random.seed(seed)
+    common = ["100M", "100M", "100M", "100M", "150M", "75M", "99M1S", "50M1I49M", "60M2D40M"]
+    with open(filename, "w") as f:
+        f.write("@HD\tVN:1.0\tSO:unsorted\n")
+        f.write("@SQ\tSN:contig1\tLN:1000000\n")
+        for i in xrange(lines):
+            if random.random() < 0.05:
+                cigar = "{}S{}M{}I{}M".format(random.randint(1, 20), random.randint(10, 60),
+                                              random.randint(1, 5), random.randint(10, 60))
+            else:
+                cigar = random.choice(common)
+            f.write("read{0}\t0\tcontig1\t{1}\t42\t{2}\t*\t0\t0\tACGT\tIIII\n".format(i, random.randint(1, 999000), cigar))
+
+
+def time_decoder(filename, decoder):
+    """ Time to split all alignment lines and decode their CIGARs. """
+    start_time = time()
+    total = 0
+    with open(filename) as f:
+        for line in f:
+            if line.startswith("@"):
+                continue
+            qname, flag, rname, pos, mapq, cigar, rest = line.split(None, 6)
+            total += decoder(cigar)
+    return time()-start_time, total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CIGAR decoding micro-benchmark.")
+    parser.add_argument("--lines", type=int, default=10000000,
+        help="Number of alignment lines in the synthetic SAM file [default: %(default)s]")
+    parser.add_argument("--keep", metavar="FILE", default="",
+        help="Write the synthetic SAM file here and keep it [default: temporary file]")
+    options = parser.parse_args()
+
+    filename = options.keep or tempfile.mkstemp(suffix=".sam")[1]
+    print "Writing {} synthetic alignments to {}...".format(options.lines, filename)
+    write_synthetic_sam(filename, options.lines)
+    try:
+        old_time, old_total = time_decoder(filename, find_end_pos_from_cigar)
+        new_time, new_total = time_decoder(filename, sam.cigar_reference_length)
+    finally:
+        if not options.keep:
+            os.remove(filename)
+    assert old_total == new_total, "Decoders disagree: {} != {}".format(old_total, new_total)
+    print "Previous decoding:        {:.2f} s".format(old_time)
+    print "cigar_reference_length:   {:.2f} s".format(new_time)
+    print "Speedup:                  {:.1f}x".format(old_time/new_time)
@@ -5,5 +5,7 @@
 
 """
 from coverage import update_contig_data
+from contig_data import ContigData
+from batch import update_contig_data_batch, create_alignment_sink, AlignmentCollector
 from compute_and_write_coverage_statistics import compute_and_write_coverage_statistics
 from debug_functions import debug_print_single_coverage, debug_output_coverage
@@ -0,0 +1,135 @@
+# coding: utf-8
+"""Tentacle coverage module: annotation interval index.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import numpy as np
+
+# Contig ids are stored in the upper bits of the search keys so that
+# the annotations of all contigs can be kept in one sorted array.
+CONTIG_SHIFT = 32
+
+class AnnotationIndex(object):
+    """ Sorted interval index over the annotated regions of all contigs.
+
+    The index stores the regions shrunk by the read overlap requirement
+    (i.e. [start+overlap, end-overlap]). The regions must be given sorted
+    on contig and start position, which is how ContigData stores its
+    annotation columns, so positions in the index are row numbers in those
+    columns. Regions that become empty after shrinking are kept but can
+    never be matched. A point lookup searches the start positions for
+    the candidates that start before the point and no further away than
+    the longest region on the contig, giving O(log n + k) per lookup.
+    """
+
+    def __init__(self, contig_ids, starts, ends, overlap, contig_count):
+        """ Builds the index.
+
+        Input:
+            contig_ids    NumPy array with the contig id of each region.
+            starts        NumPy array with 1-based start positions.
+            ends          NumPy array with 1-based (inclusive) end positions.
+            overlap       minimum overlap between read and annotated region.
+            contig_count  the number of contigs in the reference.
+        """
+        self.overlap = overlap
+        self.starts = starts.astype(np.int64) + overlap
+        self.ends = ends.astype(np.int64) - overlap
+        self.keys = (contig_ids.astype(np.int64) << CONTIG_SHIFT) + self.starts
+        self.max_lengths = np.zeros(contig_count, dtype=np.int64)
+        if len(contig_ids):
+            np.maximum.at(self.max_lengths, contig_ids, self.ends - self.starts)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _stab(self, key, position, max_length, matched):
+        """ Adds the positions in the index of all regions containing position to matched. """
+        first = self.keys.searchsorted(key - max_length, side="left")
+        last = self.keys.searchsorted(key, side="right")
+        ends = self.ends
+        for i in xrange(first, last):
+            if ends[i] >= position:
+                matched.add(i)
+
+    def query(self, contig_id, rstart, rend):
+        """ Returns the regions matched by a read.
+
+        Uses the same rule as the original linear scan: a read matches
+        a region if either of its end points lies inside the region after
+        the region has been shrunk by the overlap requirement. Reads
+        shorter than the overlap requirement never match.
+
+        Input:
+            contig_id  id of the contig the read is mapped to.
+            rstart     1-based start position of the read.
+            rend       1-based (inclusive) end position of the read.
+        Output:
+            matched    set of positions in the index of matched regions.
+        """
+        matched = set()
+        if rend - rstart + 1 < self.overlap:
+            return matched
+        base = contig_id << CONTIG_SHIFT
+        max_length = self.max_lengths[contig_id]
+        self._stab(base + rend, rend, max_length, matched)
+        self._stab(base + rstart, rstart, max_length, matched)
+        return matched
+
+    def count(self, contig_ids, rstarts, rends):
+        """ Vectorized version of query for a batch of reads.
+
+        Applies the same matching rule as query to all reads at once
+        using searchsorted against the sorted start positions. A read
+        whose both end points lie inside the same region counts once.
+
+        Input:
+            contig_ids  NumPy array with contig ids of the reads.
+            rstarts     NumPy array with 1-based start positions of the reads.
+            rends       NumPy array with 1-based (inclusive) end positions.
+        Output:
+            hits        NumPy array with the number of matching reads for
+                        each region in the index.
+        """
+        hits = np.zeros(len(self.keys), dtype=np.int64)
+        if not len(self.keys):
+            return hits
+        long_enough = (rends - rstarts + 1) >= self.overlap
+        contig_ids = contig_ids[long_enough].astype(np.int64)
+        rstarts = rstarts[long_enough]
+        rends = rends[long_enough]
+        bases = contig_ids << CONTIG_SHIFT
+        max_lengths = self.max_lengths[contig_ids]
+        ends = self.ends
+        # The start point only counts for regions that do not also
+        # contain the end point, otherwise the read is counted twice.
+        for points, is_start in ((rends, False), (rstarts, True)):
+            first = self.keys.searchsorted(bases + points - max_lengths, side="left")
+            span = self.keys.searchsorted(bases + points, side="right") - first
+            active = np.flatnonzero(span > 0)
+            offset = 0
+            while active.size:
+                candidates = first[active] + offset
+                matched = ends[candidates] >= points[active]
+                if is_start:
+                    matched &= ends[candidates] < rends[active]
+                hits += np.bincount(candidates[matched], minlength=len(hits))
+                offset += 1
+                active = active[span[active] > offset]
+        return hits
@@ -0,0 +1,300 @@
+# coding: utf-8
+"""Tentacle coverage module: batched coverage/count updates.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from array import array
+from itertools import izip
+import argparse
+import logging
+import os
+import tempfile
+import unittest
+import numpy as np
+from coverage import update_contig_data
+from contig_data import ContigData
+from compute_and_write_coverage_statistics import compute_and_write_coverage_statistics
+from ..utils import hot_path_logger
+
+def update_contig_data_batch(contig_data, contigs, rstarts, rends, options, logger):
+    """ Updates mapping data for a batch of mapped reads.
+
+    Vectorized counterpart to update_contig_data. Uses 0-based starting
+    positions and non-inclusive end positions (like Python).
+
+    Input:
+        contig_data  the ContigData store
+        contigs      sequence of contig names or contig ids, one per mapped read
+        rstarts      sequence of integer start positions
+        rends        sequence of integer end positions
+        options      options namespace
+        logger       a logger object
+    Output:
+        contig_data
+    """
+    contig_ids = contig_ids_of(contig_data, contigs)
+    rstarts = np.asarray(rstarts, dtype=np.int64)
+    rends = np.asarray(rends, dtype=np.int64)
+
+    if options.discardSequencesShorterThan:
+        keep = (rends - rstarts) >= int(options.discardSequencesShorterThan)
+        logger.debug("Removed %d reads shorter than %s", keep.size - np.count_nonzero(keep), options.discardSequencesShorterThan)
+        contig_ids = contig_ids[keep]
+        rstarts = rstarts[keep]
+        rends = rends[keep]
+    if not contig_ids.size:
+        return contig_data
+
+    if not options.noCounts:
+        # Annotations have 1-based numbers
+        contig_data.annotation_counts += contig_data.index.count(contig_ids, rstarts+1, rends)
+    if not options.noCoverage:
+        if np.any(rstarts < 0) or np.any(rends > contig_data.lengths[contig_ids]):
+            raise IndexError("Batch contains reads outside their contigs")
+        contig_data.add_reads(contig_ids)
+        if contig_data.promoted:
+            update_promoted_coverage(contig_data, contig_ids, rstarts, rends)
+            shared = ~contig_data.promoted_mask[contig_ids]
+            contig_ids, rstarts, rends = contig_ids[shared], rstarts[shared], rends[shared]
+        # Same diff array trick as update_contig_data, but adding all
+        # reads at once at their positions in the concatenated array.
+        offsets = contig_data.offsets[contig_ids]
+        coverage = contig_data.coverage
+        # bincount allocates temporaries the size of the whole coverage
+        # array, which defeats the purpose of a memory-mapped array.
+        if not contig_data.is_memmap and coverage.size <= 4 * rstarts.size:
+            coverage += np.bincount(offsets+rstarts, minlength=coverage.size)
+            coverage -= np.bincount(offsets+rends, minlength=coverage.size)
+        else:
+            np.add.at(coverage, offsets+rstarts, 1)
+            np.subtract.at(coverage, offsets+rends, 1)
+    return contig_data
+
+
+def update_promoted_coverage(contig_data, contig_ids, rstarts, rends):
+    """ Applies the reads of a batch that map to promoted contigs to their own coverage arrays. """
+    promoted = contig_data.promoted_mask[contig_ids]
+    for contig_id in np.unique(contig_ids[promoted]):
+        reads = contig_ids == contig_id
+        coverage = contig_data.promoted[contig_id]
+        np.add.at(coverage, rstarts[reads], 1)
+        np.subtract.at(coverage, rends[reads], 1)
+
+
+def contig_ids_of(contig_data, contigs):
+    """ Translates a sequence of contig names into a NumPy array of contig ids.
+
+    Integer arrays are assumed to already contain contig ids. """
+    return translate_contig_names(contig_data.ids, contigs)
+
+
+def translate_contig_names(ids, contigs):
+    """ Translates contig names into contig ids with the ids dictionary, looking up each name once. """
+    contigs = np.asarray(contigs)
+    if np.issubdtype(contigs.dtype, np.integer):
+        return contigs.astype(np.int64)
+    unique_names, inverse = np.unique(contigs, return_inverse=True)
+    unique_ids = np.array([ids[name] for name in unique_names], dtype=np.int64)
+    return unique_ids[inverse]
+
+
+def extend_array(target, values):
+    """ Appends a NumPy array to an array.array without converting the values one by one. """
+    target.fromstring(np.asarray(values, dtype=target.typecode).tostring())
+
+
+class AlignmentSink(object):
+    """ Receives mapped reads from a mapping output parser.
+
+    Passes every read straight on to update_contig_data, with a
+    HotPathLogger for its per-read debug messages.
+    """
+    def __init__(self, contig_data, options, logger):
+        self.contig_data = contig_data
+        self.options = options
+        self.logger = hot_path_logger(logger, options)
+
+    def add(self, contig, rstart, rend):
+        """ Adds a mapped read. Uses 0-based start and non-inclusive end. """
+        self.contig_data = update_contig_data(self.contig_data, contig, rstart, rend, self.options, self.logger)
+
+    def add_many(self, contigs, rstarts, rends):
+        """ Adds a chunk of mapped reads given as arrays (contig names or ids). """
+        contigs = np.asarray(contigs)
+        if np.issubdtype(contigs.dtype, np.integer):
+            contigs = self.contig_data.names[contigs]
+        for contig, rstart, rend in izip(contigs, rstarts, rends):
+            self.add(contig, int(rstart), int(rend))
+
+    def close(self):
+        """ Commits any pending reads and returns the updated contig_data. """
+        return self.contig_data
+
+
+class AlignmentBatch(AlignmentSink):
+    """ Collects mapped reads into chunks and applies them with update_contig_data_batch. """
+    def __init__(self, contig_data, options, logger, size):
+        super(AlignmentBatch, self).__init__(contig_data, options, logger)
+        self.size = size
+        self._reset()
+
+    def _reset(self):
+        self.contigs = []
+        self.rstarts = array("l")
+        self.rends = array("l")
+
+    def add(self, contig, rstart, rend):
+        """ Adds a mapped read. Uses 0-based start and non-inclusive end. """
+        self.contigs.append(contig)
+        self.rstarts.append(rstart)
+        self.rends.append(rend)
+        if len(self.contigs) >= self.size:
+            self.flush()
+
+    def add_many(self, contigs, rstarts, rends):
+        """ Adds a chunk of mapped reads given as arrays. """
+        self.flush()
+        self.contig_data = update_contig_data_batch(self.contig_data, contigs, rstarts, rends, self.options, self.logger)
+
+    def flush(self):
+        """ Applies all collected reads to contig_data. """
+        if self.contigs:
+            self.contig_data = update_contig_data_batch(self.contig_data,
+                    self.contigs,
+                    np.frombuffer(self.rstarts, dtype=self.rstarts.typecode),
+                    np.frombuffer(self.rends, dtype=self.rends.typecode),
+                    self.options, self.logger)
+            self._reset()
+
+    def close(self):
+        """ Commits any pending reads and returns the updated contig_data. """
+        self.flush()
+        return self.contig_data
+
+
+class AlignmentCollector(AlignmentSink):
+    """ Collects mapped reads into arrays without applying them to a contig_data.
+
+    Used by parsers running in worker processes, the collected arrays are
+    applied to contig_data with update_contig_data_batch by the parent.
+    """
+    def __init__(self, contig_ids):
+        self.contig_ids = contig_ids
+        self.contigs = array("l")
+        self.rstarts = array("l")
+        self.rends = array("l")
+
+    def add(self, contig, rstart, rend):
+        """ Adds a mapped read. Uses 0-based start and non-inclusive end. """
+        self.contigs.append(self.contig_ids[contig])
+        self.rstarts.append(rstart)
+        self.rends.append(rend)
+
+    def add_many(self, contigs, rstarts, rends):
+        """ Adds a chunk of mapped reads given as arrays (contig names or ids). """
+        extend_array(self.contigs, translate_contig_names(self.contig_ids, contigs))
+        extend_array(self.rstarts, rstarts)
+        extend_array(self.rends, rends)
+
+    def close(self):
+        """ Returns the collected (contig ids, starts, ends) as NumPy arrays. """
+        return (np.frombuffer(self.contigs, dtype=self.contigs.typecode),
+                np.frombuffer(self.rstarts, dtype=self.rstarts.typecode),
+                np.frombuffer(self.rends, dtype=self.rends.typecode))
+
+
+def create_alignment_sink(contig_data, options, logger):
+    """ Creates an AlignmentBatch if a batch size is set in options, otherwise an AlignmentSink. """
+    if options.coverageBatchSize:
+        return AlignmentBatch(contig_data, options, logger, options.coverageBatchSize)
+    return AlignmentSink(contig_data, options, logger)
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_update_contig_data_batch(unittest.TestCase):
+    """ The batch path must give the same annotationStats as the per-read path. """
+    names = ["c1", "c2", "c3"]
+    lengths = [300, 120, 200]
+    # Nested and overlapping regions, and a region shorter than the overlap
+    annotations = [("c1", "a", 1, 100, "+"), ("c1", "b", 50, 150, "-"), ("c1", "c", 60, 70, "+"),
+                   ("c1", "d", 200, 300, "+"), ("c2", "e", 10, 12, "+"), ("c2", "f", 1, 120, "-"),
+                   ("c3", "g", 20, 180, "+")]
+
+    def _contig_data(self, overlap, adaptive):
+        contig_data = ContigData(self.names, self.lengths, dtype=np.int16 if adaptive else np.int32, adaptive=adaptive)
+        contigs, names, starts, ends, strands = zip(*self.annotations)
+        contig_data.set_annotations(contigs, names, starts, ends, strands, overlap)
+        return contig_data
+
+    def _reads(self):
+        random = np.random.RandomState(0)
+        contigs = random.randint(0, len(self.names), 3000)
+        lengths = np.array(self.lengths)[contigs]
+        rstarts = (random.random_sample(3000) * lengths).astype(np.int64)
+        rends = np.minimum(rstarts + random.randint(1, 60, 3000), lengths)
+        # Reads with both ends inside the same annotation (c1 "c")
+        contigs[:100], rstarts[:100], rends[:100] = 0, 61, 66
+        # Enough reads on c3 to promote it from int16
+        extra = np.iinfo(np.int16).max + 10
+        contigs = np.concatenate([contigs, np.full(extra, 2, dtype=contigs.dtype)])
+        rstarts = np.concatenate([rstarts, np.full(extra, 30, dtype=np.int64)])
+        rends = np.concatenate([rends, np.full(extra, 90, dtype=np.int64)])
+        return np.array(self.names)[contigs], rstarts, rends
+
+    def _annotation_stats(self, contig_data, options):
+        contig_data.cumulative_sum()
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            compute_and_write_coverage_statistics(None, contig_data, filename, options, logging.getLogger("test_batch"))
+            with open(filename) as f:
+                return f.read()
+        finally:
+            os.remove(filename)
+
+    def _compare(self, overlap, adaptive):
+        options = argparse.Namespace(discardSequencesShorterThan=0, noCounts=False, noCoverage=False,
+                                     coverageReadOverlap=overlap, logSampleEvery=1)
+        logger = logging.getLogger("test_batch")
+        contigs, rstarts, rends = self._reads()
+        per_read = self._contig_data(overlap, adaptive)
+        for contig, rstart, rend in izip(contigs, rstarts, rends):
+            per_read = update_contig_data(per_read, contig, int(rstart), int(rend), options, logger)
+        batch = self._contig_data(overlap, adaptive)
+        # Small batches use np.add.at, large ones np.bincount
+        for first, last in ((0, 50), (50, 1000), (1000, len(contigs))):
+            batch = update_contig_data_batch(batch, contigs[first:last], rstarts[first:last], rends[first:last], options, logger)
+        self.assertEqual(sorted(per_read.promoted), sorted(batch.promoted))
+        self.assertEqual(self._annotation_stats(batch, options), self._annotation_stats(per_read, options))
+        return batch
+
+    def test_same_annotation_stats(self):
+        self._compare(0, False)
+
+    def test_read_overlap(self):
+        self._compare(5, False)
+
+    def test_promoted_contig(self):
+        batch = self._compare(0, True)
+        self.assertEqual(batch.promotion_summary(), {"int32": 1})
+        self.assertEqual(sorted(batch.promoted), [2])
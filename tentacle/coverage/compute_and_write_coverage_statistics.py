@@ -21,52 +21,77 @@ purpose: Writes results to file, and computes coverage statistics
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # 
-from statistics import compute_region_statistics
+import numpy as np
+
+from statistics import compute_regions_statistics
+
+# Maximum number of annotation rows and covered positions per output block
+BLOCK_ROWS = 1 << 16
+BLOCK_POSITIONS = 1 << 24
+
+def iter_annotation_blocks(contig_data):
+    """ Yields (first, last) row ranges of annotations to process together.
+
+    Each block has at most BLOCK_ROWS rows and, unless it is a single
+    row, spans at most BLOCK_POSITIONS positions.
+    """
+    lengths = np.maximum(contig_data.annotation_ends - contig_data.annotation_starts, 0)
+    cumulative = np.cumsum(lengths)
+    rows = len(lengths)
+    first = 0
+    while first < rows:
+        limit = cumulative[first] - lengths[first] + BLOCK_POSITIONS
+        last = int(np.searchsorted(cumulative, limit, side="right"))
+        last = min(max(last, first+1), first+BLOCK_ROWS)
+        yield first, last
+        first = last
+
 
 def compute_and_write_coverage_statistics(annotationFilename, contig_data, outFilename, options, logger):
     """ Computes coverage for each annotated region. Writes results to file.
 
+    The annotated regions are processed in blocks: the statistics of all
+    regions in a block are computed at once by compute_regions_statistics
+    and the output lines of the block are written with a single write.
+
     Input:
         annotationFilename  filename of annotation file
-        contig_data         the contig_data dictionary
+        contig_data         the ContigData store
         outFilename         output filename
         options             options namespace
         logger              a logger object object
     Output:
         None                Writes directly to file
-    Raises:
-        ParseError          On parsing errors
     """
 
-    outFile = open(outFilename, "w")
     logger.debug("Writing to {}.".format(outFilename))
-    for contig in contig_data.keys():
-        for annotation in contig_data[contig].keys():
-            if "__coverage__" in annotation:
-                pass
+    with open(outFilename, "w") as outFile:
+        for first, last in iter_annotation_blocks(contig_data):
+            rows = slice(first, last)
+            if options.noCoverage:
+                medians = means = stdevs = ["N"] * (last-first)
             else:
-                count, start, end, strand = contig_data[contig][annotation]
-                if options.noCoverage:
-                    stats = ["N", "N", "N"]
-                else: 
-                    stats = compute_region_statistics(contig_data[contig]["__coverage__"][start:end])
-
-                if options.noCounts:
-                    annotation_count = "N"
-                else:
-                    annotation_count = contig_data[contig][annotation][0]
-
-                try:
-                    outFile.write("{}_{}:{}:{}:{}\t{}\t{}\t{}\t{}\n".format(contig,
-                            annotation,
-                            str(start),
-                            str(end),
-                            strand,
-                            str(annotation_count),
-                            str(stats[0]),
-                            str(stats[1]),
-                            str(stats[2]))
-                            )
-                except KeyError, contigHeader:
-                    logger.error("Could not find match for contig header {} in annotation file {}.".format(contigHeader, annotationFilename))
-                    raise ParseError("Header {} not found in annotation file {}".format(contigHeader, annotationFilename))
+                values, lengths = contig_data.annotation_coverage(rows)
+                medians, means, stdevs = compute_regions_statistics(values, lengths)
+            if options.noCounts:
+                counts = ["N"] * (last-first)
+            else:
+                counts = contig_data.annotation_counts[rows]
+            contigs = contig_data.names[contig_data.annotation_contigs[rows]]
+            lines = ["{}_{}:{}:{}:{}\t{}\t{}\t{}\t{}\n".format(contig,
+                        annotation,
+                        str(start),
+                        str(end),
+                        strand,
+                        str(count),
+                        str(median),
+                        str(mean),
+                        str(stdev))
+                     for contig, annotation, start, end, strand, count, median, mean, stdev in
+                     zip(contigs,
+                         contig_data.annotation_names[rows],
+                         contig_data.annotation_starts[rows],
+                         contig_data.annotation_ends[rows],
+                         contig_data.annotation_strands[rows],
+                         counts, medians, means, stdevs)]
+            outFile.write("".join(lines))
@@ -0,0 +1,297 @@
+# coding: utf-8
+"""Tentacle coverage module: compact coverage and annotation store.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import numpy as np
+from annotation_index import AnnotationIndex
+
+# Number of positions per chunk when processing memory-mapped coverage,
+# 16M positions is 64 MiB of int32.
+CHUNK_SIZE = 1 << 24
+
+# Coverage data types in order of promotion. The arrays hold signed
+# start/end increments before the cumulative sum, so the types are signed.
+DTYPES = (np.dtype(np.int16), np.dtype(np.int32), np.dtype(np.int64))
+
+class ContigData(object):
+    """ Coverage and annotation count data for all contigs in a reference.
+
+    Instead of one dictionary and one NumPy array per contig, all data
+    is kept in a few contiguous arrays:
+
+     names                   CONTIG NAMES, IN REFERENCE ORDER
+     ids                     DICTIONARY: CONTIG NAME -> CONTIG ID
+     lengths                 CONTIG LENGTHS
+     offsets                 START OF EACH CONTIG IN coverage (n+1 entries)
+     coverage                ONE ARRAY WITH length+1 POSITIONS PER CONTIG
+                             (OPTIONALLY A np.memmap BACKED BY A FILE)
+     annotation_*            ANNOTATION COLUMNS (contigs, names, starts, ends,
+                             strands, counts), SORTED ON CONTIG AND START
+     annotation_offsets      FIRST ANNOTATION ROW OF EACH CONTIG (n+1 entries)
+     index                   AnnotationIndex OVER THE ANNOTATION ROWS
+     read_counts             MAPPED READS PER CONTIG (ONLY IN ADAPTIVE MODE)
+     promoted                DICTIONARY: CONTIG ID -> WIDER COVERAGE ARRAY
+
+    Consumers should use the accessor methods rather than indexing the
+    arrays directly.
+    """
+
+    def __init__(self, names, lengths, coverage=True, dtype=np.int32, filename=None, adaptive=False):
+        """ Creates an empty store for contigs with given names and lengths.
+
+        Input:
+            names     list of contig names
+            lengths   list of contig lengths
+            coverage  allocate the coverage array
+            dtype     NumPy data type of the coverage array
+            filename  if given, the coverage array is a np.memmap backed
+                      by this file instead of an array in memory
+            adaptive  count reads per contig and move a contig to a
+                      separate array of a wider type before its
+                      coverage can overflow dtype
+        """
+        self.names = np.array(names, dtype=np.string_)
+        self.ids = dict((name, contig_id) for contig_id, name in enumerate(names))
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.offsets = np.zeros(len(names)+1, dtype=np.int64)
+        np.cumsum(self.lengths+1, out=self.offsets[1:])
+        self.filename = filename
+        if coverage and filename:
+            # A newly created memmap file is zero-filled (and sparse).
+            self.coverage = np.memmap(filename, dtype=dtype, mode="w+", shape=(self.offsets[-1],))
+        elif coverage:
+            self.coverage = np.zeros(self.offsets[-1], dtype=dtype)
+        else:
+            self.coverage = None
+        self.promoted = {}
+        self.promoted_mask = np.zeros(len(names), dtype=np.bool_)
+        if adaptive and coverage:
+            self.read_counts = np.zeros(len(names), dtype=np.int64)
+        else:
+            self.read_counts = None
+        self.set_annotations([], [], [], [], [], 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, contig):
+        return contig in self.ids
+
+    @property
+    def nbytes(self):
+        """ Total size of the NumPy arrays in the store. """
+        arrays = [self.names, self.lengths, self.offsets, self.annotation_contigs,
+                  self.annotation_names, self.annotation_starts, self.annotation_ends,
+                  self.annotation_strands, self.annotation_counts, self.annotation_offsets]
+        if self.coverage is not None and not self.is_memmap:
+            arrays.append(self.coverage)
+        arrays.extend(self.promoted.values())
+        return sum(array.nbytes for array in arrays)
+
+    @property
+    def is_memmap(self):
+        """ True if the coverage array is backed by a file. """
+        return isinstance(self.coverage, np.memmap)
+
+    def set_annotations(self, contigs, names, starts, ends, strands, overlap):
+        """ Stores annotated regions and builds the annotation index.
+
+        Input:
+            contigs   list of contig names the regions belong to
+            names     list of annotation names
+            starts    list of region start positions
+            ends      list of region end positions
+            strands   list of region strands ("+" or "-")
+            overlap   minimum overlap between read and annotated region
+        Raises:
+            KeyError  if a region refers to a contig not in the store
+        """
+        contig_ids = np.array([self.ids[contig] for contig in contigs], dtype=np.int32)
+        starts = np.array(starts, dtype=np.int64)
+        order = np.lexsort((starts, contig_ids))
+        self.set_sorted_annotations(contig_ids[order],
+                                    np.array(names, dtype=np.string_)[order],
+                                    starts[order],
+                                    np.array(ends, dtype=np.int64)[order],
+                                    np.array(strands, dtype="S1")[order],
+                                    overlap)
+
+    def set_sorted_annotations(self, contig_ids, names, starts, ends, strands, overlap):
+        """ Stores annotated regions given as NumPy arrays sorted on contig id and start.
+
+        The arrays are used as they are, so they can for example be
+        read-only memory-mapped arrays from the reference index cache.
+
+        Input:
+            contig_ids  NumPy array (int32) with the contig id of each region
+            names       NumPy array (string) with annotation names
+            starts      NumPy array (int64) with region start positions
+            ends        NumPy array (int64) with region end positions
+            strands     NumPy array (S1) with region strands
+            overlap     minimum overlap between read and annotated region
+        """
+        self.annotation_contigs = contig_ids
+        self.annotation_names = names
+        self.annotation_starts = starts
+        self.annotation_ends = ends
+        self.annotation_strands = strands
+        self.annotation_counts = np.zeros(len(contig_ids), dtype=np.int64)
+        self.annotation_offsets = np.searchsorted(self.annotation_contigs, np.arange(len(self.names)+1))
+        self.index = AnnotationIndex(self.annotation_contigs,
+                                     self.annotation_starts,
+                                     self.annotation_ends,
+                                     overlap,
+                                     len(self.names))
+
+    def contig_id(self, contig):
+        """ Returns the integer id of a contig name. """
+        return self.ids[contig]
+
+    def get_coverage(self, contig):
+        """ Returns a view of the coverage array of a contig (name or id). """
+        if not isinstance(contig, (int, long, np.integer)):
+            contig = self.ids[contig]
+        if contig in self.promoted:
+            return self.promoted[contig]
+        return self.coverage[self.offsets[contig]:self.offsets[contig+1]]
+
+    def coverage_of(self, contig_id):
+        """ Returns (array, offset) where the coverage of a contig is stored. """
+        if contig_id in self.promoted:
+            return self.promoted[contig_id], 0
+        return self.coverage, self.offsets[contig_id]
+
+    def add_read(self, contig_id):
+        """ Records a read on a contig, promoting the contig if needed (adaptive mode). """
+        if self.read_counts is None:
+            return
+        self.read_counts[contig_id] += 1
+        if self.read_counts[contig_id] > np.iinfo(self.get_coverage(contig_id).dtype).max:
+            self.promote(contig_id)
+
+    def add_reads(self, contig_ids):
+        """ Records a batch of reads, promoting contigs if needed (adaptive mode). """
+        if self.read_counts is None:
+            return
+        touched, inverse = np.unique(contig_ids, return_inverse=True)
+        counts = np.bincount(inverse)
+        self.read_counts[touched] += counts
+        for contig_id in touched[self.read_counts[touched] > np.iinfo(self.coverage.dtype).max]:
+            if self.read_counts[contig_id] > np.iinfo(self.get_coverage(contig_id).dtype).max:
+                self.promote(contig_id)
+
+    def promote(self, contig_id):
+        """ Moves the coverage of a contig to an array of a wider type.
+
+        The coverage at any position of a contig can never exceed the
+        number of reads mapped to it, so the narrowest type that can hold
+        the read count is chosen. The contig's part of the shared array is
+        zeroed so that the cumulative sum over the shared array is
+        unaffected.
+        """
+        current = self.get_coverage(contig_id)
+        count = self.read_counts[contig_id]
+        dtype = [d for d in DTYPES if np.iinfo(d).max >= count][0]
+        self.promoted[contig_id] = current.astype(dtype)
+        if not self.promoted_mask[contig_id]:
+            current[:] = 0
+            self.promoted_mask[contig_id] = True
+
+    def promotion_summary(self):
+        """ Returns a dictionary: data type name -> number of promoted contigs. """
+        summary = {}
+        for array in self.promoted.itervalues():
+            summary[array.dtype.name] = summary.get(array.dtype.name, 0) + 1
+        return summary
+
+    def annotation_rows(self, contig):
+        """ Returns the range of annotation rows of a contig (name or id). """
+        if not isinstance(contig, (int, long, np.integer)):
+            contig = self.ids[contig]
+        return xrange(self.annotation_offsets[contig], self.annotation_offsets[contig+1])
+
+    def get_annotation(self, row):
+        """ Returns (name, count, start, end, strand) of an annotation row. """
+        return (self.annotation_names[row],
+                self.annotation_counts[row],
+                self.annotation_starts[row],
+                self.annotation_ends[row],
+                self.annotation_strands[row])
+
+    def annotation_coverage(self, rows):
+        """ Returns the coverage of a range or array of annotation rows.
+
+        Gives the same positions as get_coverage(contig)[start:end] for
+        each row, concatenated into one array.
+
+        Output:
+            values   NumPy array with the concatenated coverage of the rows.
+            lengths  NumPy array with the number of positions of each row.
+        """
+        contigs = self.annotation_contigs[rows]
+        segment_lengths = self.lengths[contigs] + 1
+        starts = np.clip(self.annotation_starts[rows], 0, segment_lengths)
+        ends = np.clip(self.annotation_ends[rows], starts, segment_lengths)
+        lengths = ends - starts
+        if self.promoted_mask[contigs].any():
+            values = np.concatenate([self.get_coverage(contig)[start:end]
+                                     for contig, start, end in zip(contigs, starts, ends)] or [[]])
+            return values, lengths
+        firsts = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=firsts[1:])
+        positions = np.arange(lengths.sum(), dtype=np.int64)
+        positions += np.repeat(self.offsets[contigs] + starts - firsts, lengths)
+        return self.coverage[positions], lengths
+
+    def iter_annotations(self):
+        """ Iterates over (contig, annotation, count, start, end, strand) for all annotations. """
+        for contig_id, contig in enumerate(self.names):
+            for row in self.annotation_rows(contig_id):
+                yield (contig,) + self.get_annotation(row)
+
+    def cumulative_sum(self):
+        """ Turns the start/end increments into coverage, in place.
+
+        Every read adds +1 and -1 within the same contig, so the running
+        sum is zero at each contig boundary and a single cumulative sum
+        over the concatenated array equals one sum per contig.
+
+        A memory-mapped coverage array is summed in chunks of CHUNK_SIZE
+        positions, carrying the running sum over to the next chunk, so
+        that only one chunk at a time needs to be resident in memory.
+        """
+        for array in self.promoted.itervalues():
+            np.cumsum(array, dtype=array.dtype, out=array)
+        if not self.is_memmap:
+            np.cumsum(self.coverage, dtype=self.coverage.dtype, out=self.coverage)
+            return
+        carry = 0
+        for first in xrange(0, self.coverage.size, CHUNK_SIZE):
+            chunk = self.coverage[first:first+CHUNK_SIZE]
+            np.cumsum(chunk, dtype=chunk.dtype, out=chunk)
+            chunk += carry
+            carry = chunk[-1]
+        self.coverage.flush()
+
+    def close(self):
+        """ Releases the coverage array (and its backing file mapping). """
+        if self.is_memmap:
+            self.coverage.flush()
+        self.coverage = None
@@ -31,41 +31,37 @@ def update_contig_data(contig_data, contig, rstart, rend, options, logger):
     if options.discardSequencesShorterThan:
         aligned_length = rend - rstart
         if aligned_length < int(options.discardSequencesShorterThan):
-            logger.debug("Removed read with length {}".format(aligned_length))
+            logger.debug("Removed read with length %d", aligned_length)
             return contig_data
 
+    contig_id = contig_data.ids[contig]
     if not options.noCoverage:
+        if rstart < 0 or rend > contig_data.lengths[contig_id]:
+            raise IndexError("Read at {}-{} is outside contig {}".format(rstart, rend, contig))
         # Add 1 at the starting position of the mapped read and 
         # subtract 1 at the end so that we later can compute the 
         # cumulative sum from left to right across the entire contig.
-        contig_data[contig]["__coverage__"][rstart] += 1
-        contig_data[contig]["__coverage__"][rend] += -1
+        contig_data.add_read(contig_id)
+        coverage, offset = contig_data.coverage_of(contig_id)
+        coverage[offset+rstart] += 1
+        coverage[offset+rend] += -1
 
     if not options.noCounts:
-        annotations_matched = determine_if_read_is_inside_region(contig_data, contig, rstart, rend, options, logger)
-        for annotation in annotations_matched:
-            contig_data[contig][annotation][0] += 1 # Number of mapped reads
+        annotations_matched = determine_if_read_is_inside_region(contig_data, contig_id, rstart, rend, options, logger)
+        for row in annotations_matched:
+            contig_data.annotation_counts[row] += 1 # Number of mapped reads
 
     return contig_data
 
-def determine_if_read_is_inside_region(contig_data, contig, rstart, rend, options, logger):
-    """ Determines if a read lies within an annotated region of a contig. """
+def determine_if_read_is_inside_region(contig_data, contig_id, rstart, rend, options, logger):
+    """ Determines if a read lies within an annotated region of a contig.
 
-    rstart = rstart+1 # Annotations have 1-based numbers
-    annotations_matched = []
-
-    for annotation in contig_data[contig].keys():
-        if rend - rstart + 1 >= options.coverageReadOverlap:
-            a_start = contig_data[contig][annotation][1] + options.coverageReadOverlap
-            a_end = contig_data[contig][annotation][2] - options.coverageReadOverlap
-            
-            if rend >= a_start and rend <= a_end:
-                annotations_matched.append(annotation)
-            elif rstart >= a_start and rstart <= a_end:
-                annotations_matched.append(annotation)
-
-    return annotations_matched
+    Queries the interval index built by initialize_annotation_counts
+    instead of scanning all annotations of the contig. Returns the
+    annotation rows in contig_data that the read matches. """
 
+    rstart = rstart+1 # Annotations have 1-based numbers
+    return contig_data.index.query(contig_id, rstart, rend)
 
 ###############################################
 #    Exceptions
@@ -22,19 +22,21 @@
 # 
 import numpy as np
 
-def debug_output_coverage(logger, output_filename, contig_coverage):
+def debug_output_coverage(logger, output_filename, contig_data):
     """Debug function to write out the numpy arrays for manual inspection. WARNING: SLOOOW!"""
-    if options.outputCoverage:
-        np.set_printoptions(threshold='nan', linewidth='inf')
-        logger.debug("Writing complete coverage maps to {} (this is sloooow!)".format(output_filename))
-        with open(output_filename, "w") as coverageFile:
-            for contig in contig_coverage.keys():
-                coverageFile.write('\t'.join([contig, str(contig_coverage[contig])+"\n"]))
-        logger.debug("Coverage maps written to {}.".format(output_filename))
+    np.set_printoptions(threshold='nan', linewidth='inf')
+    logger.debug("Writing complete coverage maps to {} (this is sloooow!)".format(output_filename))
+    with open(output_filename, "w") as coverageFile:
+        for contig in contig_data.names:
+            coverageFile.write('\t'.join([contig, str(contig_data.get_coverage(contig))+"\n"]))
+    logger.debug("Coverage maps written to {}.".format(output_filename))
 
 def debug_print_single_coverage(contig_data, contig):
     """ Debug function to print a single contigs numpy array and additional annotation information."""
     np.set_printoptions(threshold='nan', linewidth='inf')
     print "Annotations and coverage for sequence '{}'".format(contig)
-    for annotation in contig_data[contig].keys():
-        print annotation, contig_data[contig][annotation]
+    for row in contig_data.annotation_rows(contig):
+        annotation, count, start, end, strand = contig_data.get_annotation(row)
+        print annotation, [count, start, end, strand]
+    if contig_data.coverage is not None:
+        print "__coverage__", contig_data.get_coverage(contig)
@@ -21,8 +21,15 @@ date:: 2014-04-30
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # 
+import unittest
 import numpy as np
 
+# Medians are computed from per-region histograms when the coverage values
+# of a block span at most MAX_HISTOGRAM_SPAN values, using histograms of at
+# most HISTOGRAM_SIZE bins at a time. Otherwise the values are sorted.
+MAX_HISTOGRAM_SPAN = 1 << 16
+HISTOGRAM_SIZE = 1 << 22
+
 def compute_region_statistics(region):
     """
     Compute general statistics of reads mapped to a region of a contig.
@@ -38,3 +45,147 @@ def compute_region_statistics(region):
     """
     return (np.median(region), np.mean(region), np.std(region))
 
+
+def compute_regions_statistics(values, lengths):
+    """
+    Compute the statistics of compute_region_statistics for many regions at once.
+
+    Means come from exact integer prefix sums of the values. Standard
+    deviations are computed in two passes like np.std: the squared
+    deviations from the mean are summed with np.add.reduce along the rows
+    of a 2-D array of the regions of each length, which adds them in the
+    same order as np.std does for a single region, so the results are
+    identical. Medians come from per-region histograms, or from a single
+    sort of all values keyed on region if the values span a wide range.
+    If the sums could exceed the exactly representable floats,
+    compute_region_statistics is used for each region instead.
+
+    Input:
+        values   a NumPy array of ints with the concatenated coverage of
+                 all regions.
+        lengths  a NumPy array with the number of positions in each region.
+    Output:
+        medians  NumPy array (float) with the median of each region.
+        means    NumPy array (float) with the mean of each region.
+        stdevs   NumPy array (float) with the standard deviation of each region.
+                 Empty regions get NaN, like np.median/np.mean/np.std.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    medians = np.empty(len(lengths))
+    means = np.empty(len(lengths))
+    stdevs = np.empty(len(lengths))
+    for stats in (medians, means, stdevs):
+        stats.fill(np.nan)
+    firsts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=firsts[1:])
+    rows = np.flatnonzero(lengths > 0)
+    if not rows.size:
+        return medians, means, stdevs
+
+    largest = int(np.abs(values).max())
+    if values.size * largest >= (1 << 53):
+        for row in rows:
+            region = values[firsts[row]:firsts[row]+lengths[row]]
+            medians[row], means[row], stdevs[row] = compute_region_statistics(region)
+        return medians, means, stdevs
+
+    n = lengths[rows]
+    starts = firsts[rows]
+    ends = starts + n
+    prefix = np.zeros(values.size+1, dtype=np.int64)
+    np.cumsum(values, out=prefix[1:])
+    sums = prefix[ends] - prefix[starts]
+    means[rows] = sums / n.astype(np.float64)
+    deviations = values - np.repeat(means[rows], n)
+    squares = deviations * deviations
+    by_length = np.argsort(n, kind="mergesort")
+    for group in np.split(by_length, np.flatnonzero(np.diff(n[by_length])) + 1):
+        length = n[group[0]]
+        squared = squares[starts[group][:, np.newaxis] + np.arange(length)]
+        stdevs[rows[group]] = np.sqrt(np.add.reduce(squared, axis=1) / float(length))
+
+    low = int(values.min())
+    span = int(values.max()) - low + 1
+    if span <= MAX_HISTOGRAM_SPAN:
+        medians[rows] = _histogram_medians(values - low, n, span) + low
+    else:
+        # Sort the values within each region by sorting on (region, value)
+        labels = np.repeat(np.arange(len(rows), dtype=np.int64), n)
+        ordered = np.sort(labels*span + (values - low)) - labels*span + low
+        medians[rows] = (ordered[starts + (n-1)//2] + ordered[starts + n//2]) / 2.0
+    return medians, means, stdevs
+
+
+def _histogram_medians(values, lengths, span):
+    """
+    Medians of consecutive non-empty regions of values in [0, span) from
+    per-region histograms, processed a group of regions at a time.
+    """
+    medians = np.empty(len(lengths))
+    firsts = np.zeros(len(lengths)+1, dtype=np.int64)
+    np.cumsum(lengths, out=firsts[1:])
+    group_size = max(1, HISTOGRAM_SIZE // span)
+    for first in xrange(0, len(lengths), group_size):
+        last = min(first+group_size, len(lengths))
+        n = lengths[first:last]
+        labels = np.repeat(np.arange(last-first, dtype=np.int64), n)
+        bins = labels*span + values[firsts[first]:firsts[last]]
+        # Cumulative histogram of all regions in the group, bins of region i
+        # are [i*span, (i+1)*span). The value at rank r in region i is found
+        # from the first bin where the cumulative count exceeds the rank.
+        cumulative = np.cumsum(np.bincount(bins, minlength=(last-first)*span))
+        ranks = firsts[first:last] - firsts[first]
+        bases = np.arange(last-first, dtype=np.int64) * span
+        lower = np.searchsorted(cumulative, ranks + (n-1)//2, side="right") - bases
+        upper = np.searchsorted(cumulative, ranks + n//2, side="right") - bases
+        medians[first:last] = (lower + upper) / 2.0
+    return medians
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_compute_regions_statistics(unittest.TestCase):
+    """ The block statistics must be identical to compute_region_statistics per region. """
+
+    def _compare(self, values, lengths):
+        values = np.asarray(values)
+        medians, means, stdevs = compute_regions_statistics(values, lengths)
+        first = 0
+        for row, length in enumerate(lengths):
+            if length:
+                expected = compute_region_statistics(values[first:first+length])
+                self.assertEqual((medians[row], means[row], stdevs[row]), expected)
+            else:
+                self.assertTrue(np.isnan([medians[row], means[row], stdevs[row]]).all())
+            first += length
+
+    def _lengths(self, random):
+        # Short regions use sequential sums in np.std, long ones pairwise sums
+        return list(random.randint(0, 20, 300)) + list(random.randint(100, 3000, 30)) + [9000, 20000]
+
+    def test_histogram_medians(self):
+        random = np.random.RandomState(0)
+        lengths = self._lengths(random)
+        self._compare(random.randint(0, 500, sum(lengths)).astype(np.int32), lengths)
+
+    def test_sorted_medians(self):
+        random = np.random.RandomState(1)
+        lengths = self._lengths(random)
+        values = random.randint(0, 3*MAX_HISTOGRAM_SPAN, sum(lengths)).astype(np.int32)
+        self._compare(values, lengths)
+
+    def test_overflow_fallback(self):
+        random = np.random.RandomState(2)
+        lengths = [10, 0, 1000, 5]
+        values = random.randint(0, 1 << 50, sum(lengths)).astype(np.int64)
+        self.assertTrue(values.size * int(values.max()) >= (1 << 53))
+        self._compare(values, lengths)
+
+    def test_empty_regions(self):
+        self._compare([3, 1, 4, 1, 5], [0, 2, 0, 3, 0])
+        self._compare([], [0, 0])
+        self._compare([], [])
@@ -1,3 +1,6 @@
 from launchers import *
 from registering_worker_pool import *
-from zero_rpc_worker_pool import *
\ No newline at end of file
+from zero_rpc_worker_pool import *
+from worker_slots import *
+from locality_task_queue import *
+from retry_policy import *
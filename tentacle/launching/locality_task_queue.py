@@ -0,0 +1,240 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Task queue of a RegisteringWorkerPool that keeps tasks sharing a
+reference on the same nodes.
+
+Tasks are grouped by a locality key (e.g. their reference and
+annotation files). A node that has run a task of a group holds the
+group's files locally (in its reference DB cache), so it is given more
+tasks of that group before anything else. A node that holds none of
+the pending groups starts on a group that no other node holds, and a
+node with nothing else to do steals work from the group with the most
+pending tasks. Within a group, and among groups, the queued tasks with
+the highest cost (e.g. estimated runtime) are handed out first, and
+tasks of equal cost in the order they were put into the queue. A worker
+may restrict the tasks it takes to those that fit in the free resources
+of its node.
+"""
+from collections import OrderedDict
+import bisect
+import itertools
+import unittest
+import gevent
+import gevent.event
+from ..utils.gevent_utils import IsClosed
+
+__all__ = ["LocalityTaskQueue"]
+
+class LocalityTaskQueue(object):
+    """ A queue of task dictionaries, read by workers that identify their node. """
+
+    def __init__(self):
+        # Locality key -> list of ((-cost, sequence number), task), sorted
+        self._groups = OrderedDict()
+        # Node -> set of locality keys of the tasks it has run
+        self._held = {}
+        self._sequence = itertools.count()
+        self._pending = 0
+        self._closed = False
+        self._changed = gevent.event.Event()
+        self.local_tasks = 0
+        self.staged_groups = 0
+
+
+    def put(self, task, locality=None, cost=0):
+        """ Adds a task with a locality key (None for tasks without locality) and a cost. """
+        if self._closed:
+            raise IsClosed
+        # The sequence numbers are unique, so the tasks themselves are never compared
+        bisect.insort(self._groups.setdefault(locality, []), ((-cost, next(self._sequence)), task))
+        self._pending += 1
+        self._changed.set()
+
+
+    def put_many(self, tasks, locality=None, cost=None):
+        """ Adds tasks, with locality keys and costs from the functions locality(task) and cost(task) if given. """
+        for task in tasks:
+            self.put(task, locality(task) if locality else None, cost(task) if cost else 0)
+
+
+    def close(self):
+        """ Closes the queue for new tasks, get returns None when the remaining tasks are taken. """
+        self._closed = True
+        self._changed.set()
+
+
+    def notify(self):
+        """ Wakes the workers waiting in get, e.g. when resources on their node were released. """
+        self._changed.set()
+
+
+    def get(self, node, fits=None):
+        """ Waits for a task for a worker on node, returns None if the queue is closed and empty.
+
+        fits is an optional function of a task returning True if it can
+        start on the node now. Only such tasks are taken, the worker
+        waits (until notify) for a task that fits.
+        """
+        while True:
+            if self._pending:
+                chosen = self._choose_task(node, fits)
+                if chosen is not None:
+                    break
+            elif self._closed:
+                return None
+            self._changed.clear()
+            self._changed.wait()
+        locality, index = chosen
+        _, task = self._groups[locality][index]
+        del self._groups[locality][index]
+        if not self._groups[locality]:
+            del self._groups[locality]
+        self._pending -= 1
+        held = self._held.setdefault(node, set())
+        if locality is not None:
+            if locality in held:
+                self.local_tasks += 1
+            else:
+                self.staged_groups += 1
+                held.add(locality)
+        return task
+
+
+    def drain(self):
+        """ Removes and returns all queued tasks. """
+        tasks = [task for _, task in sorted(entry for group in self._groups.itervalues() for entry in group)]
+        self._groups.clear()
+        self._pending = 0
+        return tasks
+
+
+    def _choose_task(self, node, fits=None):
+        """ Returns the locality key and the index in its group of the next task of node, None if no task fits. """
+        # Locality key -> index of the first task in the group that fits
+        first = {}
+        for key, group in self._groups.iteritems():
+            for index, (_, task) in enumerate(group):
+                if fits is None or fits(task):
+                    first[key] = index
+                    break
+        if not first:
+            return None
+        def priority(key):
+            return self._groups[key][first[key]][0]
+        def oldest(keys):
+            key = min(keys, key=priority)
+            return (key, first[key])
+        held = self._held.get(node, set())
+        local = [key for key in first if key in held]
+        if local:
+            return oldest(local)
+        held_elsewhere = set()
+        for other_node, keys in self._held.iteritems():
+            if other_node != node:
+                held_elsewhere.update(keys)
+        unclaimed = [key for key in first if key is None or key not in held_elsewhere]
+        if unclaimed:
+            return oldest(unclaimed)
+        # Steal from the group with the most pending tasks
+        key = min(first, key=lambda key: (-len(self._groups[key]), priority(key)))
+        return (key, first[key])
+
+
+    def report(self):
+        """ Returns a summary of how often tasks ran where their files already were. """
+        return "{} tasks ran on a node that already held their reference, {} references were staged on a node".format(
+            self.local_tasks, self.staged_groups)
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_LocalityTaskQueue(unittest.TestCase):
+    def test_fifo_without_locality(self):
+        q = LocalityTaskQueue()
+        q.put_many(range(3))
+        q.close()
+        self.assertSequenceEqual([q.get("a") for _ in range(4)], [0, 1, 2, None])
+
+    def test_prefers_held_reference(self):
+        q = LocalityTaskQueue()
+        q.put_many(["r1", "r2", "r1", "r2", "r1"], locality=lambda task: task)
+        self.assertEqual(q.get("a"), "r1")
+        self.assertEqual(q.get("b"), "r2")
+        self.assertEqual(q.get("b"), "r2")
+        self.assertEqual(q.get("a"), "r1")
+        self.assertEqual(q.local_tasks, 2)
+        self.assertEqual(q.staged_groups, 2)
+
+    def test_steals_when_idle(self):
+        q = LocalityTaskQueue()
+        q.put_many(["r1", "r1", "r1", "r2"], locality=lambda task: task)
+        self.assertEqual(q.get("a"), "r1")
+        self.assertEqual(q.get("b"), "r2")
+        # b holds nothing pending and r1 is held by a
+        self.assertEqual(q.get("b"), "r1")
+
+    def test_takes_tasks_that_fit(self):
+        q = LocalityTaskQueue()
+        q.put_many([8, 2, 4])
+        self.assertEqual(q.get("a", fits=lambda cpus: cpus <= 4), 2)
+        self.assertEqual(q.get("a", fits=lambda cpus: cpus <= 4), 4)
+        waiting = gevent.spawn(q.get, "a", lambda cpus: cpus <= 1)
+        gevent.sleep(0)
+        self.assertFalse(waiting.ready())
+        q.notify()
+        gevent.sleep(0)
+        self.assertFalse(waiting.ready())
+        waiting.kill()
+        self.assertEqual(q.get("a", fits=lambda cpus: cpus <= 8), 8)
+        q.close()
+        self.assertEqual(q.get("a", fits=lambda cpus: False), None)
+
+    def test_drain(self):
+        q = LocalityTaskQueue()
+        q.put_many(["r1", "r2", "r1"], locality=lambda task: task)
+        self.assertSequenceEqual(q.drain(), ["r1", "r2", "r1"])
+        q.close()
+        self.assertEqual(q.get("a"), None)
+
+    def test_highest_cost_first(self):
+        q = LocalityTaskQueue()
+        q.put_many([(1, "r1"), (5, "r2"), (3, "r1"), (3, "r2")], locality=lambda task: task[1], cost=lambda task: task[0])
+        self.assertEqual(q.get("a"), (5, "r2"))
+        # Tasks put later are ordered among the queued ones, equal costs in put order
+        q.put((4, "r2"), "r2", 4)
+        q.put((3, "r2"), "r2", 3)
+        self.assertEqual(q.get("a"), (4, "r2"))
+        self.assertEqual(q.get("a"), (3, "r2"))
+        self.assertEqual(q.get("a"), (3, "r2"))
+        # b starts on the unclaimed group with the costliest task
+        self.assertEqual(q.get("b"), (3, "r1"))
+        self.assertEqual(q.get("b"), (1, "r1"))
+
+    def test_waits_for_tasks(self):
+        q = LocalityTaskQueue()
+        waiting = gevent.spawn(q.get, "a")
+        gevent.sleep(0)
+        self.assertFalse(waiting.ready())
+        q.put("task")
+        self.assertEqual(waiting.get(timeout=1), "task")
+        waiting = gevent.spawn(q.get, "a")
+        q.close()
+        self.assertEqual(waiting.get(timeout=1), None)
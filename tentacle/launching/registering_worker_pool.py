@@ -18,13 +18,21 @@ from __future__ import print_function
 import os
 import argparse
 import unittest
+import tempfile
 import gevent
+import gevent.pool
+import gevent.queue
 import socket
-from datetime import datetime
+import heapq
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from .launchers import GeventLauncher
+from .worker_slots import Resources, WorkerSlots, local_resources
+from .locality_task_queue import LocalityTaskQueue
+from .retry_policy import RetryPolicy, classify_failure, add_retry_arguments, LOST_WORKER
 from ..utils.gevent_utils import IterableQueue
 from ..utils import ScopedObject
-from tentacle.utils.query_jobs_utils import write_jobs_summary
+from tentacle.utils.query_jobs_utils import write_jobs_summary, start_jobs_summary, append_job_summary, finish_jobs_summary, start_results_index, append_results_index
 
 
 __all__ = []
@@ -35,6 +43,30 @@ class Worker(ScopedObject):
         result = apply(task,[])
         return result
 
+    def resources(self):
+        """ Returns the Resources (CPUs, memory) of the node the worker runs on. """
+        return local_resources()
+
+    def keep_alive(self):
+        """ Keeps the worker from closing when idle, see ZeroRpcWorkerPoolWorker. """
+        pass
+
+def lpt_makespan(costs, slots):
+    """ Returns the makespan of running tasks with costs longest first on slots concurrent slots. """
+    finish_times = [0] * max(1, slots)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
+
+def peak_concurrency(intervals):
+    """ Returns the largest number of (start, end) intervals that overlap. """
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
 __all__.append("WorkerDisabledException")
 class WorkerDisabledException(Exception):
     """ Raised when master process loses connection to worker node. 
@@ -43,16 +75,32 @@ class WorkerDisabledException(Exception):
         self.message = message
 
 
+__all__.append("NoWorkersLeftException")
+class NoWorkersLeftException(Exception):
+    """ Set as the result of the tasks left when the nodes of all workers are blacklisted. """
+    pass
+
+
 __all__.append("RegisteringWorkerPool")
 class RegisteringWorkerPool(ScopedObject):
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, max_tasks_per_worker=0, retry_policy=None, keep_alive_interval=None):
         #TODO: Handle errors in init?
         super(RegisteringWorkerPool, self).__init__()
-        self.tasks_with_result_slots_queue = IterableQueue()
+        self.tasks_with_result_slots_queue = LocalityTaskQueue()
         self.working_greenlets = IterableQueue()
         self.map_jobs = []
         self.output_dir = output_dir
-        self._scope.on_exit(lambda: self.working_greenlets.close(), #close for adding more entries
+        self.max_tasks_per_worker = max_tasks_per_worker
+        # Node -> WorkerSlots shared by the workers on the node
+        self.node_slots = {}
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Seconds between keep alive calls to idle workers while retries wait for their backoff
+        self.keep_alive_interval = keep_alive_interval
+        self.delayed_retries = gevent.pool.Group()
+        self.active_workers = 0
+        self.no_workers_left = False
+        self._scope.on_exit(lambda: self.delayed_retries.kill(),
+                            lambda: self.working_greenlets.close(), #close for adding more entries
                             lambda: self.tasks_with_result_slots_queue.close(), #close for adding more entries
                             lambda: [g.join() for g in self.working_greenlets])
 
@@ -60,72 +108,243 @@ class RegisteringWorkerPool(ScopedObject):
         """ Starts a greenlet that puts the worker to work, running tasks from the queue.
         """
         g = gevent.Greenlet(self._run_tasks_from_queue, worker)
+        self.no_workers_left = False
         self.working_greenlets.put(g)
         g.start()
         
     def _run_tasks_from_queue(self, worker):
         """ Run tasks from the queue on the worker.
+
+        Several tasks run concurrently on the worker as long as the CPUs
+        and memory they declare (their "requirements") fit in the
+        resources of its node, see WorkerSlots. The workers on a node
+        share its resources, and a worker only takes a task from the
+        queue when it fits in what is free. Tasks without requirements
+        run alone. The worker is identified by its node name in the
+        queue, which prefers giving it tasks that share files with the
+        tasks run on the node before, see LocalityTaskQueue.
+        Failed tasks are retried according to the RetryPolicy, and the
+        worker stops taking tasks if its node is blacklisted. While
+        retries wait for their backoff, the worker is kept from closing
+        when idle.
         """
-        def put_failed_job_back_into_queue(self, d, e):
-            """ Helper function to put a failed job back into the queue.
+        def put_failed_job_back_into_queue(self, d, e, failure):
+            """ Helper function to put a failed job back into the queue,
+            after a backoff, if the retry policy retries the failure.
             """
             # Everything in this tuple has to be strings, since most objects wont serialize.
-            d["attempts"].append((d["worker_name"], str(d["start_time"]), str(e)))
+            d["attempts"].append((d["worker_name"], str(d["start_time"]), "{}: {}".format(failure, e)))
             d["start_time"] = ""
             d["worker_name"] = ""
-            if len(d["attempts"]) < 2: #options.maxAttempts:
-                self.tasks_with_result_slots_queue.put(d)
-            else:
+            if self.retry_policy.task_failed(worker_name, failure):
+                print("Worker {} failed {} tasks in a row, it will not be given more tasks.".format(worker_name, self.retry_policy.blacklist_after))
+            delay = self.retry_policy.retry_delay(failure, len(d["attempts"]))
+            if delay is None:
                 d["result"].set_exception(e)
+            elif delay:
+                print("Retrying task '{}' ({}) in {} seconds.".format(d["description"][0], failure, delay))
+                self.delayed_retries.add(gevent.spawn_later(delay, self._requeue, d))
+            else:
+                self._requeue(d)
             return (self, d)
             
+        def run_task(d, reserved):
+            try:
+                d["worker_name"] = worker_name
+                d["start_time"] = datetime.now()
+                result = worker.run(d["task"])
+                d["end_time"] = datetime.now()
+                self.retry_policy.task_succeeded(worker_name)
+                d["result"].set(result)
+                #self.logger.info("Finished {task} at worker with endpoint(s): {ep}".format(task=task, ep=worker._worker_endpoints))
+            except WorkerDisabledException as e:
+                #self.logger.error("Lost connection to Worker with endpoint(s): {}".format(worker._worker_endpoints)) # TODO
+                print("Lost connetion to Worker {} with endpoint(s): {}".format(d["worker_name"], worker._worker_endpoints))
+                worker_lost.set()
+                put_failed_job_back_into_queue(self, d, 
+                    WorkerDisabledException("Lost connection to Worker {} with endpoint(s) {}".format(d["worker_name"], worker._worker_endpoints)),
+                    LOST_WORKER)
+            except Exception as e:
+                #self.logger.error("Error when trying to execute task {} by worker {}\n{}".format(description, worker, traceback.format_exc())) # TODO
+                failure = classify_failure(e)
+                print("Error when trying to execute task '{}' by Worker {} ({}).\n{}.".format(d["description"][0], d["worker_name"], failure, str(e)))
+                put_failed_job_back_into_queue(self, d, e, failure)
+            finally:
+                slots.release(reserved)
+                self.tasks_with_result_slots_queue.notify()
+
+        def keep_worker_alive():
+            while True:
+                gevent.sleep(self.keep_alive_interval)
+                if len(self.delayed_retries):
+                    try:
+                        worker.keep_alive()
+                    except WorkerDisabledException:
+                        return
+
         try:    
             worker_ip = worker._worker_endpoints[0].split("//")[1].split(":")[0]
         except AttributeError:
             worker_ip = "localhost"
+        worker_lost = gevent.event.Event()
+        running_tasks = gevent.pool.Group()
+        keep_alive = gevent.spawn(keep_worker_alive) if self.keep_alive_interval else None
+        self.active_workers += 1
         # Here is where the jobs are run
         try:
-            for d in self.tasks_with_result_slots_queue:
-                try:
-                    d["worker_name"] = str(socket.gethostbyaddr(worker_ip)[1][0])
-                    d["start_time"] = datetime.now()
-                    result = worker.run(d["task"])
-                    d["result"].set(result)
-                    d["end_time"] = datetime.now()
-                except WorkerDisabledException as e:
-                    #self.logger.error("Lost connection to Worker with endpoint(s): {}".format(worker._worker_endpoints)) # TODO
-                    print("Lost connetion to Worker {} with endpoint(s): {}".format(d["worker_name"], worker._worker_endpoints))
-                    self, d = put_failed_job_back_into_queue(self, d, 
-                        "Lost connection to Worker {} with endpoint(s) {}".format(d["worker_name"], worker._worker_endpoints))
+            try:
+                worker_name = str(socket.gethostbyaddr(worker_ip)[1][0])
+            except (socket.error, IndexError):
+                worker_name = worker_ip
+            try:
+                capacity = worker.resources()
+            except WorkerDisabledException:
+                capacity = None
+            if worker_name not in self.node_slots:
+                self.node_slots[worker_name] = WorkerSlots(capacity, self.max_tasks_per_worker)
+            slots = self.node_slots[worker_name]
+            fits = lambda d: slots.fits(slots.fit(d["requirements"]))
+            while not worker_lost.is_set() and not self.retry_policy.is_blacklisted(worker_name):
+                d = self.tasks_with_result_slots_queue.get(worker_name, fits)
+                if d is None:
                     break
-                except Exception as e:
-                    #self.logger.error("Error when trying to execute task {} by worker {}\n{}".format(description, worker, traceback.format_exc())) # TODO
-                    print("Error when trying to execute task '{}' by Worker {}.\n{}.".format(d["description"][0], d["worker_name"], str(e)))
-                    self, d = put_failed_job_back_into_queue(self, d, e)
-
-                #self.logger.info("Finished {task} at worker with endpoint(s): {ep}".format(task=task, ep=worker._worker_endpoints))
+                reserved = slots.acquire(d["requirements"])
+                if worker_lost.is_set() or self.retry_policy.is_blacklisted(worker_name):
+                    slots.release(reserved)
+                    self.tasks_with_result_slots_queue.put(d, d["locality"], d["cost"])
+                    break
+                running_tasks.spawn(run_task, d, reserved)
+            running_tasks.join()
         finally:
+            if keep_alive:
+                keep_alive.kill()
+            running_tasks.kill()
             worker.close()
+            self.active_workers -= 1
+            if not self.active_workers and self.retry_policy.is_blacklisted(worker_name):
+                self.no_workers_left = True
+                queued = self.tasks_with_result_slots_queue.drain()
+                print("The nodes of all workers are blacklisted, failing the {} queued tasks.".format(len(queued)))
+                for d in queued:
+                    self._requeue(d)
+
+    def _requeue(self, d):
+        """ Puts a task back into the queue, or fails it if the nodes of all workers are blacklisted. """
+        if self.no_workers_left:
+            d["result"].set_exception(NoWorkersLeftException("The nodes of all workers are blacklisted"))
+        else:
+            self.tasks_with_result_slots_queue.put(d, d["locality"], d["cost"])
     
-    def map(self, f, items):
-        """ Creates a list of tasks and results. """
-        def make_call(f, item): 
-            return (lambda: f(item))
-        tasks_and_results = [{"description":item,
-                              "worker_name":"", 
-                              "task":make_call(f,item), 
-                              "result":gevent.event.AsyncResult(), 
-                              "start_time":"", 
-                              "end_time":"",
-                              "attempts":[]} for item in items]
+    def map(self, f, items, requirements=None, locality=None, cost=None):
+        """ Creates a list of tasks and results.
+
+        requirements is an optional function returning the Resources
+        (CPUs, memory) needed to run f on an item. locality is an
+        optional function returning a key of the files an item needs on
+        the node (e.g. its reference), items with the same key are
+        preferably run on the same nodes. cost is an optional function
+        returning the estimated runtime of an item in seconds, the
+        queued items are then handed out longest first (LPT) so that
+        large items do not start last, and the predicted and actual
+        makespans are printed when all items are done.
+        """
+        tasks_and_results = [self._create_task(f, item, requirements, locality, cost) for item in items]
         self.map_jobs.append(tasks_and_results)
-        self.tasks_with_result_slots_queue.put_many(tasks_and_results)
+        self.tasks_with_result_slots_queue.put_many(tasks_and_results, locality=lambda d: d["locality"],
+                                                    cost=lambda d: d["cost"])
         for job in tasks_and_results:
             job["result"].wait()
+        if locality:
+            print("Data locality: {}".format(self.tasks_with_result_slots_queue.report()))
+        if cost:
+            self.print_makespans([d["cost"] for d in tasks_and_results],
+                                 [(d["start_time"], d["end_time"]) for d in tasks_and_results if d["end_time"]])
         results = [job["result"] for job in tasks_and_results] #pylint: disable=W0601
         self.write_run_summary()
         return results
 
+    def imap_unordered(self, f, items, requirements=None, locality=None, cost=None):
+        """ Like map, but yields (item, result) pairs as the tasks complete.
+
+        items may be a lazy iterable (e.g. an IterableQueue) that yields
+        new items while the pool is running, they are queued as they
+        come. Each completed task is appended to the run summary and the
+        results index in the output dir and then forgotten, so the
+        bookkeeping does not grow with the number of items. With cost
+        the items that are queued at a time are handed out longest
+        first, the items are still read as they come.
+        """
+        summary_file = os.path.join(self.output_dir, "run_summary.txt")
+        index_file = os.path.join(self.output_dir, "results_index.tab")
+        start_jobs_summary(summary_file)
+        start_results_index(index_file)
+        running_jobs = OrderedDict()
+        self.map_jobs.append(running_jobs)
+        completed = gevent.queue.Queue()
+        queued = [0]
+        def queue_items():
+            for item in items:
+                d = self._create_task(f, item, requirements, locality, cost)
+                running_jobs[id(d)] = d
+                d["result"].rawlink(lambda result, d=d: completed.put(d))
+                self.tasks_with_result_slots_queue.put(d, d["locality"], d["cost"])
+                queued[0] += 1
+        feeder = gevent.spawn(queue_items)
+        feeder.link(lambda feeder: completed.put(None))
+        done = 0
+        costs, intervals = [], []
+        try:
+            while not feeder.ready() or done < queued[0]:
+                d = completed.get()
+                if d is None:
+                    feeder.get() # Raises the errors of items
+                    continue
+                done += 1
+                del running_jobs[id(d)]
+                description = self.describe_task(d)
+                append_job_summary(description, summary_file)
+                append_results_index(description, index_file)
+                if cost:
+                    costs.append(d["cost"])
+                    if d["end_time"]:
+                        intervals.append((d["start_time"], d["end_time"]))
+                yield (d["description"], d["result"])
+        finally:
+            feeder.kill()
+        finish_jobs_summary(summary_file, done)
+        if locality:
+            print("Data locality: {}".format(self.tasks_with_result_slots_queue.report()))
+        if cost:
+            self.print_makespans(costs, intervals)
+
+    def _create_task(self, f, item, requirements, locality, cost):
+        """ Returns the dictionary of a task running f on item, see map. """
+        def make_call(f, item): 
+            return (lambda: f(item))
+        return {"description":item,
+                "worker_name":"", 
+                "task":make_call(f,item), 
+                "requirements":requirements(item) if requirements else None,
+                "locality":locality(item) if locality else None,
+                "cost":cost(item) if cost else 0,
+                "result":gevent.event.AsyncResult(), 
+                "start_time":"", 
+                "end_time":"",
+                "attempts":[]}
+
+    def print_makespans(self, costs, intervals):
+        """ Prints the makespan predicted from the task costs next to the actual makespan.
+
+        intervals are the (start_time, end_time) of the completed tasks.
+        """
+        if not intervals:
+            return
+        actual = (max(end for _, end in intervals) - min(start for start, _ in intervals)).total_seconds()
+        slots = peak_concurrency(intervals)
+        predicted = lpt_makespan(costs, slots)
+        print("Predicted makespan {} for {} tasks on {} concurrent slots, actual makespan {}.".format(
+            timedelta(seconds=round(predicted)), len(costs), slots, timedelta(seconds=round(actual))))
+
     def write_run_summary(self):
         """ Writes a complete summary on the status of all jobs after job "completion". """
         summary_filename = "run_summary.txt"
@@ -135,7 +354,8 @@ class RegisteringWorkerPool(ScopedObject):
 
     def get_mapped_jobs_description(self):
         """ Provides a way to query the status of jobs currently registered with the server."""
-        return [[self.describe_task(item) for item in map_job] for map_job in self.map_jobs]
+        return [[self.describe_task(item) for item in (map_job.itervalues() if isinstance(map_job, dict) else map_job)]
+                for map_job in self.map_jobs]
 
     def describe_task(self, item_entry):
         """ Prepares the information in the job list for serialization. """
@@ -156,15 +376,21 @@ class GeventWorkerPoolFactory(object):
         group.add_argument("-N", "--distributionNodeCount", dest="node_count", type=int,
             default=1,
             help="The number of distributed nodes to run on. [default =  %(default)s]")
+        group.add_argument("--distributionMaxTasksPerNode", dest="max_tasks_per_worker", type=int,
+            default=0,
+            help="The maximum number of tasks run concurrently on a node, within its CPUs and memory. [default = no limit]")
+        add_retry_arguments(group)
         parser.add_argument_group(group)
         return parser
     
     def create_from_parsed_args(self, parsed_args, output_dir, *args, **kwargs):
-        return self.create(worker_count=parsed_args.node_count, output_dir=output_dir)
+        return self.create(worker_count=parsed_args.node_count, output_dir=output_dir,
+                           max_tasks_per_worker=parsed_args.max_tasks_per_worker,
+                           retry_policy=RetryPolicy.create_from_parsed_args(parsed_args))
     
-    def create(self, worker_count, output_dir):
+    def create(self, worker_count, output_dir, max_tasks_per_worker=0, retry_policy=None):
         #Create the pool
-        pool = RegisteringWorkerPool(output_dir=output_dir)
+        pool = RegisteringWorkerPool(output_dir=output_dir, max_tasks_per_worker=max_tasks_per_worker, retry_policy=retry_policy)
         try:
             ws = [Worker() for _ in range(worker_count)]
             for w in ws: 
@@ -240,3 +466,96 @@ class RegisteringWorkerPoolTests(unittest.TestCase):
                     else:
                         self.assertEqual(res[i].value, i)
     #TODO: check exception throwing function in map
+
+    def Test_lpt_makespan(self):
+        self.assertEqual(lpt_makespan([2, 3, 7, 4, 4], 2), 10)
+        self.assertEqual(peak_concurrency([(0, 2), (1, 3), (2, 4)]), 2)
+
+    def test_task_errors_and_blacklisted_node(self):
+        output_dir = tempfile.mkdtemp()
+        items = [("task{}".format(i), ("reference", "reads{}".format(i), "annotations", "results", "log")) for i in range(10)]
+        # Task errors (e.g. corrupt reads files) do not blacklist the only node
+        def f(item):
+            if item[0] in ("task0", "task1", "task2"):
+                raise ValueError("Corrupt reads file")
+            return item[0]
+        pool = RegisteringWorkerPool(output_dir, retry_policy=RetryPolicy(backoff=0))
+        with pool:
+            pool.register_worker(Worker())
+            results = gevent.with_timeout(10, pool.map, f, items)
+        self.assertSequenceEqual([r.successful() for r in results], [False]*3 + [True]*7)
+        # When the only node is blacklisted, the tasks left fail instead of waiting forever
+        def g(item):
+            raise IOError(5, "Input/output error")
+        pool = RegisteringWorkerPool(output_dir, retry_policy=RetryPolicy(max_attempts=5, backoff=0, blacklist_after=2))
+        with pool:
+            pool.register_worker(Worker())
+            results = gevent.with_timeout(10, pool.map, g, items)
+        self.assertFalse(any(r.successful() for r in results))
+        self.assertIsInstance(results[-1].exception, NoWorkersLeftException)
+
+    def test_keep_alive_while_retries_wait(self):
+        class KeepAliveCountingWorker(Worker):
+            keep_alive_calls = 0
+            def keep_alive(self):
+                KeepAliveCountingWorker.keep_alive_calls += 1
+        attempts = []
+        def f(item):
+            attempts.append(item)
+            if len(attempts) == 1:
+                raise IOError(5, "Input/output error")
+            return item[0]
+        items = [("task", ("reference", "reads", "annotations", "results", "log"))]
+        pool = RegisteringWorkerPool(tempfile.mkdtemp(), retry_policy=RetryPolicy(backoff=0.3), keep_alive_interval=0.05)
+        with pool:
+            pool.register_worker(KeepAliveCountingWorker())
+            results = gevent.with_timeout(10, pool.map, f, items)
+        self.assertEqual(results[0].value, "task")
+        self.assertGreater(KeepAliveCountingWorker.keep_alive_calls, 2)
+
+    def test_workers_share_node_slots(self):
+        class FourCpuWorker(Worker):
+            def resources(self):
+                return Resources(4, 100)
+        cpus = [2, 2, 2, 4, 1, 1]
+        items = [("task{}".format(i), ("reference", "reads{}".format(i), "annotations", "results", "log")) for i in range(len(cpus))]
+        requirements = lambda item: Resources(cpus[int(item[0][4:])], 10)
+        running = [0]
+        peak = [0]
+        def f(item):
+            running[0] += requirements(item).cpus
+            peak[0] = max(peak[0], running[0])
+            gevent.sleep(0.05)
+            running[0] -= requirements(item).cpus
+            return item[0]
+        pool = RegisteringWorkerPool(tempfile.mkdtemp())
+        with pool:
+            # Both workers run on localhost and share its 4 CPUs
+            pool.register_worker(FourCpuWorker())
+            pool.register_worker(FourCpuWorker())
+            results = gevent.with_timeout(10, pool.map, f, items, requirements=requirements)
+        self.assertSequenceEqual([r.value for r in results], [item[0] for item in items])
+        self.assertEqual(peak[0], 4)
+
+    def test_imap_unordered_streams_longest_first(self):
+        costs = [1, 3, 2, 5, 4]
+        items = [("task{}".format(i), ("reference", "reads{}".format(i), "annotations", "results", "log")) for i in range(len(costs))]
+        cost = lambda item: costs[int(item[0][4:])]
+        started = []
+        def f(item):
+            started.append(item[0])
+            gevent.sleep(0.01)
+            return item[0]
+        queue = IterableQueue()
+        queue.put_many(items[:3])
+        pool = RegisteringWorkerPool(tempfile.mkdtemp())
+        with pool:
+            pool.register_worker(Worker())
+            results = pool.imap_unordered(f, queue, cost=cost)
+            # Items are handed out longest first among the queued ones, before the queue is closed
+            done = [gevent.with_timeout(10, next, results)[1].value for _ in range(3)]
+            queue.put_many(items[3:])
+            queue.close()
+            done += [result.value for _, result in gevent.with_timeout(10, list, results)]
+        self.assertSequenceEqual(started, ["task1", "task2", "task0", "task3", "task4"])
+        self.assertSequenceEqual(done, started)
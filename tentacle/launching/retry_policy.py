@@ -0,0 +1,174 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Retries of failed tasks in a RegisteringWorkerPool.
+
+Failures are classified by their cause:
+
+ * lost worker: the connection to the worker was lost, the task is
+   requeued right away for another worker,
+ * out of memory: the task (or its mapper) ran out of memory on the
+   node, it is retried after a backoff, when the node may have more
+   memory free or another node may take it,
+ * node error: I/O or operating system errors (e.g. a full disk or an
+   unavailable file system), retried after a backoff,
+ * task error: any other error, e.g. a corrupt reads file or a mapper
+   that rejects its input. Running the task again would fail in the
+   same way, so it is not retried.
+
+Each failure counts as an attempt, and a task is not retried after
+max_attempts attempts. The backoff doubles with every attempt. A node
+whose tasks run out of memory or fail on node errors a number of times
+in a row is blacklisted: its workers stop taking tasks, and the tasks
+are left to the other workers. Task errors and lost workers do not
+count, as they say nothing about the health of the node.
+
+Errors of remote workers arrive as zerorpc RemoteErrors, which carry the
+name and message of the remote exception; they are classified by those.
+"""
+import re
+import unittest
+
+__all__ = ["RetryPolicy", "classify_failure", "add_retry_arguments",
+           "LOST_WORKER", "OUT_OF_MEMORY", "NODE_ERROR", "TASK_ERROR"]
+
+LOST_WORKER = "lost worker"
+OUT_OF_MEMORY = "out of memory"
+NODE_ERROR = "node error"
+TASK_ERROR = "task error"
+
+# Retried failures, and whether they are retried after a backoff
+RETRIED_FAILURES = {LOST_WORKER: False, OUT_OF_MEMORY: True, NODE_ERROR: True}
+# Failures that count towards blacklisting the node
+NODE_FAILURES = set([OUT_OF_MEMORY, NODE_ERROR])
+
+NODE_ERROR_NAMES = set(["IOError", "OSError", "EnvironmentError"])
+# Messages of out of memory errors in Python, C/C++ and mapper output, and
+# the return code (-9, SIGKILL) of a MapperError for a mapper killed by the
+# kernel's out of memory killer
+OUT_OF_MEMORY_MESSAGES = re.compile(r"MemoryError|Cannot allocate memory|std::bad_alloc|[Oo]ut of memory|^-9$", re.MULTILINE)
+
+def classify_failure(e):
+    """ Returns the class of a task error: OUT_OF_MEMORY, NODE_ERROR or TASK_ERROR. """
+    name = getattr(e, "name", None) or type(e).__name__
+    if isinstance(e, MemoryError) or OUT_OF_MEMORY_MESSAGES.search(str(e)):
+        return OUT_OF_MEMORY
+    if isinstance(e, EnvironmentError) or name in NODE_ERROR_NAMES:
+        return NODE_ERROR
+    return TASK_ERROR
+
+
+def add_retry_arguments(group):
+    """ Adds the options of a RetryPolicy to an argparse group, see RetryPolicy.create_from_parsed_args. """
+    group.add_argument("--maxAttempts", dest="max_attempts", type=int,
+        default=2,
+        help="The maximum number of attempts to run a task whose failure may be temporary (lost worker, out of memory, node I/O error). Other task errors are not retried. [default =  %(default)s]")
+    group.add_argument("--distributionRetryBackoff", dest="retry_backoff", type=int,
+        default=30,
+        help="Seconds to wait before retrying a task that ran out of memory or failed on a node error, doubled with every attempt. [default =  %(default)s]")
+    group.add_argument("--distributionBlacklistAfter", dest="blacklist_after", type=int,
+        default=3,
+        help="Stop giving tasks to a node after this many tasks in a row ran out of memory or failed on node I/O errors. [default = %(default)s, 0 = never]")
+
+
+class RetryPolicy(object):
+    """ Decides which failed tasks are retried and when, and which nodes are blacklisted. """
+
+    def __init__(self, max_attempts=2, backoff=30, max_backoff=600, blacklist_after=3):
+        """
+        Input:
+            max_attempts     maximum number of attempts of a task.
+            backoff          seconds before the first retry after a backoff.
+            max_backoff      the longest backoff in seconds.
+            blacklist_after  number of failures in a row that blacklists a node (0 for never).
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.blacklist_after = blacklist_after
+        # Node -> number of failed tasks in a row
+        self.failures_in_a_row = {}
+
+
+    @classmethod
+    def create_from_parsed_args(cls, parsed_args):
+        return cls(max_attempts=parsed_args.max_attempts,
+                   backoff=parsed_args.retry_backoff,
+                   blacklist_after=parsed_args.blacklist_after)
+
+
+    def retry_delay(self, failure, attempts):
+        """ Returns the seconds to wait before retrying a task after attempts attempts, or None if it is not retried. """
+        if failure not in RETRIED_FAILURES or attempts >= self.max_attempts:
+            return None
+        if not RETRIED_FAILURES[failure]:
+            return 0
+        return min(self.backoff * 2**(attempts-1), self.max_backoff)
+
+
+    def task_failed(self, node, failure):
+        """ Records a failed task on a node, returns True if the node became blacklisted. """
+        if failure not in NODE_FAILURES:
+            return False
+        self.failures_in_a_row[node] = self.failures_in_a_row.get(node, 0) + 1
+        return self.failures_in_a_row[node] == self.blacklist_after
+
+
+    def task_succeeded(self, node):
+        self.failures_in_a_row[node] = 0
+
+
+    def is_blacklisted(self, node):
+        return bool(self.blacklist_after) and self.failures_in_a_row.get(node, 0) >= self.blacklist_after
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_RetryPolicy(unittest.TestCase):
+    def test_classify_failure(self):
+        class RemoteError(Exception):
+            def __init__(self, name, msg):
+                super(RemoteError, self).__init__(msg)
+                self.name = name
+        self.assertEqual(classify_failure(MemoryError()), OUT_OF_MEMORY)
+        self.assertEqual(classify_failure(Exception("pblat\n-9\n\n")), OUT_OF_MEMORY)
+        self.assertEqual(classify_failure(IOError(28, "No space left on device")), NODE_ERROR)
+        self.assertEqual(classify_failure(RemoteError("OSError", "[Errno 5] Input/output error")), NODE_ERROR)
+        self.assertEqual(classify_failure(ValueError("Unable to parse line")), TASK_ERROR)
+
+    def test_retry_delay(self):
+        policy = RetryPolicy(max_attempts=3, backoff=10, max_backoff=15)
+        self.assertEqual(policy.retry_delay(LOST_WORKER, 1), 0)
+        self.assertEqual(policy.retry_delay(OUT_OF_MEMORY, 1), 10)
+        self.assertEqual(policy.retry_delay(NODE_ERROR, 2), 15)
+        self.assertEqual(policy.retry_delay(NODE_ERROR, 3), None)
+        self.assertEqual(policy.retry_delay(TASK_ERROR, 1), None)
+
+    def test_blacklist(self):
+        policy = RetryPolicy(blacklist_after=2)
+        policy.task_failed("node1", NODE_ERROR)
+        policy.task_succeeded("node1")
+        self.assertFalse(policy.task_failed("node1", NODE_ERROR))
+        self.assertFalse(policy.task_failed("node1", LOST_WORKER))
+        self.assertFalse(policy.task_failed("node1", TASK_ERROR))
+        self.assertTrue(policy.task_failed("node1", OUT_OF_MEMORY))
+        self.assertTrue(policy.is_blacklisted("node1"))
+        self.assertFalse(policy.is_blacklisted("node2"))
+        self.assertFalse(RetryPolicy(blacklist_after=0).task_failed("node1", NODE_ERROR))
@@ -0,0 +1,157 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Resource slots of the workers in a RegisteringWorkerPool.
+
+Each task declares the CPUs and memory it needs, and each worker
+declares the CPUs and memory of its node. A worker runs several tasks
+concurrently as long as their requirements fit in what the running
+tasks leave free, so that a large node is not left idle while a single
+task runs with a few threads.
+"""
+from collections import namedtuple
+import unittest
+import gevent
+import gevent.event
+import psutil
+
+__all__ = ["Resources", "local_resources", "WorkerSlots"]
+
+# CPUs and memory (in bytes) of a worker or needed by a task
+Resources = namedtuple("Resources", ["cpus", "memory"])
+
+# Used for workers that cannot tell their resources: every task runs alone
+UNKNOWN_CAPACITY = Resources(1, 0)
+
+def local_resources():
+    """ Returns the Resources of this node: its CPUs and the memory currently available. """
+    return Resources(psutil.NUM_CPUS, psutil.virtual_memory().available)
+
+
+class WorkerSlots(object):
+    """
+    The CPUs and memory of a worker, shared by the tasks it runs.
+
+    Requirements larger than the worker are limited to its capacity, so
+    a task that needs more than the whole worker, or that declares no
+    requirements (None), runs alone.
+    """
+
+    def __init__(self, capacity, max_tasks=0):
+        """
+        Input:
+            capacity   Resources of the worker (None if unknown).
+            max_tasks  maximum number of tasks running at a time (0 for no limit).
+        """
+        self.capacity = Resources(*capacity) if capacity else UNKNOWN_CAPACITY
+        self.max_tasks = max_tasks
+        self.free = self.capacity
+        self.running = 0
+        self._released = gevent.event.Event()
+
+
+    def fit(self, requirements):
+        """ Returns the requirements of a task limited to the capacity of the worker. """
+        if requirements is None:
+            return self.capacity
+        return Resources(min(max(requirements.cpus, 1), self.capacity.cpus),
+                         min(max(requirements.memory, 0), self.capacity.memory))
+
+
+    def has_room(self):
+        """ Returns True if another task could start, i.e. a CPU is free and max_tasks is not reached. """
+        if self.max_tasks and self.running >= self.max_tasks:
+            return False
+        return self.free.cpus >= 1
+
+
+    def fits(self, requirements):
+        """ Returns True if a task with the (fitted) requirements can start now. """
+        return (self.has_room() and
+                requirements.cpus <= self.free.cpus and
+                requirements.memory <= self.free.memory)
+
+
+    def wait_for_room(self):
+        """ Waits until another task could start. """
+        self._wait_until(self.has_room)
+
+
+    def acquire(self, requirements):
+        """ Waits until a task fits and reserves its resources, returns the reserved Resources. """
+        reserved = self.fit(requirements)
+        self._wait_until(lambda: self.fits(reserved))
+        self.free = Resources(self.free.cpus - reserved.cpus, self.free.memory - reserved.memory)
+        self.running += 1
+        return reserved
+
+
+    def release(self, reserved):
+        """ Returns the resources reserved by a finished task. """
+        self.free = Resources(self.free.cpus + reserved.cpus, self.free.memory + reserved.memory)
+        self.running -= 1
+        self._released.set()
+
+
+    def _wait_until(self, condition):
+        while not condition():
+            self._released.clear()
+            self._released.wait()
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_WorkerSlots(unittest.TestCase):
+    def test_fit(self):
+        slots = WorkerSlots(Resources(8, 100))
+        self.assertEqual(slots.fit(Resources(4, 10)), Resources(4, 10))
+        self.assertEqual(slots.fit(Resources(16, 1000)), Resources(8, 100))
+        self.assertEqual(slots.fit(None), Resources(8, 100))
+
+    def test_concurrent_tasks(self):
+        slots = WorkerSlots(Resources(8, 100))
+        first = slots.acquire(Resources(4, 60))
+        self.assertTrue(slots.fits(slots.fit(Resources(4, 40))))
+        self.assertFalse(slots.fits(slots.fit(Resources(4, 50))))
+        second = slots.acquire(Resources(2, 40))
+        self.assertEqual(slots.free, Resources(2, 0))
+        slots.release(first)
+        slots.release(second)
+        self.assertEqual(slots.free, Resources(8, 100))
+        self.assertEqual(slots.running, 0)
+
+    def test_waits_for_release(self):
+        slots = WorkerSlots(Resources(4, 100))
+        first = slots.acquire(Resources(4, 10))
+        waiting = gevent.spawn(slots.acquire, Resources(2, 10))
+        gevent.sleep(0)
+        self.assertFalse(waiting.ready())
+        slots.release(first)
+        self.assertEqual(waiting.get(timeout=1), Resources(2, 10))
+
+    def test_max_tasks(self):
+        slots = WorkerSlots(Resources(8, 100), max_tasks=1)
+        slots.acquire(Resources(1, 1))
+        self.assertFalse(slots.has_room())
+
+    def test_unknown_capacity(self):
+        slots = WorkerSlots(None)
+        slots.acquire(Resources(4, 10))
+        self.assertFalse(slots.has_room())
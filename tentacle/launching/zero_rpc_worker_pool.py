@@ -24,6 +24,8 @@ from ..utils import ScopedObject
 from ..utils.zerorpc_utils import run_single_rpc, spawn_server
 from ..serialization.cloud_serializer import CloudSerializer
 from .registering_worker_pool import Worker, RegisteringWorkerPool, WorkerDisabledException
+from .worker_slots import Resources
+from .retry_policy import RetryPolicy, add_retry_arguments
 from .launchers import GeventLauncher, SubprocessLauncher
 
 def _debugPrint(msg): 
@@ -34,8 +36,9 @@ __all__ = []
 
 __all__.append("ZeroRpcWorkerPool")
 class ZeroRpcWorkerPool(RegisteringWorkerPool):
-    def __init__(self, logger, output_dir):
-        super(ZeroRpcWorkerPool, self).__init__(output_dir=output_dir)
+    def __init__(self, logger, output_dir, max_tasks_per_worker=0, retry_policy=None, keep_alive_interval=None):
+        super(ZeroRpcWorkerPool, self).__init__(output_dir=output_dir, max_tasks_per_worker=max_tasks_per_worker,
+                                                retry_policy=retry_policy, keep_alive_interval=keep_alive_interval)
         self._endpoints = None #Is needed since zerorpc invokes endpoints property for some reason when starting server
         s, self._endpoints = spawn_server(self)
         self.logger = logger
@@ -108,6 +111,24 @@ class ZeroRpcWorkerPool(RegisteringWorkerPool):
                 #_debugPrint("Error was {}".format(e))
                 raise WorkerDisabledException(e)
             return res
+
+        def resources(self):
+            """ Asks the worker for the Resources of its node, None if it cannot tell. """
+            try:
+                return Resources(*self._zerorpc_client.resources())
+            except (zerorpc.TimeoutExpired, zerorpc.LostRemote) as e:
+                self.logger.error("Lost worker at {} when asking for its resources: {}".format(self._worker_endpoints, e))
+                raise WorkerDisabledException(e)
+            except zerorpc.RemoteError as e:
+                self.logger.warning("Worker at {} cannot tell its resources, running one task at a time: {}".format(self._worker_endpoints, e))
+                return None
+
+        def keep_alive(self):
+            """ Keeps the worker from closing when idle, while it waits for retried tasks. """
+            try:
+                self._zerorpc_client.keep_alive()
+            except (zerorpc.TimeoutExpired, zerorpc.LostRemote) as e:
+                raise WorkerDisabledException(e)
         
         def close_client(self):
             try:
@@ -126,7 +147,7 @@ class ZeroRpcWorkerPoolWorker(Worker):
         self.start_worker_server()
         self._scope.on_exit(lambda: gevent.getcurrent().link(lambda _: self.stop_worker_server())) #Stop the server after the current call is done, so that the response is sent.
                 
-        self.is_running = False
+        self.running_tasks = 0
         self.has_run_since_last_check = True
         self.idle_closer = gevent.spawn(self.close_on_idle, idle_timeout)
         
@@ -146,9 +167,13 @@ class ZeroRpcWorkerPoolWorker(Worker):
         _debugPrint("close_ received, closing")
         self.close()
         
+    def keep_alive(self):
+        """ Counts as having run a task for the idle check, see close_on_idle. """
+        self.has_run_since_last_check = True
+
     def close_on_idle(self, idle_timeout):
-        while (self.is_running or self.has_run_since_last_check) and (not self.closed.is_set()):
-            _debugPrint("Checking idle status. Is running:" + str(self.is_running) + ". Has run since last check:" + str(self.has_run_since_last_check) + ".")
+        while (self.running_tasks or self.has_run_since_last_check) and (not self.closed.is_set()):
+            _debugPrint("Checking idle status. Running tasks:" + str(self.running_tasks) + ". Has run since last check:" + str(self.has_run_since_last_check) + ".")
             self.has_run_since_last_check = False
             self.closed.wait(timeout=idle_timeout)
             
@@ -163,12 +188,13 @@ class ZeroRpcWorkerPoolWorker(Worker):
     def run_serialized(self, serialized_task):
         _debugPrint("ZeroRpcWorkerPoolWorker: run_serialized called")
         task = CloudSerializer().deserialize_from_string(serialized_task)
-        self.is_running = True
+        # Several tasks may run concurrently, each in its own greenlet
+        self.running_tasks += 1
         try:
             return self.run(task)
         finally:
             self.has_run_since_last_check = True
-            self.is_running = False
+            self.running_tasks -= 1
     
     @staticmethod
     def create_worker_runner(pool_endpoints, idle_timeout):
@@ -199,6 +225,10 @@ class ZeroRpcDistributedWorkerPoolFactory(object):
         group.add_argument("--distributedNodeIdleTimeout", 
             default = 10, type=int, 
             help="The duration (in seconds) after which an idle node should timeout. [default =  %(default)s]")
+        group.add_argument("--distributionMaxTasksPerNode", dest="max_tasks_per_worker", type=int,
+            default=0,
+            help="The maximum number of tasks run concurrently on a node, within its CPUs and memory. [default = no limit]")
+        add_retry_arguments(group)
         parser.add_argument_group(group)
         return parser
     
@@ -209,6 +239,8 @@ class ZeroRpcDistributedWorkerPoolFactory(object):
                            worker_count=parsed_args.node_count, 
                            use_dedicated_coordinator=parsed_args.use_dedicated_coordinator, 
                            idle_timeout=parsed_args.distributedNodeIdleTimeout,
+                           max_tasks_per_worker=parsed_args.max_tasks_per_worker,
+                           retry_policy=RetryPolicy.create_from_parsed_args(parsed_args),
                            remote_launcher=remote_launcher, 
                            local_launcher=local_launcher)
     
@@ -220,11 +252,15 @@ class ZeroRpcDistributedWorkerPoolFactory(object):
                worker_count, 
                use_dedicated_coordinator, 
                idle_timeout, 
-               local_launcher=GeventLauncher()):
+               local_launcher=GeventLauncher(),
+               max_tasks_per_worker=0,
+               retry_policy=None):
 
         #Create the pool
         logger.debug("Creating ZeroRpcWorkerPool.")
-        pool = ZeroRpcWorkerPool(logger=logger, output_dir=output_dir)
+        # Workers close when idle for idle_timeout, so they are kept alive while retries wait for their backoff
+        pool = ZeroRpcWorkerPool(logger=logger, output_dir=output_dir, max_tasks_per_worker=max_tasks_per_worker,
+                                 retry_policy=retry_policy, keep_alive_interval=idle_timeout / 2.0)
         try:
             #Launch the workers
             if worker_count==0:
@@ -19,13 +19,14 @@
 # 
 
 from subprocess import PIPE#, Popen
+from pipes import quote
 from gevent.subprocess import Popen
 from mapper import Mapper
 import psutil
 
 from ..utils import resolve_executable
-from ..utils import mapping_utils
 from ..parsers import sam
+from ..parsers import bam
 
 __all__ = ["Bowtie2"]
 
@@ -33,6 +34,8 @@ class Bowtie2(Mapper):
     """
     Bowtie2
     """
+    threads_option = "bowtie2Threads"
+
     def __init__(self, logger, mapper_name):
         self.logger = logger
         self.mapper_string = mapper_name
@@ -59,6 +62,9 @@ class Bowtie2(Mapper):
             help="bowtie2: Name of the FASTA file in the database tarball (including extension). It must share basename with the rest of the DB.")
         mapping_group.add_argument("--bowtie2Other", type=str, default="",
             help="bowtie2: additional command line options for bowtie2 [default: not used]")
+        mapping_group.add_argument("--bowtie2Bam", dest="bowtie2Bam",
+            default=False, action="store_true",
+            help="bowtie2: pipe the SAM output through 'samtools view' and parse the mapping results as BAM, which is much smaller on disk [default %(default)s].")
         
         return parser
     
@@ -67,7 +73,7 @@ class Bowtie2(Mapper):
         """
         Transfers and prepares reference DB for Bowtie2.
         """
-        mapping_utils.copy_untar_ref_db(remote_files.contigs, local_files.contigs, self.logger)
+        self.prepare_reference_db(remote_files.contigs, local_files.contigs, options)
         return local_files._replace(contigs=rebase_to_local_tmp(options.bowtie2DBName))
 
 
@@ -90,7 +96,26 @@ class Bowtie2(Mapper):
             for token in otherOptions:
                 mapper_call.append(token)
 
+        if options.bowtie2Bam:
+            mapper_call, output_filename = self.pipe_through_samtools(mapper_call, output_filename)
+            self.output_parser = bam.parse_bam
+
         return mapper_call, output_filename
+
+
+    def pipe_through_samtools(self, mapper_call, output_filename):
+        """
+        Changes a bowtie2 call to write SAM to stdout and converts it to BAM
+        with samtools on the fly. Runs through bash with pipefail so that
+        a failure in either program gives a nonzero return code.
+        """
+        sam_index = mapper_call.index("-S")
+        bowtie2_call = mapper_call[:sam_index] + mapper_call[sam_index+2:]
+        output_filename = output_filename+".bam"
+        samtools_call = [resolve_executable("samtools"), "view", "-b", "-S", "-o", output_filename, "-"]
+        pipeline = " | ".join([" ".join(quote(token) for token in bowtie2_call),
+                               " ".join(quote(token) for token in samtools_call)])
+        return [resolve_executable("bash"), "-o", "pipefail", "-c", pipeline], output_filename
     
 
     def assert_mapping_results(self, output_filename):
@@ -24,7 +24,6 @@ from mapper import Mapper
 import psutil
 
 from ..utils import resolve_executable
-from ..utils import mapping_utils
 from ..parsers import gem
 
 __all__ = ["Gem"]
@@ -33,6 +32,8 @@ class Gem(Mapper):
     """
     GEM
     """
+    threads_option = "gemThreads"
+
     def __init__(self, logger, mapper_name):
         self.logger = logger
         self.mapper_string = mapper_name
@@ -82,9 +83,7 @@ class Gem(Mapper):
         """
         Transfers and prepares reference DB for GEM.
         """
-        mapping_utils.copy_untar_ref_db(remote_files.contigs, 
-                                        local_files.contigs, 
-                                        self.logger)
+        self.prepare_reference_db(remote_files.contigs, local_files.contigs, options)
         return local_files._replace(contigs=rebase_to_local_tmp(options.gemDBName))
 
 
@@ -38,6 +38,10 @@ import os
 
 from ..utils import resolve_executable
 from ..utils import mapping_utils
+from ..utils import read_qc
+from ..utils.mapping_stream import MappingStream
+from ..utils import mapping_parts
+from ..utils.reference_cache import ReferenceCache
 from ..parsers import blast8 # EXAMPLE OUTPUT PARSER
 
 __all__ = ["Mapper"]
@@ -54,6 +58,18 @@ class Mapper(object):
        This class must be subclassed and customized to produce a functional mapping module.
     """
 
+    # Set by run_mapper when the mapper output is streamed through a FIFO.
+    mapping_stream = None
+    # Set by run_mapper when the reads are mapped in parts (--mapperProcesses).
+    mapping_parts = None
+    # Reference DBs from the node-local reference DB cache in use by the task.
+    cached_references = ()
+    # Set by prepare_reads to the time spent per chunk of reads in quality control.
+    read_preparation_report = ""
+    # Name (dest) of the option with the number of threads of the mapper,
+    # None if the number of threads is unknown (tasks then use the whole node).
+    threads_option = None
+
     def __init__(self, logger, mapper):
         """Initalizes a mapper object.
 
@@ -142,6 +158,53 @@ class Mapper(object):
 
 ############## NORMALLY THE FOLLOWING METHODS DO NOT NEED MODIFICATION
 
+    def prepare_reference_db(self, source_file, destination, options):
+        """Copies and extracts a reference DB tarball into the directory of destination.
+
+        Calls :func:`tentacle.mapping_utils.copy_untar_ref_db`. With
+        --referenceDBCache the DB is instead extracted once per node into
+        the reference DB cache, and the extracted files are linked into
+        the directory of destination. The cached DB is in use by the task
+        until :func:`release_references` is called.
+
+        Args:
+            source_file (str): Reference DB file (tarball) to transfer.
+
+            destination (str): Node-local filename of the reference DB file.
+
+            options (Namespace): Parsed arguments from the Tentacle command line.
+
+        Returns:
+            destination (str): Node-local filename of the reference DB file.
+        """
+        if not options.referenceDBCache:
+            return mapping_utils.copy_untar_ref_db(source_file, destination, self.logger)
+
+        def extract(source_file, directory):
+            archive = os.path.join(directory, os.path.basename(destination))
+            mapping_utils.copy_untar_ref_db(source_file, archive, self.logger)
+            if archive.lower().endswith((".tar.gz", ".tar", ".tgz")):
+                # Only the extracted files are needed in the cache
+                os.remove(archive)
+
+        cache = ReferenceCache(options.referenceDBCache, options.referenceDBCacheQuota << 30, self.logger)
+        reference = cache.acquire(source_file, extract)
+        self.cached_references += (reference,)
+        reference.link_into(os.path.dirname(destination))
+        return destination
+
+
+    def release_references(self):
+        """Releases the reference DBs used from the node-local reference DB cache.
+
+        Called when the task has finished, after the coverage analysis
+        that reads the (linked) local contigs. Safe to call more than once.
+        """
+        for reference in self.cached_references:
+            reference.release()
+        self.cached_references = ()
+
+
     def prepare_references(self, remote_files, local_files, options, rebase_to_local_tmp=None):
         """Transfers and prepares reference DB for the mapper.
 
@@ -174,8 +237,10 @@ class Mapper(object):
         """Transfer and prepare reads.
 
         Contains all logic for preparing reads, including; determining format (FASTA/FASTQ),
-        detects compression (gzip), performs quality filtering (FASTX), and FASTQ-to-FASTA
-        conversion (seqtk).
+        detects compression (gzip), performs quality filtering, and FASTQ-to-FASTA
+        conversion. Quality filtering and conversion run in a single pass in-process
+        (see tentacle.utils.read_qc), or with the FASTX-Toolkit and seqtk if
+        additional FASTX options are given (--fqFilterOther, --fqTrimOther).
 
         Args:
             remote_files (namedtuple): Contains fields; 'contigs', 'reads', 'annotations'.
@@ -191,6 +256,10 @@ class Mapper(object):
             PipelineError: If any part of the quality control/conversion pipeline
                 malfunctions.
 
+            ReadSourceError: If the reads file cannot be decompressed.
+
+            FastqFormatError: If FASTQ reads are not in four-line format.
+
         .. note::
 
            This method normally does NOT require modification.
@@ -218,23 +287,29 @@ class Mapper(object):
 
         self.logger.info("Preparing %s for mapping.", reads)
 
-        # Uncompress reads into Popen PIPE object
-        uncompressed_reads = mapping_utils.uncompress_into_Popen(reads, self.logger)
+        # Open reads, decompressing them in-process
+        read_source = mapping_utils.open_reads(reads, options.readsThreads, self.logger)
 
-        # Determine reads format (FASTA or FASTQ) and return new source stream
-        read_source, fastq_format = mapping_utils.determine_format(uncompressed_reads, self.logger)
+        # Determine reads format (FASTA or FASTQ) from the first byte
+        read_source, fastq_format = mapping_utils.determine_format(read_source, self.logger)
 
         # Perform filtering and trimming if FASTQ,
-        # otherwise just write to disk
+        # otherwise just write to disk.
+        # Quality control runs in-process unless additional options
+        # for the FASTX-Toolkit programs are given.
         program_filter = "fastq_quality_filter"
         program_trim = "fastq_quality_trimmer"
         program_convert = "seqtk"
-        if fastq_format and options.qualityControl:
+        use_fastx = options.fastqFilterOther or options.fastqTrimOther
+        qc_statistics = None
+        if fastq_format and options.qualityControl and use_fastx:
             self.logger.info("Performing quality control on reads...")
             self.logger.info("Filtering reads using {}...".format(program_filter))
             filter_args = {"-q": options.fastqMinQ,
                            "-p": options.fastqProportion,
                            "-v": ""}
+            if options.fastqQualityOffset != 64:
+                filter_args["-Q"] = options.fastqQualityOffset
             if options.fastqFilterOther:
                 for key, value in options.fastqFilterOther.split():
                     filter_args[key] = value
@@ -247,6 +322,8 @@ class Mapper(object):
             trimming_args = {"-t":options.fastqThreshold,
                              "-l":options.fastqMinLength,
                              "-v":""}
+            if options.fastqQualityOffset != 64:
+                trimming_args["-Q"] = options.fastqQualityOffset
             if options.fastqTrimOther:
                 for key, value in options.fastqTrimOther:
                     trimming_args[key] = value
@@ -267,48 +344,50 @@ class Mapper(object):
                 pipeline_components.append((fasta_reads, program_convert))
                 # Some mappers require a .fasta file ending so we append that just in case
                 destination = destination+".fasta"
-                written_reads = mapping_utils.write_reads(fasta_reads, destination, self.logger)
+                mapping_utils.write_reads(fasta_reads, destination, self.logger)
             else:
-                written_reads = mapping_utils.write_reads(trimmed_reads, destination, self.logger)
-            pipeline_components.append((written_reads, "cat"))
-        elif fastq_format and not options.qualityControl:
-            if self.input_reads_format == "FASTA":
+                mapping_utils.write_reads(trimmed_reads, destination, self.logger)
+        elif fastq_format and (options.qualityControl or self.input_reads_format == "FASTA"):
+            convert = self.input_reads_format == "FASTA"
+            if options.qualityControl:
+                self.logger.info("Performing quality control on reads...")
+            if convert:
                 self.logger.info("Converting FASTQ to FASTA...")
-                arguments = OrderedDict([("seq", ""), ("-A", ""), ("-", "")])
-                fasta_reads = mapping_utils.filtered_call(self.logger,
-                                     source=read_source,
-                                     program=program_convert,
-                                     arguments=arguments)
-                pipeline_components.append((fasta_reads, program_convert))
-                # Some mappers require a .fasta file ending so we append that
+                # Some mappers require a .fasta file ending so we append that just in case
                 destination = destination+".fasta"
-                written_reads = mapping_utils.write_reads(fasta_reads, destination, self.logger)
-            else:
-                written_reads = mapping_utils.write_reads(read_source, destination, self.logger)
-            pipeline_components.append((written_reads, "cat"))
+            settings = read_qc.qc_settings(options, convert)
+            qc_statistics = read_qc.prepare_fastq(read_source, destination, settings, self.logger,
+                                                  options.readsProcesses)
+            self.read_preparation_report = qc_statistics.timing_report()
         else:
             if not options.qualityControl:
                 self.logger.info("Skipping quality control and writing reads unmodified to local storage...")
             else:
                 self.logger.info("Writing reads to local storage...")
-            written_reads = mapping_utils.write_reads(read_source, destination, self.logger)
-            pipeline_components.append((written_reads, "cat"))
+            mapping_utils.write_reads(read_source, destination, self.logger)
 
-        # Calling .communicate() on the Popen object runs 
-        # the entire pipeline that has been pending
-        written_reads.communicate() 
+        # The reads have been written when the pipeline output ends,
+        # wait for the programs to exit and for the reads to have been
+        # fed into the pipeline.
+        for component, program_name in pipeline_components:
+            component.wait()
         for component in pipeline_components:
             check_return_code(component)
+        read_source.wait()
         self.logger.info("Read transfer completed.")
         if fastq_format and options.qualityControl:
             self.logger.info("Read quality control and FASTA conversion completed.")
-            self.logger.info("Filtering statistics:\n%s", filtered_reads.stderr.read())
-            self.logger.info("Trimming statistics:\n%s", trimmed_reads.stderr.read())
+            if qc_statistics is None:
+                self.logger.info("Filtering statistics:\n%s", filtered_reads.stderr.read())
+                self.logger.info("Trimming statistics:\n%s", trimmed_reads.stderr.read())
+            else:
+                self.logger.info("Filtering statistics:\n%s", qc_statistics.filter_report(options))
+                self.logger.info("Trimming statistics:\n%s", qc_statistics.trim_report(options))
 
         if options.bowtie2FilterReads:
             # Transfer genome index for bowtie2 and perform read filtering
             db_destination = os.path.dirname(destination)+"/"+os.path.basename(options.bowtie2FilterDB)
-            mapping_utils.copy_untar_ref_db(options.bowtie2FilterDB, db_destination, self.logger)
+            self.prepare_reference_db(options.bowtie2FilterDB, db_destination, options)
             filtered_reads = mapping_utils.filter_human_reads_bowtie2(destination, options, self.logger)
             self.logger.info("Finished preparing %s for mapping.", reads)
             return local_files._replace(reads=filtered_reads)
@@ -318,7 +397,7 @@ class Mapper(object):
 
 
 
-    def run_mapper(self, local_files, options):
+    def run_mapper(self, local_files, options, results_copy_dir=None):
         """Runs mapper.
 
         Args:
@@ -328,8 +407,16 @@ class Mapper(object):
 
             all arguments parsed from the command line (incl. non-mapper-related).
 
+        Kwargs:
+            results_copy_dir (str): Only used with --streamMappingResults. If given,
+                a gzipped copy of the streamed mapping results is written to this directory.
+
         Returns:
-            output_filename (str): Filename of mapping results.
+            output_filename (str): Filename of mapping results. With 
+                --streamMappingResults this is a FIFO that must be consumed
+                before calling :func:`wait_for_mapper`. With --mapperProcesses
+                this is a list of the filenames of the mapping results of each
+                part of the reads, see :func:`run_mapper_parts`.
 
         Raises:
             MapperError: If the mapper does not return with returncode 0.
@@ -339,11 +426,21 @@ class Mapper(object):
            This method normally does NOT require modification.
         """
 
+        if options.mapperProcesses > 1 and not options.streamMappingResults:
+            return self.run_mapper_parts(local_files, options)
+
         mapper_call, output_filename = self.construct_mapper_call(local_files, options)
 
         self.logger.info("Running {0}...".format(self.mapper))
         self.logger.debug("Mapper call: {0}".format(' '.join(mapper_call)))
         stdout.flush() # Force printout so users knows what's going on
+        if options.streamMappingResults:
+            copy_filename = None
+            if results_copy_dir:
+                copy_filename = os.path.join(results_copy_dir, os.path.basename(output_filename)+".gz")
+            self.mapping_stream = MappingStream(mapper_call, output_filename, self.logger, copy_filename)
+            return self.mapping_stream.filename
+
         # Run the command in the result dir and give filenames relative to that.
         result_base_dir = os.path.dirname(output_filename)
         mapper_process = Popen(mapper_call, stdout=PIPE, stderr=PIPE, cwd=result_base_dir)
@@ -365,7 +462,116 @@ class Mapper(object):
         return output_filename
 
 
+    def run_mapper_parts(self, local_files, options):
+        """Starts mapping the reads in parts, with one mapper process per part.
+
+        The reads are split into --mapperProcesses parts at record boundaries.
+        The number of mappers running at the same time is limited by the number
+        of CPUs and by the available memory, given the memory use of one mapper
+        (--mapperProcessMemory, or estimated by :func:`estimate_mapper_memory`).
+        The mapping results of each part are available from
+        :func:`iter_mapped_parts` as soon as its mapper has finished.
+
+        Args:
+            local_files (namedtuple): Contains fields; 'contigs', 'reads', 'annotations'.
+
+            options (Namespace): Parsed arguments from the Tentacle command line.
+
+        Returns:
+            output_filenames (list): Filenames of the mapping results of each part.
+        """
+        parts = mapping_parts.split_reads(local_files.reads, options.mapperProcesses, self.logger)
+        mapper_calls = [self.construct_mapper_call(local_files._replace(reads=part), options) for part in parts]
+        memory = options.mapperProcessMemory << 30
+        if not memory:
+            memory = self.estimate_mapper_memory(local_files)
+        concurrency = mapping_parts.process_limit(len(parts), memory, self.logger)
+        self.logger.info("Running {0} on {1} parts of the reads, {2} at a time...".format(self.mapper, len(parts), concurrency))
+        stdout.flush() # Force printout so users knows what's going on
+        self.mapping_parts = mapping_parts.MappingParts(mapper_calls, concurrency, self.logger)
+        return [output_filename for _, output_filename in mapper_calls]
+
+
+    def estimate_mapper_memory(self, local_files):
+        """Estimates the memory use of one mapper process, in bytes.
 
+        The estimate is the total size of the reference (DB) files, i.e. the
+        node-local files whose names start with the name of the local contigs
+        file or DB. Mappers that need more or less memory than the size of
+        their reference can override this method.
+        """
+        directory, prefix = os.path.split(local_files.contigs)
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(prefix)]
+        return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+    @classmethod
+    def threads(cls, options):
+        """Returns the number of threads used by one mapper process.
+
+        Read from the option named by threads_option. None for mappers
+        without a threads option, which may use all CPUs of the node
+        (e.g. usearch).
+        """
+        if cls.threads_option is None:
+            return None
+        return getattr(options, cls.threads_option, None)
+
+
+    def iter_mapped_parts(self):
+        """Yields the mapping results filename of each part as its mapper finishes.
+
+        Used with --mapperProcesses, see :func:`run_mapper_parts`. The
+        remaining mappers are stopped if the caller stops early.
+
+        Raises:
+            MapperError: If a mapper does not return with returncode 0.
+        """
+        try:
+            for part, (output_filename, returncode, mapper_stdout, mapper_stderr) in enumerate(self.mapping_parts.completed()):
+                if returncode != 0:
+                    self.logger.error("{0}: return code {1} for {2}".format(self.mapper, returncode, output_filename))
+                    self.logger.error("{0}: stdout: {1}".format(self.mapper, mapper_stdout))
+                    self.logger.error("{0}: stderr: {1}".format(self.mapper, mapper_stderr))
+                    raise MapperError("\n".join([self.mapper, str(returncode), mapper_stdout, mapper_stderr]))
+                self.assert_mapping_results(output_filename)
+                self.logger.debug("{0}: stdout: {1}".format(self.mapper, mapper_stdout))
+                self.logger.debug("{0}: stderr: {1}".format(self.mapper, mapper_stderr))
+                self.logger.info("Mapped part {0} of {1} of the reads.".format(part+1, self.mapping_parts.parts))
+                yield output_filename
+        finally:
+            self.mapping_parts.terminate()
+
+
+    def wait_for_mapper(self):
+        """Waits for a streaming mapper to finish.
+
+        Must be called after the output from :func:`run_mapper` has been
+        consumed when running with --streamMappingResults or --mapperProcesses,
+        does nothing otherwise.
+
+        Raises:
+            MapperError: If the mapper does not return with returncode 0.
+        """
+        if self.mapping_parts is not None:
+            try:
+                self.mapping_parts.terminate()
+            finally:
+                self.mapping_parts = None
+            return
+        if self.mapping_stream is None:
+            return
+        try:
+            returncode, mapper_stdout, mapper_stderr = self.mapping_stream.wait()
+        finally:
+            self.mapping_stream = None
+        if returncode != 0:
+            self.logger.error("{0}: return code {1}".format(self.mapper, returncode))
+            self.logger.error("{0}: stdout: {1}".format(self.mapper, mapper_stdout))
+            self.logger.error("{0}: stderr: {1}".format(self.mapper, mapper_stderr))
+            raise MapperError("\n".join([self.mapper, str(returncode), mapper_stdout, mapper_stderr]))
+        self.logger.debug("{0}: stdout: {1}".format(self.mapper, mapper_stdout))
+        self.logger.debug("{0}: stderr: {1}".format(self.mapper, mapper_stderr))
 
 
 
@@ -34,6 +34,8 @@ class Pblat(Mapper):
     """
     Pblat
     """
+    threads_option = "pblatThreads"
+
     def __init__(self, logger, mapper="pblat"):
         self.logger = logger
         self.mapper_string = mapper
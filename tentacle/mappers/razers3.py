@@ -33,6 +33,8 @@ class Razers3(Mapper):
     """
     RazerS3
     """
+    threads_option = "razers3Threads"
+
     def __init__(self, logger, mapper="razers3"):
         self.logger = logger
         self.mapper_string = mapper
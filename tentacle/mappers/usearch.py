@@ -23,7 +23,6 @@ from gevent.subprocess import Popen
 from mapper import Mapper
 
 from ..utils import resolve_executable
-from ..utils import mapping_utils
 from ..parsers import blast8
 
 __all__ = ["Usearch"]
@@ -73,7 +72,7 @@ class Usearch(Mapper):
         """
         Transfers and prepares reference DB for usearch.
         """
-        mapping_utils.copy_untar_ref_db(remote_files.contigs, local_files.contigs, self.logger)
+        self.prepare_reference_db(remote_files.contigs, local_files.contigs, options)
         return local_files._replace(contigs=rebase_to_local_tmp(options.usearchDBName))
 
 
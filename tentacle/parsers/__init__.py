@@ -4,5 +4,5 @@
 .. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
 
 """
-from initialize_contig_data import initialize_contig_data
+from initialize_contig_data import initialize_contig_data, estimate_coverage_bytes
 from parse_mapping_output import parse_mapping_output
@@ -0,0 +1,183 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Tentacle parsers
+
+author:: Fredrik Boulund
+"""
+
+from array import array
+import struct
+import numpy as np
+from ..coverage import create_alignment_sink
+from ..utils import bgzf, hot_path_logger
+
+# refID, pos, l_read_name, mapq, bin, n_cigar_op (the first fields after block_size)
+RECORD_HEADER = struct.Struct("<iiBBHH")
+# block_size plus the fixed-size fields of an alignment record
+RECORD_FIXED_SIZE = 36
+# BAM CIGAR operator codes for M, D, = and X, i.e. the same operators
+# as counted towards the aligned length by the SAM parser.
+REFERENCE_OPERATORS = frozenset([0, 2, 7, 8])
+CIGAR_CACHE_SIZE = 4096
+_cigar_cache = {}
+
+def bam_cigar_reference_length(cigar):
+    """
+    Returns the number of reference positions covered by an alignment
+    given its BAM-encoded CIGAR (a string of little endian uint32).
+
+    Results are memoized on the encoded CIGAR.
+    """
+    try:
+        return _cigar_cache[cigar]
+    except KeyError:
+        pass
+    operations = struct.unpack("<{}I".format(len(cigar)//4), cigar)
+    length = sum(operation >> 4 for operation in operations if operation & 0xf in REFERENCE_OPERATORS)
+    if len(_cigar_cache) >= CIGAR_CACHE_SIZE:
+        _cigar_cache.clear()
+    _cigar_cache[cigar] = length
+    return length
+
+
+class BamBuffer(object):
+    """ Decompressed BAM data with a read position, refilled from a BGZF reader. """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.data = ""
+        self.position = 0
+
+    def ensure(self, size):
+        """ Makes sure that size bytes are available from position. Returns False at end of file. """
+        while len(self.data) - self.position < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.data = self.data[self.position:] + chunk
+            self.position = 0
+        return True
+
+    def read(self, size):
+        if not self.ensure(size):
+            raise ParseError("Unexpected end of BAM file")
+        value = self.data[self.position:self.position+size]
+        self.position += size
+        return value
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+
+def read_bam_header(bam, mappings):
+    """ Reads the BAM header and returns the list of reference names. """
+    if bam.read(4) != "BAM\1":
+        raise ParseError("Mapping results file {} is not in BAM format".format(mappings))
+    l_text, = bam.unpack("<i")
+    bam.read(l_text)
+    n_ref, = bam.unpack("<i")
+    references = []
+    for _ in xrange(n_ref):
+        l_name, = bam.unpack("<i")
+        references.append(bam.read(l_name).rstrip("\0"))
+        bam.unpack("<i") # l_ref
+    return references
+
+
+def parse_bam(mappings, contig_data, options, logger):
+    """
+    Parses BAM alignments.
+
+    Decompresses the BGZF blocks on a thread pool and decodes the
+    alignment records of each decompressed chunk into integer arrays of
+    contig id, start and end position that are passed on to the
+    alignment sink in one call per chunk.
+
+    Uses the same rules as parse_sam: every record with a reference
+    (refID != -1) is added, with the end position derived from the CIGAR.
+    """
+    alignments = create_alignment_sink(contig_data, options, logger)
+    bam = BamBuffer(bgzf.iter_decompressed(mappings, options.bamThreads))
+    references = read_bam_header(bam, mappings)
+    try:
+        contig_ids = [contig_data.ids[reference] for reference in references]
+    except KeyError, e:
+        logger.error("BAM reference {} not found among the contigs".format(e))
+        raise ParseError("BAM reference {} in {} not found among the contigs".format(e, mappings))
+    logger.debug("Read BAM header with {} references from {}".format(len(references), mappings))
+
+    hot_logger = hot_path_logger(logger, options)
+    unpack_record = RECORD_HEADER.unpack_from
+    while True:
+        # Decode all complete records in the current chunk
+        data = bam.data
+        position = bam.position
+        end = len(data)
+        contigs = array("l")
+        rstarts = array("l")
+        rends = array("l")
+        while position + 4 <= end:
+            block_size, = struct.unpack_from("<i", data, position)
+            if position + 4 + block_size > end:
+                break
+            refid, pos, l_read_name, mapq, bin_, n_cigar_op = unpack_record(data, position+4)
+            if refid >= 0:
+                cigar_start = position + RECORD_FIXED_SIZE + l_read_name
+                length = bam_cigar_reference_length(data[cigar_start:cigar_start+4*n_cigar_op])
+                contigs.append(contig_ids[refid])
+                rstarts.append(pos)
+                rends.append(pos + length)
+            position += 4 + block_size
+        bam.position = position
+        for record in hot_logger.sample(len(contigs)):
+            hot_logger.logger.debug("Read mapped to %s:%d-%d", contig_data.names[contigs[record]], rstarts[record], rends[record])
+        if contigs:
+            alignments.add_many(np.frombuffer(contigs, dtype=contigs.typecode),
+                                np.frombuffer(rstarts, dtype=rstarts.typecode),
+                                np.frombuffer(rends, dtype=rends.typecode))
+
+        # Pull in the next chunk, the remaining bytes are an incomplete record
+        remaining = end - position
+        if remaining < 4:
+            needed = 4
+        else:
+            needed = 4 + struct.unpack_from("<i", data, position)[0]
+        if not bam.ensure(needed):
+            if remaining:
+                raise ParseError("Truncated alignment record in BAM file {}".format(mappings))
+            break
+
+    return alignments.close()
+
+
+
+###############################################
+#    Exceptions
+###############################################
+
+class Error(Exception):
+    """ Base class for exceptions in this module.
+
+    Attributes:
+        msg     error message
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+class ParseError(Error):
+    """ Raised for parsing errors. """
@@ -18,93 +18,232 @@
 
 author:: Fredrik Boulund
 date:: 2014-04-30
-"""
 
+The blast8 output is parsed in chunks of lines that are split into
+columns with NumPy. Best hits are selected per read name with a sort of
+all hits, so the hits of a read do not have to be on consecutive lines.
+"""
+from itertools import islice
+import argparse
+import logging
+import unittest
+import warnings
 import numpy as np
-from ..coverage import update_contig_data
+from ..coverage import create_alignment_sink, AlignmentCollector
+from ..utils import hot_path_logger
+
+# Lines parsed at a time
+CHUNK_LINES = 1 << 18
+BLAST8_COLUMNS = 12
 
 def parse_blast8(mappings, contig_data, options, logger):
     """ Parses mapped data in blast8 format (e.g. for usearch, pblat, blast).  """
-    #DEBUG
-    #np.set_printoptions(threshold='nan') 
-
-    def check_new_read(contig_data, read, identity, aligned_length, contig, sstart, send, previous_read, previous_information):
-        """ Determines if the most recently parsed read has been seen before """
-        # We cannot assume the output is ordered so 
-        # check if readname has already been seen and 
-        # determine if the new hit is better before 
-        # committing to contig_data.
-        if read in previous_readname:
-            logger.debug("Read {} seen before".format(read))
-            if identity > previous_information[0]:
-                logger.debug("Read {}          with stats {}, {}, {}, {}, {},  is better than previous".format(read, identity, mismatches, contig, sstart, send))
-                logger.debug("Read {} with stats {}, {}, {}, {}, {}".format(previous_readname, previous_information[0], previous_information[1], previous_information[2], previous_information[3], previous_information[4]))
-                previous_information = (identity, aligned_length, contig, sstart, send)
-            elif identity == previous_information[0]:
-                if aligned_length > previous_information[1]:
-                    logger.debug("Read {}          with stats {}, {}, {}, {}, {},  is better than previous".format(read, identity, mismatches, contig, sstart, send))
-                    logger.debug("Read {} with stats {}, {}, {}, {}, {}".format(previous_readname, previous_information[0], previous_information[1], previous_information[2], previous_information[3], previous_information[4]))
-                    previous_information = (identity, aligned_length, contig, sstart, send)
-        else:
-            logger.debug("Read {} NOT seen before".format(read))
-            if previous_information:
-                logger.debug("Read {} with stats {}, {}, {}, {}, {}, was best hit, committing to contig_data".format(
-                                previous_readname, previous_information[0], previous_information[1], previous_information[2], previous_information[3], previous_information[4]))
-                _, _, contig, sstart, send = previous_information
-                contig_data = update_contig_data(contig_data, contig, sstart-1, send, options, logger)
-            previous_readname.clear()
-            previous_readname.add(read)
-            previous_information = (identity, aligned_length, contig, sstart, send)
-        return (contig_data, previous_readname, previous_information)
+    alignments = create_alignment_sink(contig_data, options, logger)
+    with open(mappings) as f:
+        parse_blast8_lines(f, alignments, mappings, options, logger)
+    return alignments.close()
 
 
-    with open(mappings) as f:
-        previous_readname = set()
-        previous_information = ()
-        for line in f:
-            # Read name, Contig name, percent identity, alignment length, mismatches, 
-            # gap openings, query start, query end, subject start, subject end, 
-            # e-value, bit score
-            # Positions in pblat output are indexed from start (1-indexed)
-            # to end (inclusive) so a 75bp read with complete matching
-            # could possible have a starting position of 1 and end at 75.
-            try:
-                (read, contig, identity, length, mismatches, gaps,            #pylint: disable=W0612
-                 qstart, qend, sstart, send, evalue, bitscore) = line.split('\t') #pylint: disable=W0612
-            except ValueError, e:
-                logger.error("Unable to parse results file %s\n%s", mappings, e)
-                logger.error("The line that couldn't be parsed was this:\n%s", line)
-                raise ParseError("Cannot parse line\n{}\n in file {}".format(line, mappings))
-            
-            identity = float(identity)
-            qend = int(qend)
-            qstart = int(qstart)
-            aligned_length = abs(qend-qstart)
-            sstart = int(sstart)
-            send = int(send)
-
-            # Some mappers output reverse coordinates if mapped in the other direction,
-            # Reverse them so we do not get negative counts in the coverage      
-            if sstart > send:
-                sstart, send = (send, sstart)
-
-            logger.debug("Read: {}".format(read))
-            read = read.split()[0]
-            logger.debug("Formatted to: {}".format(read))
-
-            if options.coverageAllAlignments:
-                contig_data, previous_readname, previous_information = check_new_read(contig_data, read, identity, aligned_length, contig, sstart, send, previous_readname, previous_information)
-            else:
-                contig_data = update_contig_data(contig_data, contig, sstart-1, send, options, logger)
-
-
-        # Add the last read to contig_data
+def blast8_read_name(line):
+    """ Returns the read name of a blast8 line, as used to group hits of the same read. """
+    return line.split('\t', 1)[0].split()[0]
+
+
+def parse_blast8_lines(lines, alignments, mappings, options, logger):
+    """ Parses lines in blast8 format and adds the mapped reads to alignments.
+
+    With --coverageAllAlignments only the best hit of each read is added:
+    the hit with the highest identity and, among those, the longest
+    aligned query part (the first such hit in the file if tied). The
+    hits of a read may be anywhere in the lines.
+    """
+    if options.coverageAllAlignments:
+        add_hits(alignments, collect_blast8_best_hits(lines, mappings, options, logger))
+        return
+    for hits in iter_blast8_chunks(lines, mappings, options, logger):
+        add_hits(alignments, hits)
+
+
+def collect_blast8_best_hits(lines, mappings, options, logger):
+    """ Returns the best hit of each read in lines in blast8 format, see select_best_hits. """
+    selection = BestHitSelection()
+    for hits in iter_blast8_chunks(lines, mappings, options, logger):
+        selection.add(hits)
+    return selection.best_hits(mappings, logger)
+
+
+def add_blast8_best_hits(candidates, alignments, mappings, options, logger):
+    """
+    Adds the best hit of each read to alignments, selected among the
+    best hits of several parts of the lines (from collect_blast8_best_hits).
+    Ties between the parts go to the first part, so with the parts in
+    file order the selection is the same as for all lines at once.
+    """
+    selection = BestHitSelection()
+    for hits in candidates:
+        if hits is not None:
+            selection.add(hits)
+    add_hits(alignments, selection.best_hits(mappings, logger))
+
+
+def iter_blast8_chunks(lines, mappings, options, logger):
+    """ Yields the hits of chunks of CHUNK_LINES lines in blast8 format, see read_blast8_chunk. """
+    hot_logger = hot_path_logger(logger, options)
+    while True:
+        chunk = list(islice(lines, CHUNK_LINES))
+        if not chunk:
+            return
+        hits = read_blast8_chunk(chunk, mappings, logger, options.coverageAllAlignments)
+        for position in hot_logger.sample(len(chunk)):
+            hot_logger.logger.debug("Hit %s", chunk[position].rstrip())
+        yield hits
+
+
+class BestHitSelection(object):
+    """ Keeps the best hit of each read among the hits added so far. """
+
+    def __init__(self):
+        self.candidates = []
+        self.count = 0
+        self.compacted = CHUNK_LINES
+        self.hits = 0
+
+    def add(self, hits):
+        """ Adds a structured array of hits (from read_blast8_chunk). """
+        self.hits += len(hits)
+        self.candidates.append(select_best_hits(hits))
+        self.count += len(self.candidates[-1])
+        # Reads with hits in several chunks leave several candidates,
+        # merge them whenever the number of candidates has doubled
+        if self.count > 2 * self.compacted:
+            self.candidates = [select_best_hits(concatenate_hits(self.candidates))]
+            self.count = len(self.candidates[0])
+            self.compacted = max(self.count, CHUNK_LINES)
+
+    def best_hits(self, mappings, logger):
+        """ Returns the best hit of each read, ordered by read name, None if no hits were added. """
+        if not self.candidates:
+            return None
+        best_hits = select_best_hits(concatenate_hits(self.candidates))
+        logger.debug("Selected best hits of %d reads among %d hits in %s", len(best_hits), self.hits, mappings)
+        return best_hits
+
+
+def read_blast8_chunk(chunk, mappings, logger, read_names=True):
+    """
+    Splits a chunk of blast8 lines into columns.
+
+    Input:
+        chunk       list of lines in blast8 format.
+        mappings    name of the mapping output file, for error messages.
+        logger      a logger object.
+        read_names  include the read names (first word of the query name).
+    Output:
+        hits        structured array with fields read (if read_names),
+                    contig, identity, aligned_length, start and end. The
+                    subject positions are reordered to start <= end and
+                    converted to 0-based start and non-inclusive end.
+    """
+    # Every line must have all columns, or the columns after it would be shifted
+    if any(line.count("\t") != BLAST8_COLUMNS - 1 for line in chunk):
+        raise_parse_error(chunk, mappings, logger)
+    text = "".join(chunk)
+    if not text.endswith("\n"):
+        text += "\n"
+    fields = text[:-1].replace("\n", "\t").split("\t")
+    # Read name, Contig name, percent identity, alignment length, mismatches,
+    # gap openings, query start, query end, subject start, subject end,
+    # e-value, bit score
+    # Positions in pblat output are indexed from start (1-indexed)
+    # to end (inclusive) so a 75bp read with complete matching
+    # could possible have a starting position of 1 and end at 75.
+    identity = parse_column(fields, 2, np.float64)
+    qstart = parse_column(fields, 6, np.int64)
+    qend = parse_column(fields, 7, np.int64)
+    sstart = parse_column(fields, 8, np.int64)
+    send = parse_column(fields, 9, np.int64)
+    if any(column.size != len(chunk) for column in (identity, qstart, qend, sstart, send)):
+        raise_parse_error(chunk, mappings, logger)
+    contigs = np.array(fields[1::BLAST8_COLUMNS])
+
+    dtype = [("contig", contigs.dtype),
+             ("identity", np.float64),
+             ("aligned_length", np.int64),
+             ("start", np.int64),
+             ("end", np.int64)]
+    if read_names:
+        reads = np.array([read.split()[0] for read in fields[0::BLAST8_COLUMNS]])
+        dtype.insert(0, ("read", reads.dtype))
+    hits = np.empty(len(chunk), dtype=dtype)
+    if read_names:
+        hits["read"] = reads
+    hits["contig"] = contigs
+    hits["identity"] = identity
+    hits["aligned_length"] = np.abs(qend - qstart)
+    # Some mappers output reverse coordinates if mapped in the other direction,
+    # Reverse them so we do not get negative counts in the coverage
+    hits["start"] = np.minimum(sstart, send) - 1
+    hits["end"] = np.maximum(sstart, send)
+    return hits
+
+
+def parse_column(fields, column, dtype):
+    """
+    Converts a column of the blast8 fields to numbers. Parsing stops at
+    the first value that is not a number, so the result is shorter than
+    the column if any value is invalid.
+    """
+    with warnings.catch_warnings():
+        # NumPy warns about the invalid value
+        warnings.simplefilter("ignore", DeprecationWarning)
+        return np.fromstring(" ".join(fields[column::BLAST8_COLUMNS]), dtype=dtype, sep=" ")
+
+
+def raise_parse_error(chunk, mappings, logger):
+    """ Finds the first line of a chunk that cannot be parsed and raises ParseError for it. """
+    for line in chunk:
+        fields = line.split('\t')
         try:
-            check_new_read(contig_data, read, identity, aligned_length, contig, sstart, send, previous_readname, previous_information)
-        except UnboundLocalError:
-            pass # File was empty
+            if len(fields) != BLAST8_COLUMNS:
+                raise ValueError("Expected {} columns, found {}".format(BLAST8_COLUMNS, len(fields)))
+            float(fields[2])
+            for position in fields[6:10]:
+                int(position)
+        except ValueError, e:
+            logger.error("Unable to parse results file %s\n%s", mappings, e)
+            logger.error("The line that couldn't be parsed was this:\n%s", line)
+            raise ParseError("Cannot parse line\n{}\n in file {}".format(line, mappings))
+    raise ParseError("Cannot parse lines in file {}".format(mappings))
+
+
+def select_best_hits(hits):
+    """
+    Returns the best hit of each read in a structured array of hits
+    (from read_blast8_chunk), ordered by read name.
+
+    Hits are sorted by read name, decreasing identity and decreasing
+    aligned length. The sort is stable, so the first of equally good
+    hits is selected.
+    """
+    order = np.lexsort((-hits["aligned_length"], -hits["identity"], hits["read"]))
+    hits = hits[order]
+    first = np.ones(len(hits), dtype=np.bool_)
+    first[1:] = hits["read"][1:] != hits["read"][:-1]
+    return hits[first]
 
-    return contig_data
+
+def concatenate_hits(hits_list):
+    """ Concatenates structured arrays of hits, widening the string fields to fit. """
+    dtype = []
+    for name, _ in hits_list[0].dtype.descr:
+        dtype.append((name, max((hits.dtype[name] for hits in hits_list), key=lambda t: t.itemsize)))
+    return np.concatenate([hits.astype(dtype) for hits in hits_list])
+
+
+def add_hits(alignments, hits):
+    """ Adds a structured array of hits (or None) to alignments. """
+    if hits is not None and len(hits):
+        alignments.add_many(hits["contig"], hits["start"], hits["end"])
 
 
 
@@ -127,3 +266,56 @@ class ParseError(Error):
 
 class FileFormatError(Error):
     """ Raised when file is not in expected format. """
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_parse_blast8_lines(unittest.TestCase):
+    options = argparse.Namespace(coverageAllAlignments=True, logSampleEvery=1)
+    logger = logging.getLogger("test_blast8")
+
+    @staticmethod
+    def _line(read, contig, identity, qstart, qend, sstart, send):
+        return "\t".join(map(str, [read, contig, identity, 0, 0, 0, qstart, qend, sstart, send, 0, 0])) + "\n"
+
+    def _parse(self, lines, options=None):
+        alignments = AlignmentCollector({"c1": 0, "c2": 1})
+        parse_blast8_lines(iter(lines), alignments, "test.blast8", options or self.options, self.logger)
+        return [tuple(column) for column in zip(*alignments.close())]
+
+    def test_unsorted_best_hits(self):
+        lines = [self._line("r1 desc", "c1", 90.0, 1, 50, 10, 59),
+                 self._line("r2", "c2", 99.0, 1, 50, 100, 51),
+                 self._line("r1", "c2", 95.0, 1, 50, 20, 69),
+                 self._line("r2", "c1", 99.0, 1, 40, 5, 44),
+                 self._line("r1", "c1", 95.0, 1, 70, 30, 99)]
+        # r1: highest identity, then longest aligned part; r2: reversed coordinates
+        self.assertEqual(self._parse(lines), [(0, 29, 99), (1, 50, 100)])
+        all_alignments = argparse.Namespace(coverageAllAlignments=False, logSampleEvery=1)
+        self.assertEqual(len(self._parse(lines, all_alignments)), 5)
+
+    def test_ties_go_to_the_first_hit(self):
+        lines = [self._line("r1", "c2", 95.0, 1, 50, 20, 69),
+                 self._line("r1", "c1", 95.0, 1, 50, 10, 59)]
+        hits = read_blast8_chunk(lines, "test.blast8", self.logger)
+        self.assertEqual(select_best_hits(hits)["contig"].tolist(), ["c2"])
+        self.assertEqual(self._parse(lines), [(1, 19, 69)])
+
+    def test_best_hits_across_parts(self):
+        lines = [self._line("r{}".format(i % 7), "c{}".format(1 + i % 2), 90.0 + i % 3, 1, 20 + i % 5, i, i + 30)
+                 for i in range(40)]
+        parts = [collect_blast8_best_hits(iter(part), "test.blast8", self.options, self.logger)
+                 for part in (lines[:13], lines[13:14], lines[14:])]
+        alignments = AlignmentCollector({"c1": 0, "c2": 1})
+        add_blast8_best_hits(parts, alignments, "test.blast8", self.options, self.logger)
+        self.assertEqual([tuple(column) for column in zip(*alignments.close())], self._parse(lines))
+
+    def test_shifted_columns(self):
+        line = self._line("r1", "c1", 95.0, 1, 50, 10, 59)
+        fields = line.split("\t")
+        short = "\t".join(fields[:5] + fields[6:])
+        long_ = "\t".join(fields[:5] + ["0"] + fields[5:])
+        self.assertRaises(ParseError, read_blast8_chunk, [line, short, long_], "test.blast8", self.logger)
@@ -0,0 +1,146 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Tentacle FASTA scanner
+
+author:: Fredrik Boulund
+purpose:: Determines sequence names and lengths of (gzipped) FASTA files
+          without reading them line by line.
+
+"""
+import numpy as np
+from ..utils.read_source import iter_blocks
+
+# Bytes read from the file at a time
+BLOCK_SIZE = 8 << 20
+HEADER_CHAR = ord(">")
+NEWLINE = ord("\n")
+
+def sequence_name(header):
+    """ Returns the sequence name of a header line: the first word, without the '>'. """
+    return header.split()[0][1:]
+
+
+def scan_fasta(filename):
+    """
+    Determines the names and lengths of all sequences in a FASTA file.
+
+    The file is read in large blocks. Header lines are found with
+    vectorized searches for '>' at line starts, and the length of each
+    sequence is the number of non-whitespace bytes between its header
+    line and the next header.
+
+    Input:
+        filename  path to a FASTA file, may be gzipped.
+    Output:
+        names     list of sequence names (first word of the header).
+        lengths   list of sequence lengths.
+    Raises:
+        FileFormatError  if the file does not start with a FASTA header.
+    """
+    names = []
+    lengths = []
+    header = None
+    header_parts = None
+    seqlength = 0
+    line_start = True
+    first_header = -1
+    for block in iter_blocks(filename, BLOCK_SIZE):
+        position = 0
+        if header is None and header_parts is None:
+            # First block, the first line must be a header
+            if not block.lstrip().startswith(">"):
+                raise FileFormatError("First line is this:\n{}".format(block.split("\n", 1)[0].strip()))
+            position = first_header = block.index(">")
+        if header_parts is not None:
+            # A header line continues from the previous block
+            newline = block.find("\n")
+            if newline == -1:
+                header_parts.append(block)
+                continue
+            header_parts.append(block[:newline])
+            header = "".join(header_parts)
+            header_parts = None
+            position = newline + 1
+
+        data = np.frombuffer(block, dtype=np.uint8)
+        starts = np.flatnonzero(data[position:] == HEADER_CHAR) + position
+        previous = data[np.maximum(starts-1, 0)] == NEWLINE
+        if starts.size and starts[0] == 0:
+            previous[0] = line_start
+        if starts.size and starts[0] == first_header:
+            previous[0] = True
+            first_header = -1
+        starts = starts[previous]
+        ends = []
+        for start in starts:
+            end = block.find("\n", start)
+            if end == -1:
+                break
+            ends.append(end)
+
+        # Sequence data runs from position to the first header, between
+        # the end of each header line and the next header, and from the
+        # last complete header line to the end of the block.
+        whitespace = data <= 32
+        segment_starts = [position] + [end+1 for end in ends]
+        segment_ends = list(starts) + [len(data)]
+        segment_lengths = [(end - start) - np.count_nonzero(whitespace[start:end])
+                           for start, end in zip(segment_starts, segment_ends)]
+
+        seqlength += segment_lengths[0]
+        for start, end, segment_length in zip(starts, ends, segment_lengths[1:]):
+            if header is not None:
+                names.append(sequence_name(header))
+                lengths.append(int(seqlength))
+            header = block[start:end]
+            seqlength = segment_length
+        if len(ends) < len(starts):
+            # The last header line continues in the next block
+            if header is not None:
+                names.append(sequence_name(header))
+                lengths.append(int(seqlength))
+            header = None
+            header_parts = [block[starts[-1]:]]
+            seqlength = 0
+        line_start = block.endswith("\n")
+
+    if header_parts is not None:
+        header = "".join(header_parts)
+    if header is None:
+        raise FileFormatError("No FASTA header found")
+    names.append(sequence_name(header))
+    lengths.append(int(seqlength))
+    return names, lengths
+
+
+
+###############################################
+#    Exceptions
+###############################################
+
+class Error(Exception):
+    """ Base class for exceptions in this module.
+
+    Attributes:
+        msg     error message
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+class FileFormatError(Error):
+    """ Raised when file is not in expected format. """
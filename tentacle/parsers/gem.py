@@ -21,12 +21,23 @@ date:: 2014-04-30
 """
 
 import numpy as np
-from ..coverage import update_contig_data
+from ..coverage import create_alignment_sink
+from ..utils import hot_path_logger
 
 def parse_gem(mappings, contig_data, options, logger):
     """
     Parses GEM alignment format.
     """
+    mapped_reads = create_alignment_sink(contig_data, options, logger)
+    with open(mappings) as f:
+        parse_gem_lines(f, mapped_reads, mappings, options, logger)
+    return mapped_reads.close()
+
+
+def parse_gem_lines(lines, mapped_reads, mappings, options, logger):
+    """
+    Parses lines in GEM alignment format and adds the mapped reads to mapped_reads.
+    """
 
     def find_end_pos_from_gigar(gigar, plus_strand):
         """
@@ -64,15 +75,15 @@ def parse_gem(mappings, contig_data, options, logger):
                     pass
         return endpos
 
-    def parse_gem_line(line, contig_data):
+    def parse_gem_line(line):
         """
-        Takes a line, extracts the required information from it
-        and updates contig_data accordingly.
+        Takes a line and extracts the required information from it.
+        Returns None for unmapped reads.
         """
         # reference contig, start, and end position are extracted from gigar string.
         readname, readseq, readqual, matchsummary, alignments = line.split("\t", 4) 
         if alignments.startswith("-"):
-            return contig_data
+            return None
         else:
             # We only use the first alignment if there are several
             alignments = alignments.split(",")[0] 
@@ -90,11 +101,14 @@ def parse_gem(mappings, contig_data, options, logger):
 
             return (contigname, startpos, endpos)
 
-    with open(mappings) as f:
-        for line in f:
-            contigname, startpos, endpos = parse_gem_line(line, contig_data)
-            contig_data = update_contig_data(contig_data, contigname, startpos-1, endpos, options, logger)
-    return contig_data
+    hot_logger = hot_path_logger(logger, options)
+    for line in lines:
+        alignment = parse_gem_line(line)
+        if alignment is not None:
+            contigname, startpos, endpos = alignment
+            if hot_logger.enabled:
+                hot_logger.debug("Read %s mapped to %s:%d-%d", line.split("\t", 1)[0], contigname, startpos-1, endpos)
+            mapped_reads.add(contigname, startpos-1, endpos)
 
 
 ###############################################
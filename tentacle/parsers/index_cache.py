@@ -0,0 +1,125 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Tentacle reference index cache
+
+author:: Fredrik Boulund
+purpose:: Stores the parsed contig names/lengths and sorted annotation
+          columns of a reference in a cache directory, so that tasks that
+          share a reference do not have to parse it again.
+
+Each cached reference index is a directory named after a checksum of the
+contigs and annotation files, containing one .npy file per array and a
+metadata.json file with the file sizes and checksums. Cached indexes are
+written to a temporary directory and renamed into place, so a partially
+written index is never read. They are loaded as read-only memory-mapped
+arrays.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from ..utils import file_checksum
+
+# Increase when the contents of a cached index change
+FORMAT_VERSION = 1
+ARRAYS = ("names", "lengths", "annotation_contigs", "annotation_names",
+          "annotation_starts", "annotation_ends", "annotation_strands")
+
+def describe_files(contigs_file, annotations_file):
+    """ Returns the metadata that identifies a reference: sizes and checksums of its files. """
+    return {"version": FORMAT_VERSION,
+            "contigs_size": os.path.getsize(contigs_file),
+            "contigs_checksum": file_checksum(contigs_file),
+            "annotations_size": os.path.getsize(annotations_file),
+            "annotations_checksum": file_checksum(annotations_file)}
+
+
+def cache_key(metadata):
+    """ Returns the name of the cache directory for a reference. """
+    return hashlib.sha1("{version}:{contigs_checksum}:{annotations_checksum}".format(**metadata)).hexdigest()
+
+
+def load_reference_index(cache_dir, metadata, logger):
+    """
+    Loads a cached reference index.
+
+    Input:
+        cache_dir  the reference index cache directory.
+        metadata   metadata of the reference, from describe_files.
+        logger     a logger object.
+    Output:
+        arrays     dictionary with the arrays in ARRAYS as read-only
+                   memory-mapped arrays, or None if the reference is not
+                   in the cache (or the cached index is invalid).
+    """
+    index_dir = os.path.join(cache_dir, cache_key(metadata))
+    try:
+        with open(os.path.join(index_dir, "metadata.json")) as f:
+            cached_metadata = json.load(f)
+    except IOError:
+        logger.debug("Reference index not found in cache {}".format(index_dir))
+        return None
+    except ValueError:
+        logger.warning("Ignoring cached reference index {} with invalid metadata".format(index_dir))
+        return None
+    if any(cached_metadata.get(key) != value for key, value in metadata.iteritems()):
+        logger.warning("Ignoring cached reference index {}, it does not match the reference files".format(index_dir))
+        return None
+    arrays = {}
+    for name in ARRAYS:
+        arrays[name] = np.load(os.path.join(index_dir, name+".npy"), mmap_mode="r")
+    logger.debug("Loaded reference index from cache {}".format(index_dir))
+    return arrays
+
+
+def save_reference_index(cache_dir, metadata, contig_data, logger):
+    """
+    Writes the contig names/lengths and annotation columns of a
+    ContigData store to the cache.
+
+    The index is written to a temporary directory in cache_dir that is
+    renamed into place. If another task already stored the same
+    reference, its index is kept. Failing to write to the cache is not
+    an error, the task continues without caching.
+    """
+    index_dir = os.path.join(cache_dir, cache_key(metadata))
+    if os.path.isdir(index_dir):
+        return
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temp_dir = tempfile.mkdtemp(prefix=".tmp", dir=cache_dir)
+    except OSError, e:
+        logger.warning("Could not create reference index cache in {}: {}".format(cache_dir, e))
+        return
+    try:
+        for name in ARRAYS:
+            np.save(os.path.join(temp_dir, name+".npy"), getattr(contig_data, name))
+        with open(os.path.join(temp_dir, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+        # mkdtemp creates the directory readable only by the owner
+        os.chmod(temp_dir, 0755)
+        os.rename(temp_dir, index_dir)
+        logger.debug("Saved reference index to cache {}".format(index_dir))
+    except (IOError, OSError), e:
+        if os.path.isdir(index_dir):
+            logger.debug("Reference index was saved to cache {} by another task".format(index_dir))
+        else:
+            logger.warning("Could not save reference index to cache {}: {}".format(index_dir, e))
+        shutil.rmtree(temp_dir, ignore_errors=True)
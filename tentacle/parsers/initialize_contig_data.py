@@ -21,90 +21,142 @@ date:: 2014-05-06
 purpose:: Creates an empty data structure for contig coverage and annotated region count information.
           
 """
+import os
 import numpy as np
+from ..coverage.contig_data import ContigData
+from ..utils.read_source import compression
+import fasta
+import index_cache
 
-def initialize_contig_data(files, options, logger):
+# Approximate expansion of gzipped FASTA files, to estimate their contents from the file size
+GZIP_EXPANSION = 4
+# Estimated coverage array sizes by (contigs file, annotations file, options)
+_coverage_bytes_estimates = {}
+
+def initialize_contig_data(files, options, logger, temp_dir=None, source_files=None):
     """ Reads annotation and reference (FASTA) files to create an empty data structure.
 
-    Data structure is a nested dictionary:
-     contig_data                 MAIN DICTIONARY
-       ["CONTIG0101"]            CONTIG KEY
-         ["TIGRFAM0101"]         ANNOTATION KEY
-           [int, int, int, "+"]  LIST WITH: [ANNOTATION COUNT, ANNOTATION START, ANNOTATION STOP, STRAND]
-         ["__coverage__"]        COVERAGE SPECIAL KEY (if reference sequence has this name error ensues!)
-           np.array              COVERAGE DATA STRUCTURE (NumPy array)
+    Data structure is a ContigData store (see tentacle.coverage.contig_data):
+     contig_data                 CONTIGDATA STORE
+       .names, .ids, .lengths    CONTIG NAMES, NAME -> ID MAPPING, CONTIG LENGTHS
+       .coverage                 ONE NumPy ARRAY WITH length+1 POSITIONS PER CONTIG
+       .offsets                  START OF EACH CONTIG IN .coverage
+       .annotation_*             ANNOTATION COLUMNS: CONTIG, NAME, START, STOP, STRAND, COUNT
+       .index                    SORTED INTERVAL INDEX OVER THE ANNOTATIONS
+
+    With --coverageMemmap the coverage array is a np.memmap backed by a
+    file in temp_dir (defaults to the directory of the contigs file).
+    With --coverageAdaptiveDtype the coverage array starts out as int16 and
+    contigs are moved to wider arrays in .promoted when needed.
+    With --referenceIndexCache the contig names/lengths and annotation
+    columns are loaded from the cache if the reference has been parsed
+    before, and stored in the cache otherwise. The cache is keyed on
+    source_files, the shared contigs and annotations files that the
+    node-local copies in files were made from (defaults to files), so
+    that all tasks of a reference find the same entry.
     """
     logger.info("Initializing coverage data structure...")
-    contig_data = {}
-    contig_data = initialize_contig_keys(contig_data, files.contigs, options, logger)
+    if options.referenceIndexCache:
+        source_files = source_files or files
+        metadata = index_cache.describe_files(source_files.contigs, source_files.annotations)
+        cached = index_cache.load_reference_index(options.referenceIndexCache, metadata, logger)
+        if cached is not None:
+            contig_data = create_contig_data(cached["names"].tolist(), cached["lengths"], files.contigs, options, logger, temp_dir)
+            contig_data.set_sorted_annotations(cached["annotation_contigs"],
+                                               cached["annotation_names"],
+                                               cached["annotation_starts"],
+                                               cached["annotation_ends"],
+                                               cached["annotation_strands"],
+                                               options.coverageReadOverlap)
+            logger.info("Coverage data structure initialized from reference index cache.")
+            return contig_data
+    contig_data = initialize_contig_keys(files.contigs, options, logger, temp_dir)
     contig_data = initialize_annotation_counts(contig_data, files.annotations, options, logger)
+    if options.referenceIndexCache:
+        index_cache.save_reference_index(options.referenceIndexCache, metadata, contig_data, logger)
     logger.info("Coverage data structure initialized.")
     return contig_data
 
 
-def initialize_contig_keys(contig_data, contigs_file, options, logger):
-    """ Creates the first level of keys in the contig_data dictionary from a FASTA file.
+def initialize_contig_keys(contigs_file, options, logger, temp_dir=None):
+    """ Creates a ContigData store for the contigs in a FASTA file.
 
-    Keys in the dictionary are based on the first-space separated header
+    Contig names are based on the first-space separated header
     string in the FASTA headers.
 
-    Each sequence is represented by a continous array of length equal to 
-    contig length+1 for later use in coverage computations.
+    Each sequence is represented by a continous region of length equal to 
+    contig length+1 in the coverage array for later use in coverage computations.
+
+    The FASTA file is scanned in large blocks (see tentacle.parsers.fasta)
+    and may be gzipped.
     """
+    # Parse contigs_file to determine contig names and lengths
+    try:
+        names, lengths = fasta.scan_fasta(contigs_file)
+    except fasta.FileFormatError, e:
+        logger.error("CONTIGS file %s not in FASTA format?", contigs_file)
+        logger.error(e.msg)
+        raise FileFormatError("{} not in FASTA format?".format(contigs_file))
+    logger.debug("Read lengths of {} contigs from {}".format(len(names), contigs_file))
+    return create_contig_data(names, lengths, contigs_file, options, logger, temp_dir)
+
+
+def create_contig_data(names, lengths, contigs_file, options, logger, temp_dir=None):
+    """ Creates a ContigData store for contigs with given names and lengths, according to options."""
+    coverage_filename = None
+    if options.coverageMemmap and not options.noCoverage:
+        if temp_dir is None:
+            temp_dir = os.path.dirname(os.path.abspath(contigs_file))
+        coverage_filename = os.path.join(temp_dir, "coverage.memmap")
+        logger.debug("Backing coverage arrays with memory-mapped file {}".format(coverage_filename))
+    if options.coverageAdaptiveDtype:
+        # Start narrow, contigs are promoted to wider arrays as reads are added.
+        dtype = np.int16
+    else:
+        dtype = np.int32
+    contig_data = ContigData(names, lengths, coverage=not options.noCoverage, dtype=dtype,
+                             filename=coverage_filename, adaptive=options.coverageAdaptiveDtype)
+    if not options.noCoverage:
+        logger.debug("Sum of all numpy array sizes: {} bytes".format(contig_data.coverage.nbytes))
+    return contig_data
 
-    def initialize_coverage_array(seqlength, datatype):
-        """ Initializes a numpy array for use in coverage computations. """
-        return np.zeros(seqlength+1, dtype=datatype)
 
-    if not options.noCoverage:
-        arrays_size = 0
-    # Parse contigs_file to fill out data structure
-    with open(contigs_file) as f:
-        # Check that contigs_file seems to be in FASTA format
-        line = f.readline().strip()
-        if not line.startswith(">"):
-            logger.error("CONTIGS file %s not in FASTA format?", contigs_file)
-            logger.error("First line is this:\n%s", line)
-            raise FileFormatError("{} not in FASTA format?".format(contigs_file))
-
-        # Strip everything after the first space
-        header = line.split()[0][1:]
-
-        # Start reading sequence data to determine contig length
-        seqlength = 0
-        line = f.readline().strip()
-        while True:
-            if line.startswith(">"):
-                # Create the first level of keys in the contig_data structure
-                contig_data[header] = {}
-                if not options.noCoverage:
-                    contig_data[header]["__coverage__"] = initialize_coverage_array(seqlength, np.int32)
-                    arrays_size += contig_data[header]["__coverage__"].nbytes
-
-                # Reinit for next sequence
-                seqlength = 0
-                header = line.split()[0][1:]
-                line = f.readline()
-            else:
-                # For reference sequences in multi-line FASTA.
-                # This will sum the number of bases for each line 
-                seqlength = seqlength + len(line.strip())
-                line = f.readline()
-                if line == "":
-                    # Finish the last contig
-                    contig_data[header] = {}
-                    if not options.noCoverage:
-                        contig_data[header]["__coverage__"] = initialize_coverage_array(seqlength, np.int32)
-                        arrays_size += contig_data[header]["__coverage__"].nbytes
-                    break
+def estimate_coverage_bytes(contigs_file, annotations_file, options, logger):
+    """ Estimates the memory used by the coverage arrays of a reference without parsing it.
 
-    if not options.noCoverage:
-        logger.debug("Sum of all numpy array sizes: {} bytes".format(arrays_size))
-    return contig_data
+    The total contig length is taken from the reference index cache if the
+    reference is cached (--referenceIndexCache), otherwise it is estimated
+    from the size of the contigs file. Memory-mapped coverage arrays
+    (--coverageMemmap) are not counted. Estimates are remembered per
+    reference, as many tasks share the same reference.
+    """
+    if options.noCoverage or options.coverageMemmap:
+        return 0
+    itemsize = np.dtype(np.int16 if options.coverageAdaptiveDtype else np.int32).itemsize
+    key = (contigs_file, annotations_file, itemsize, options.referenceIndexCache)
+    if key not in _coverage_bytes_estimates:
+        positions = None
+        if options.referenceIndexCache:
+            metadata = index_cache.describe_files(contigs_file, annotations_file)
+            cached = index_cache.load_reference_index(options.referenceIndexCache, metadata, logger)
+            if cached is not None:
+                # Each contig has length+1 positions
+                positions = int(cached["lengths"].sum()) + len(cached["lengths"])
+        if positions is None:
+            positions = os.path.getsize(contigs_file)
+            if compression(contigs_file):
+                positions *= GZIP_EXPANSION
+        _coverage_bytes_estimates[key] = positions * itemsize
+    return _coverage_bytes_estimates[key]
 
 
 def initialize_annotation_counts(contig_data, annotations_filename, options, logger):
-    """ Initializes the second level of keys in the contig_data structure (annotations)."""
+    """ Adds the annotated regions to the contig_data store and builds the annotation index."""
+    contigs = []
+    annotations = []
+    starts = []
+    ends = []
+    strands = []
     with open(annotations_filename) as annotations_file:
         logger.debug("Parsing {}.".format(annotations_filename))
         for line in annotations_file:
@@ -113,11 +165,22 @@ def initialize_annotation_counts(contig_data, annotations_filename, options, log
             except ValueError, e:
                 logger.error("Could not parse annotation line\n{}\nfrom file {}.".format(line, annotations_filename))
                 raise ParseError("Could not parse line {} in file {}.".format(line, annotations_filename))
-
-            start = int(start) # Uses 0-based indexing
-            end = int(end)
-            contig_data[contig_header][annotation] = [0, start, end, strand]
-
+            if contig_header not in contig_data:
+                logger.error("Could not find contig {} from annotation file {} in the reference.".format(contig_header, annotations_filename))
+                raise ParseError("Contig {} in file {} not found in reference.".format(contig_header, annotations_filename))
+
+            contigs.append(contig_header)
+            annotations.append(annotation)
+            starts.append(int(start)) # Uses 0-based indexing
+            ends.append(int(end))
+            strands.append(strand)
+
+    # The interval index is built once, so that determining what
+    # annotated regions a read hits does not require a scan over
+    # all annotations on the contig for every mapped read.
+    logger.debug("Building annotation interval index...")
+    contig_data.set_annotations(contigs, annotations, starts, ends, strands, options.coverageReadOverlap)
+    logger.debug("Indexed {} annotated regions, {} bytes in total.".format(len(contig_data.index), contig_data.nbytes))
     return contig_data
 
 
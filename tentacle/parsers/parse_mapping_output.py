@@ -22,31 +22,80 @@ purpose:: Parses mapping output in different formats and extracts mapped read in
           used in coverage/counts computations..
           
 """
+import os
 import numpy as np
 import blast8
 import razers3
 import sam
+import bam
 import gem
+from sharding import parse_sharded
+
+# Output parsers that can be run on shards of the mapping output in
+# parallel: parser -> (line parser, function returning the offset of
+# the first line to parse, function returning the group key of a line,
+# best-hit selection across shards with --coverageAllAlignments, see
+# parse_sharded).
+SHARDABLE_PARSERS = {
+    blast8.parse_blast8: (blast8.parse_blast8_lines, None, blast8.blast8_read_name,
+                          (blast8.collect_blast8_best_hits, blast8.add_blast8_best_hits)),
+    razers3.parse_razers3: (razers3.parse_razers3_lines, None, None, None),
+    sam.parse_sam: (sam.parse_sam_lines, sam.find_alignments_start, None, None),
+    gem.parse_gem: (gem.parse_gem_lines, None, None, None),
+}
 
 def parse_mapping_output(mapper, mappings, contig_data, options, logger):
     """
     Adds the number of mapped reads to the correct positions in 
-    a contig_data dictionary.
+    a ContigData store.
 
     Uses NumPy.
 
+    With --mapperProcesses the reads are mapped in parts, and the output
+    of each part is added to the ContigData store as soon as its mapper
+    has finished, so that the coverage of all parts is merged before the
+    cumulative sum.
+
     Input:
         mapper      mapper object used to map the data
-        mappings    mapper output file.
-        contig_data  the contig_data dictionary
+        mappings    mapper output file (a list of files with --mapperProcesses).
+        contig_data  the ContigData store
         options     all options
         logger      a logger object
     Output:
         contig_data 
     """
-    contig_data = mapper.output_parser(mappings, contig_data, options, logger)
+    if mapper.mapping_parts is not None:
+        parts = mapper.iter_mapped_parts()
+        try:
+            for part_mappings in parts:
+                contig_data = add_mapping_output(mapper, part_mappings, contig_data, options, logger)
+        finally:
+            parts.close()
+    else:
+        contig_data = add_mapping_output(mapper, mappings, contig_data, options, logger)
 
     if not options.noCoverage:
-        for contig in contig_data.keys():
-            np.cumsum(contig_data[contig]["__coverage__"], dtype=np.int32, out=contig_data[contig]["__coverage__"])
+        contig_data.cumulative_sum()
+        if options.coverageAdaptiveDtype:
+            logger.info("Promoted {} of {} contigs to wider coverage arrays {}, {} bytes in total.".format(
+                len(contig_data.promoted), len(contig_data), contig_data.promotion_summary(), contig_data.nbytes))
+    return contig_data
+
+
+def add_mapping_output(mapper, mappings, contig_data, options, logger):
+    """
+    Parses one mapper output file and adds the mapped reads to a
+    ContigData store, in parallel shards if possible.
+    """
+    if options.parseProcesses > 1 and mapper.output_parser in SHARDABLE_PARSERS and os.path.isfile(mappings):
+        parse_lines, find_start, group_key, best_hits = SHARDABLE_PARSERS[mapper.output_parser]
+        start = find_start(mappings, logger) if find_start else 0
+        if not options.coverageAllAlignments:
+            best_hits = None
+        contig_data = parse_sharded(parse_lines, mappings, contig_data, options, logger, start, group_key, best_hits)
+    else:
+        if options.parseProcesses > 1:
+            logger.info("Mapping output {} cannot be parsed in parallel, using a single process.".format(mappings))
+        contig_data = mapper.output_parser(mappings, contig_data, options, logger)
     return contig_data
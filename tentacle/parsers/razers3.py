@@ -21,29 +21,38 @@ date:: 2014-04-30
 """
 
 import numpy as np
-from ..coverage import update_contig_data
+from ..coverage import create_alignment_sink
+from ..utils import hot_path_logger
 
 def parse_razers3(mappings, contig_data, options, logger):
     """ Parses razers3 output.  """
+    alignments = create_alignment_sink(contig_data, options, logger)
     with open(mappings) as f:
-        for line in f:
-            # Read name, Read start, Read end, Direction, Contig name, 
-            # Contig start, Contig end, percent Identity.
-            # Positions in RazerS3 output are indexed from start (0-indexed)
-            # to end (non-inclusive) so a 75bp read with complete matching
-            # could possible have a starting position of 0 and end at 75.
-            try:
-                read, rstart, rend, direction, contig, cstart, cend, identity = line.split() #pylint: disable=W0612
-            except ValueError, e:
-                logger.error("Unable to parse results file %s\n%s", mappings, e)
-                logger.error("The line that couldn't be parsed was this:\n%s", line)
-                raise ParseError("Cannot parse line\n{}\n in file {}".format(line, mappings))
-            cstart = int(cstart)
-            cend = int(cend) # End coordinate is non-inclusive
+        parse_razers3_lines(f, alignments, mappings, options, logger)
+    return alignments.close()
 
-            contig_data = update_contig_data(contig_data, contig, cstart, cend, options, logger)
 
-    return contig_data
+def parse_razers3_lines(lines, alignments, mappings, options, logger):
+    """ Parses lines of razers3 output and adds the mapped reads to alignments. """
+    hot_logger = hot_path_logger(logger, options)
+    for line in lines:
+        # Read name, Read start, Read end, Direction, Contig name, 
+        # Contig start, Contig end, percent Identity.
+        # Positions in RazerS3 output are indexed from start (0-indexed)
+        # to end (non-inclusive) so a 75bp read with complete matching
+        # could possible have a starting position of 0 and end at 75.
+        try:
+            read, rstart, rend, direction, contig, cstart, cend, identity = line.split() #pylint: disable=W0612
+        except ValueError, e:
+            logger.error("Unable to parse results file %s\n%s", mappings, e)
+            logger.error("The line that couldn't be parsed was this:\n%s", line)
+            raise ParseError("Cannot parse line\n{}\n in file {}".format(line, mappings))
+        cstart = int(cstart)
+        cend = int(cend) # End coordinate is non-inclusive
+
+        if hot_logger.enabled:
+            hot_logger.debug("Read %s mapped to %s:%d-%d", read, contig, cstart, cend)
+        alignments.add(contig, cstart, cend)
 
 
 ###############################################
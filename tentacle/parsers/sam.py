@@ -20,56 +20,95 @@ author:: Fredrik Boulund
 date:: 2014-04-30
 """
 
+from itertools import chain
+import re
 import numpy as np
-from ..coverage import update_contig_data
+from ..coverage import create_alignment_sink
+from ..utils import hot_path_logger
+
+CIGAR_PATTERN = re.compile(r'([0-9]+)([MIDNSHPX=])')
+# CIGAR operators counted towards the aligned length on the reference
+REFERENCE_OPERATORS = frozenset(['M', 'D', '=', 'X'])
+# Most alignments in a run share a handful of CIGAR strings, the memo
+# is emptied when it grows past this size.
+CIGAR_CACHE_SIZE = 4096
+_cigar_cache = {}
+
+def cigar_reference_length(cigar):
+    """
+    Returns the number of reference positions covered by an alignment
+    with the given CIGAR string.
+
+    Results are memoized on the CIGAR string. Pure-match CIGARs
+    (e.g. 100M) are decoded without the regular expression.
+    """
+    try:
+        return _cigar_cache[cigar]
+    except KeyError:
+        pass
+    if cigar[-1:] == "M" and cigar[:-1].isdigit():
+        length = int(cigar[:-1])
+    else:
+        length = sum(int(count) for count, operator in CIGAR_PATTERN.findall(cigar) if operator in REFERENCE_OPERATORS)
+    if len(_cigar_cache) >= CIGAR_CACHE_SIZE:
+        _cigar_cache.clear()
+    _cigar_cache[cigar] = length
+    return length
+
 
 def parse_sam(mappings, contig_data, options, logger):
     """
     Parses standard SAM alignments.
     Useful for bowtie2 and other aligners that output SAM format
     """
-    
-    def find_end_pos_from_cigar(cigar):
-        """
-        Parses a CIGAR string and returns the sum of all entities
-        to find the end position of the aligned read in the reference.
-        """
-        import re
-        regex = r'([0-9]+[MIDNSHPX=])'
-        allowed_operators = set(['M', 'D', '=', 'X'])
-        return sum([int(operator[:-1]) for operator in re.findall(regex, cigar) if operator[-1] in allowed_operators])
-
-    def parse_sam_line(line, contig_data):
-        """
-        Takes a line, extracts the required information from it
-        and updates contig_data accordingly.
-        """
+    alignments = create_alignment_sink(contig_data, options, logger)
+    with open(mappings) as f:
+        line = f.readline()
+        if not line.startswith("@HD"):
+            logger.error("Unable to parse results file %s", mappings)
+            logger.error("Could not find @HD header tag on first line of file:\n%s", line)
+            raise ParseError("Mapping results file {} does not start with @HD".format(mappings))
+        for line in f:
+            if not line.startswith("@"):
+                # We're in alignment territory and no longer need the check!
+                parse_sam_lines(chain([line], f), alignments, mappings, options, logger)
+                break
+
+    return alignments.close()
+
+
+def parse_sam_lines(lines, alignments, mappings, options, logger):
+    """
+    Parses SAM alignment lines (no header lines) and adds the mapped 
+    reads to alignments.
+    """
+    hot_logger = hot_path_logger(logger, options)
+    for line in lines:
         # rname is reference/contig name, pos is starting position of aligned read,
         # end position is extracted from cigar.
         qname, flag, rname, pos, mapq, cigar, rest = line.split(None, 6)
-        if rname == '*':
-            return contig_data
-        else:
+        if rname != '*':
             start = int(pos)
-            end = start + find_end_pos_from_cigar(cigar) - 1
+            end = start + cigar_reference_length(cigar) - 1
+            if hot_logger.enabled:
+                hot_logger.debug("Read %s mapped to %s:%d-%d", qname, rname, start-1, end)
+            alignments.add(rname, start-1, end)
+
 
-            contig_data = update_contig_data(contig_data, rname, start-1, end, options, logger)
-            return contig_data
-                
+def find_alignments_start(mappings, logger):
+    """
+    Checks the SAM header and returns the byte offset of the first 
+    alignment line in the file.
+    """
     with open(mappings) as f:
         line = f.readline()
         if not line.startswith("@HD"):
-            logger.error("Unable to parse results file %s\n%s", mappings, e)
             logger.error("Could not find @HD header tag on first line of file:\n%s", line)
             raise ParseError("Mapping results file {} does not start with @HD".format(mappings))
-        for line in f:
-            if not line.startswith("@"):
-                contig_data = parse_sam_line(line, contig_data)
-                break # We're in alignment territory and no longer need the check!
-        for line in f:
-            contig_data = parse_sam_line(line, contig_data)
-
-    return contig_data
+        while True:
+            position = f.tell()
+            if not f.readline().startswith("@"):
+                return position
 
 
 
@@ -0,0 +1,175 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Tentacle sharded parsing of mapping output
+
+author:: Fredrik Boulund
+purpose:: Splits a mapping output file into byte-range shards aligned to
+          line boundaries and parses the shards in parallel worker processes.
+
+"""
+from cStringIO import StringIO
+from multiprocessing import Pool
+import logging
+import os
+
+from ..coverage import update_contig_data_batch, AlignmentCollector, create_alignment_sink
+
+# Shards per worker process, more shards than processes evens out the load
+# and limits the size of the arrays returned by each worker.
+SHARDS_PER_PROCESS = 4
+# Bytes read at a time from a shard
+READ_SIZE = 16 << 20
+
+def find_shard_boundaries(filename, start, shards, group_key=None):
+    """
+    Splits the byte range [start, end of file) of a file into shards.
+
+    Shard boundaries are placed at line starts. If group_key is given,
+    boundaries are moved forward past all lines with the same key as the
+    line at the boundary, so that consecutive lines with the same key
+    (e.g. all hits of a read) always end up in the same shard.
+
+    Input:
+        filename   path to a text file.
+        start      byte offset where the lines to parse start.
+        shards     the number of shards to create (at most).
+        group_key  optional function returning the group key of a line.
+    Output:
+        shards     list of (start, end) byte offsets.
+    """
+    size = os.path.getsize(filename)
+    boundaries = [start]
+    with open(filename, "rb") as f:
+        for shard in xrange(1, shards):
+            target = start + (size - start) * shard // shards
+            if target <= boundaries[-1]:
+                continue
+            # Finish the line that target points into (or the one ending
+            # right before it), so that position is at the start of a line.
+            f.seek(target-1)
+            f.readline()
+            position = f.tell()
+            if group_key is not None and position < size:
+                key = group_key(f.readline())
+                while True:
+                    position = f.tell()
+                    line = f.readline()
+                    if not line or group_key(line) != key:
+                        break
+            if position >= size:
+                break
+            boundaries.append(position)
+    boundaries.append(size)
+    return [(first, last) for first, last in zip(boundaries[:-1], boundaries[1:]) if first < last]
+
+
+def iter_shard_lines(filename, start, end):
+    """ Yields the lines in the byte range [start, end) of a file. """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        partial = ""
+        while remaining > 0:
+            block = f.read(min(READ_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            last_newline = block.rfind("\n")
+            if last_newline == -1:
+                partial += block
+                continue
+            for line in StringIO(partial + block[:last_newline+1]):
+                yield line
+            partial = block[last_newline+1:]
+        if partial:
+            yield partial
+
+
+# Set in each worker process by _initialize_worker
+_worker_state = {}
+
+def _initialize_worker(contig_ids, options, logger_name):
+    _worker_state["contig_ids"] = contig_ids
+    _worker_state["options"] = options
+    _worker_state["logger"] = logging.getLogger(logger_name)
+
+
+def _parse_shard(args):
+    """ Parses one shard in a worker process and returns the collected alignments.
+
+    With collect_lines, returns what it collects from the lines instead.
+    """
+    parse_lines, collect_lines, mappings, start, end = args
+    if collect_lines is not None:
+        return collect_lines(iter_shard_lines(mappings, start, end), mappings,
+                             _worker_state["options"], _worker_state["logger"])
+    alignments = AlignmentCollector(_worker_state["contig_ids"])
+    parse_lines(iter_shard_lines(mappings, start, end), alignments, mappings,
+                _worker_state["options"], _worker_state["logger"])
+    return alignments.close()
+
+
+def parse_sharded(parse_lines, mappings, contig_data, options, logger, start=0, group_key=None, best_hits=None):
+    """
+    Parses a mapping output file in parallel.
+
+    The file is split into shards that are parsed by options.parseProcesses
+    worker processes. Each worker returns the alignments of its shard as
+    arrays, which are applied to contig_data with update_contig_data_batch
+    as they arrive.
+
+    Parsers that select the best hit of each read give best_hits, a pair
+    (collect_lines, add_best_hits) of module level functions. Each worker
+    then returns the best-hit candidates of its shard,
+    collect_lines(lines, mappings, options, logger), and the parent
+    selects among the candidates of all shards, in file order, with
+    add_best_hits(candidates, alignments, mappings, options, logger).
+    The hits of a read in different shards are thereby compared, and
+    the best hits are the same as when parsing in a single process.
+
+    Input:
+        parse_lines  module level function (lines, alignments, mappings, options, logger)
+                     that parses lines of the mapping output format.
+        mappings     path to the mapping output file.
+        contig_data  the ContigData store.
+        options      options namespace.
+        logger       a logger object.
+        start        byte offset of the first line to parse (e.g. after a header).
+        group_key    passed on to find_shard_boundaries.
+        best_hits    optional (collect_lines, add_best_hits) pair, see above.
+    Output:
+        contig_data
+    """
+    processes = options.parseProcesses
+    shards = find_shard_boundaries(mappings, start, processes*SHARDS_PER_PROCESS, group_key)
+    logger.debug("Parsing {} in {} shards using {} processes".format(mappings, len(shards), processes))
+    pool = Pool(processes, _initialize_worker, (contig_data.ids, options, logger.name))
+    try:
+        collect_lines, add_best_hits = best_hits or (None, None)
+        tasks = [(parse_lines, collect_lines, mappings, first, last) for first, last in shards]
+        if best_hits:
+            alignments = create_alignment_sink(contig_data, options, logger)
+            add_best_hits(pool.imap(_parse_shard, tasks), alignments, mappings, options, logger)
+            contig_data = alignments.close()
+        else:
+            for contig_ids, rstarts, rends in pool.imap(_parse_shard, tasks):
+                contig_data = update_contig_data_batch(contig_data, contig_ids, rstarts, rends, options, logger)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return contig_data
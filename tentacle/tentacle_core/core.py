@@ -22,6 +22,7 @@ from sys import exit, stdout
 from collections import namedtuple
 from time import time
 from gevent.subprocess import Popen, PIPE
+import gevent
 #from gevent import monkey
 #from subprocess import Popen, PIPE
 import argparse
@@ -58,10 +59,42 @@ class TentacleCore:
         return mapper
 
 
-    def preprocess_data_and_map_reads(self, files, options):
+    @staticmethod
+    def estimate_task_resources(files, options, logger):
+        """
+        Estimates the CPUs and memory (in bytes) needed to process a
+        set of files on a node, so that several tasks can share a node.
+        Returns None if the mapper does not tell how many threads it
+        uses, the task then needs the whole node.
+
+        CPUs are the threads of all mapper processes (--mapperProcesses),
+        or the reads/parse worker processes if there are more of those.
+        Memory is the reference held by each mapper process
+        (--mapperProcessMemory, or the size of the contigs file) plus
+        the coverage arrays.
+        """
+        mappers = importlib.import_module(".."+options.mapperName, "tentacle.mappers.subpkg")
+        mapperClass = getattr(mappers, options.mapperName.title())
+        threads = mapperClass.threads(options)
+        if threads is None:
+            return None
+        mapper_processes = max(1, options.mapperProcesses)
+        cpus = max(threads * mapper_processes, options.readsProcesses, options.parseProcesses)
+        if options.mapperProcessMemory:
+            mapper_memory = options.mapperProcessMemory << 30
+        else:
+            mapper_memory = os.path.getsize(files.contigs)
+        memory = mapper_memory * mapper_processes + parsers.estimate_coverage_bytes(files.contigs, files.annotations, options, logger)
+        return (cpus, memory)
+
+
+    def preprocess_data_and_map_reads(self, files, options, results_copy_dir=None):
         """
         Performs file copy operations, gunzip, quality filtering etc. 
         before running the mapper.
+
+        With --streamMappingResults the mapper is only started and the 
+        returned mapped_reads.mapped_reads is a FIFO with its output.
         """
 
         mapper = self.initalize_mapper(options)
@@ -76,29 +109,22 @@ class TentacleCore:
         LocalTuple = namedtuple("local", ["contigs", "reads", "annotations"])
         local = LocalTuple(rebase_to_local_tmp(files.contigs), rebase_to_local_tmp(files.reads), rebase_to_local_tmp(files.annotations))
     
-        # Copy annotation file to node, returns updated local filename.
-        # TODO: References, Reads, and Annotations can be transferred in parallel.
-        preprocess_annotation_time = time()
-        new_annotations = mapping_utils.gunzip_copy(files.annotations, local.annotations, self.logger)
-        local = local._replace(annotations=new_annotations)
-        self.logger.info("Time to transfer and prepare annotations: %s", time()-preprocess_annotation_time)
-
-        # Transfer and unpack references.
-        # Returns mapper DB filename where relevant and specified by the correct command line flag.
-        preprocess_references_time = time()
-        local = mapper.prepare_references(files, local, options, rebase_to_local_tmp)
-        self.logger.info("Time to transfer and prepare references: %s", time()-preprocess_references_time)
-    
-        # Prepare reads for mapping (gunzip, filter and transfer to node)
-        # Returns updated local filename.
-        reads_time = time()
-        local = mapper.prepare_reads(files, local, options)
-        self.logger.info("Time to transfer and preprocess reads: %s", time()-reads_time)
-        
-        # Map reads using mapper on node with node-local files in tempdir.
-        maptime = time()
-        mapped_reads_file_path = mapper.run_mapper(local, options)
-        self.logger.info("Time to map reads: %s", time()-maptime)
+        try:
+            local = self.stage_files(mapper, files, local, options, rebase_to_local_tmp)
+            
+            # Map reads using mapper on node with node-local files in tempdir.
+            maptime = time()
+            mapped_reads_file_path = mapper.run_mapper(local, options, results_copy_dir)
+        except:
+            # Cached reference DBs are otherwise released by analyse
+            mapper.release_references()
+            raise
+        if options.streamMappingResults:
+            self.logger.info("Started mapper, streaming mapping results to coverage computation.")
+        elif mapper.mapping_parts is not None:
+            self.logger.info("Started mapper processes, computing coverage/counts for each part of the reads as it is mapped.")
+        else:
+            self.logger.info("Time to map reads: %s", time()-maptime)
 
         # Prepare and return a named tuple with essential information from mapping.
         MappedReadsTuple = namedtuple("mapped_reads", ["contigs", "mapped_reads", "annotations"])
@@ -108,32 +134,81 @@ class TentacleCore:
         return (mapped_reads, temp_dir, mapper)
     
     
-    def analyse_coverage(self, mapped_reads, mapper, outfile, options):
+    def stage_files(self, mapper, files, local, options, rebase_to_local_tmp):
+        """
+        Transfers and prepares annotations, references and reads on the node.
+
+        With --parallelStaging the three stages run concurrently in
+        greenlets, so that waiting for the (network) file system in one
+        stage overlaps with decompression in another. Each stage only
+        updates its own field of the local filenames (e.g. GEM rebases
+        the references to its DB name), and the results are merged when
+        all stages are done. If a stage fails, the others are killed.
+        """
+        def timed(description, function, *args):
+            stage_time = time()
+            result = function(*args)
+            if function == mapper.prepare_reads and mapper.read_preparation_report:
+                # Break down the time spent per chunk of reads
+                self.logger.info("Time to {}: %s (%s)".format(description), time()-stage_time, mapper.read_preparation_report)
+            else:
+                self.logger.info("Time to {}: %s".format(description), time()-stage_time)
+            return result
+
+        stages = [("transfer and prepare annotations", mapping_utils.gunzip_copy, files.annotations, local.annotations, self.logger),
+                  # Returns mapper DB filename where relevant and specified by the correct command line flag.
+                  ("transfer and prepare references", mapper.prepare_references, files, local, options, rebase_to_local_tmp),
+                  # Gunzip, filter and transfer reads to node.
+                  ("transfer and preprocess reads", mapper.prepare_reads, files, local, options)]
+        if options.parallelStaging:
+            self.logger.info("Transferring and preparing annotations, references and reads in parallel...")
+            staging_time = time()
+            greenlets = [gevent.spawn(timed, *stage) for stage in stages]
+            try:
+                gevent.joinall(greenlets, raise_error=True)
+            finally:
+                gevent.killall(greenlets)
+            annotations, references, reads = [greenlet.value for greenlet in greenlets]
+            self.logger.info("Time to transfer and prepare all files: %s", time()-staging_time)
+        else:
+            annotations, references, reads = [timed(*stage) for stage in stages]
+        return local._replace(annotations=annotations,
+                              contigs=references.contigs,
+                              reads=reads.reads)
+    
+    
+    def analyse_coverage(self, mapped_reads, mapper, outfile, options, temp_dir=None, source_files=None):
         """
         Analyses mapped contigs and counts map coverage
+
+        source_files are the shared files of the task, which identify the
+        reference in the reference index cache.
         """
     
         coveragetime = time()
         # Initialize data structure to hold results
-        contig_data = parsers.initialize_contig_data(mapped_reads, options, self.logger)
+        contig_data = parsers.initialize_contig_data(mapped_reads, options, self.logger, temp_dir, source_files)
         self.logger.info("Computing coverage/counts across reference sequences...")
         contig_data = parsers.parse_mapping_output(mapper,
                                                    mapped_reads.mapped_reads,
                                                    contig_data,
                                                    options,
                                                    self.logger)
+        # Raises if a streaming mapper failed, before any results are written
+        mapper.wait_for_mapper()
         self.logger.info("Coverage/counts computed.")
     
         # DEBUG printing (EXTREMELY SLOW)
         if not options.noCoverage and options.debugOutputCoverage:
             coverage_output_filename = "contigCoverage.txt"
-            coverage.debug_output_coverage(self.logger, coverage_output_filename, contig_coverage)
+            coverage.debug_output_coverage(self.logger, coverage_output_filename, contig_data)
         if options.debugPrintSingleCoverage:
             coverage.debug_print_single_coverage(contig_data, options.debugPrintSingleCoverage)
     
         self.logger.info("Computing coverage statistics and writing results to {}...".format(outfile))
         coverage.compute_and_write_coverage_statistics(mapped_reads.annotations, contig_data, outfile, options, self.logger)
         self.logger.info("Annotation coverage statistics and writing of results completed.")
+        contig_data.close()
 
         self.logger.info("Time to analyse coverage/counts: %s", time()-coveragetime)
         self.logger.info("Results available in %s", outfile)
@@ -166,14 +241,33 @@ class TentacleCore:
 
 
     def analyse(self, files, options):
-        mapped_reads, temp_dir, mapper = self.preprocess_data_and_map_reads(files, options)
-
+        results_copy_dir = None
         if options.saveMappingResultsFile:
-            target_filename = os.path.dirname(files.annotationStats)+"/"+\
-                              os.path.basename(mapped_reads.mapped_reads)+".gz"
-            self.save_mapping_results(mapped_reads, target_filename)
+            results_copy_dir = os.path.dirname(files.annotationStats)
+        mapped_reads, temp_dir, mapper = self.preprocess_data_and_map_reads(files, options, results_copy_dir)
+
+        try:
+            # With --mapperProcesses the mapping results of the parts are
+            # saved when all parts have been mapped.
+            mapped_parts = mapper.mapping_parts is not None
+            if options.saveMappingResultsFile and not options.streamMappingResults and not mapped_parts:
+                # A streaming mapper writes the copy while the results are parsed.
+                target_filename = os.path.dirname(files.annotationStats)+"/"+\
+                                  os.path.basename(mapped_reads.mapped_reads)+".gz"
+                self.save_mapping_results(mapped_reads, target_filename)
+
+            self.analyse_coverage(mapped_reads, mapper, files.annotationStats, options, temp_dir, files)
 
-        self.analyse_coverage(mapped_reads, mapper, files.annotationStats, options)
+            if options.saveMappingResultsFile and mapped_parts:
+                for part in mapped_reads.mapped_reads:
+                    target_filename = os.path.dirname(files.annotationStats)+"/"+\
+                                      os.path.basename(part)+".gz"
+                    self.save_mapping_results(mapped_reads._replace(mapped_reads=part), target_filename)
+        finally:
+            # The coverage analysis reads the local contigs, which may be
+            # linked into the reference DB cache, so the cached DBs are
+            # released only when it is done
+            mapper.release_references()
 
         if options.deleteTempFiles:
             self.delete_temporary_files(temp_dir)
@@ -201,6 +295,9 @@ class TentacleCore:
         quality_filtering_group.add_argument("--fqProportion", dest="fastqProportion",
             type=int, default=50,
             help="FASTQ filter: minimum proportion of bases above base quality score [default: %(default)s]")
+        quality_filtering_group.add_argument("--fqQualityOffset", dest="fastqQualityOffset",
+            type=int, default=64,
+            help="FASTQ filter/trim: ASCII offset of the quality scores, e.g. 33 for Sanger/Illumina 1.8+ [default: %(default)s]")
         quality_filtering_group.add_argument("--fqFilterOther", dest="fastqFilterOther",
             type=str, default="",
             help="FASTQ filter: Additional fastq_quality_filter command line options enclosed in single quotes. [default: '%(default)s']") 
@@ -115,9 +115,16 @@ class LaunchingMasterWorkerExecutor(object):
             #create the distributed worker pool
             #TODO: handle logging/exceptions
             with distributed_worker_pool_factory.create_from_parsed_args(parsed_args=parsed_args, master_logger=master_logger, remote_launcher=launcher, output_dir=output_dir) as distributed_worker_pool:
-                distributed_worker_pool.map(
-                    lambda task: worker_factory.create_from_parsed_args(parsed_args, logger_provider).process(task), tasks)
-                #TODO, what to do with results?
+                completed_tasks = distributed_worker_pool.imap_unordered(
+                    lambda task: worker_factory.create_from_parsed_args(parsed_args, logger_provider).process(task), tasks,
+                    requirements=lambda task: worker_factory.estimate_task_resources(parsed_args, task, master_logger),
+                    locality=worker_factory.task_locality,
+                    cost=worker_factory.task_cost_estimator(parsed_args, master_logger) if parsed_args.longestTasksFirst else None)
+                for done, ((core_name, files), result) in enumerate(completed_tasks, 1):
+                    if result.successful():
+                        master_logger.info("Completed {} ({} of {} tasks done)".format(core_name, done, len(tasks)))
+                    else:
+                        master_logger.error("Failed {} ({} of {} tasks done): {}".format(core_name, done, len(tasks), result.exception))
 
         if parsed_args.localCoordinator:
             return gevent.spawn(create_distributed_worker_pool_and_process_tasks)
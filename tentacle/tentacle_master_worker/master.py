@@ -37,6 +37,10 @@ class TentacleMaster(object):
             help="a tab delimited text file with mapping triplets on each row. Required.")
         general_group.add_argument("--saveMappingResultsFile", action="store_true",
             help="Retrieve the mapping results file from the node after mapping completion")
+        general_group.add_argument("--streamMappingResults", action="store_true",
+            help="Compute coverage/counts while the mapper is running by streaming its output through a FIFO instead of writing it to local disk. With --saveMappingResultsFile a gzipped copy of the stream is written [default: %(default)s].")
+        general_group.add_argument("--parallelStaging", action="store_true",
+            help="Transfer and prepare annotations, references and reads on the node concurrently instead of one after the other [default: %(default)s].")
         general_group.add_argument("--noCoverage", action="store_true",
             help="Skip computing coverage for all annotated regions [default: %(default)s].")
         general_group.add_argument("--noCounts", action="store_true",
@@ -44,9 +48,39 @@ class TentacleMaster(object):
         general_group.add_argument("--coverageReadOverlap", default=0, type=int, metavar="O",
                 help="Minimum overlap between read and annotated region for it to count towards the count for that region [default: 0]")
         general_group.add_argument("--coverageAllAlignments", action="store_true",
-                help="Specific to mappers with blast8 tabular output: Include all matching alignments in coverage computations. Note that this might inflate coverage! Default is to only include the 'best' hit found in the mapper output [default %(default)s].")
+                help="Specific to mappers with blast8 tabular output: Include only the best hit of each read (highest identity, then longest aligned part) in coverage computations. The best-hit candidates are kept in memory until the whole mapper output is parsed, so memory grows with the number of reads. Default is to include all matching alignments, which might inflate coverage [default %(default)s].")
         general_group.add_argument("--discardSequencesShorterThan", default=0, type=int, metavar="N",
             help="After mapping reads, discard reads with aligned portions shorter than this [default: not used]")
+        general_group.add_argument("--parseProcesses", default=1, type=int, metavar="N",
+            help="Parse the mapping output in N worker processes, each parsing byte-range shards of the file [default: %(default)s]")
+        general_group.add_argument("--logSampleEvery", default=1, type=int, metavar="N",
+            help="With --logLevel DEBUG, log only every Nth of the debug messages written per read or alignment by the parsers and coverage updates [default: %(default)s]")
+        general_group.add_argument("--bamThreads", default=4, type=int, metavar="N",
+            help="Number of threads used to decompress mapping results in BAM format [default: %(default)s]")
+        general_group.add_argument("--readsThreads", default=1, type=int, metavar="N",
+            help="Number of threads used to decompress reads files in BGZF format (bgzip), other gzipped reads are decompressed by a single thread [default: %(default)s]")
+        general_group.add_argument("--mapperProcesses", default=1, type=int, metavar="N",
+            help="Split the reads into N parts and map them with concurrent mapper processes, for mappers that do not scale well with their own threads (consider lowering the mapper's thread option). At most one process per CPU runs at a time, and only as many as fit in the available memory. The results of each part are parsed as soon as it is mapped [default: %(default)s]")
+        general_group.add_argument("--mapperProcessMemory", default=0, type=int, metavar="GB",
+            help="Memory used by one mapper process in GiB, limits the number of concurrent mapper processes with --mapperProcesses [default: estimated from the size of the reference]")
+        general_group.add_argument("--readsProcesses", default=1, type=int, metavar="N",
+            help="Split FASTQ reads into chunks of records and run quality control and FASTA conversion on them in N worker processes [default: %(default)s]")
+        general_group.add_argument("--coverageBatchSize", default=0, type=int, metavar="N",
+            help="Collect mapped reads into batches of N reads and update coverage/counts with vectorized NumPy operations [default: not used]")
+        general_group.add_argument("--coverageMemmap", action="store_true",
+            help="Keep coverage arrays in a memory-mapped file in the node-local temp dir instead of in RAM, for references too large to fit in memory [default: %(default)s].")
+        general_group.add_argument("--coverageAdaptiveDtype", action="store_true",
+            help="Store coverage as 16 bit integers and promote contigs to 32 or 64 bit integers only when their coverage could overflow, saving memory for shallow samples [default: %(default)s].")
+        general_group.add_argument("--referenceIndexCache", default="", metavar="DIR",
+            help="Cache the parsed contig lengths and annotated regions of each reference in DIR (e.g. on a shared file system), so that tasks sharing a reference load them instead of parsing the reference again [default: not used]")
+        general_group.add_argument("--referenceDBCache", default="", metavar="DIR",
+            help="Extract reference DB tarballs once per node into this node-local cache directory and link them into the task directories, instead of copying and extracting them for every task [default: not used]")
+        general_group.add_argument("--referenceDBCacheQuota", default=0, type=int, metavar="GB",
+            help="Maximum size of the reference DB cache in GiB, least recently used DBs that are not in use are evicted to stay within it [default: no limit]")
+        general_group.add_argument("--longestTasksFirst", action="store_true",
+            help="Queue the tasks with the longest estimated runtime first instead of in manifest order, so that a few large reads files do not start last. Runtimes are estimated from the sizes of the reads and reference files and from --runtimeHistory [default: %(default)s]")
+        general_group.add_argument("--runtimeHistory", nargs="+", default=[], metavar="SUMMARY",
+            help="run_summary.txt files of earlier runs, whose task runtimes are used to estimate the runtimes with --longestTasksFirst [default: not used]")
         return parser
     
     @staticmethod
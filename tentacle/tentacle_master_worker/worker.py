@@ -16,6 +16,8 @@
 # 
 from ..tentacle_core import TentacleCore
 from ..utils import logging_utils
+from ..utils.task_costs import TaskCostModel
+from ..launching.worker_slots import Resources
 import traceback
 
 __all__ = ["TentacleWorker"]
@@ -33,6 +35,28 @@ class TentacleWorker():
     def create_argparser(cls, argv):
         return TentacleCore.create_processing_argparser(argv)
 
+    @classmethod
+    def estimate_task_resources(cls, parsed_args, task, logger):
+        """ Returns the Resources (CPUs, memory) needed to process a task, None if it needs the whole node. """
+        (core_name, files) = task
+        resources = TentacleCore.estimate_task_resources(files, parsed_args, logger)
+        return Resources(*resources) if resources else None
+
+    @classmethod
+    def task_cost_estimator(cls, parsed_args, logger):
+        """ Returns a function estimating the runtime of a task in seconds, see TaskCostModel. """
+        model = TaskCostModel(parsed_args.runtimeHistory, logger)
+        def estimate_task_cost(task):
+            (core_name, files) = task
+            return model.cost(files.reads, files.contigs)
+        return estimate_task_cost
+
+    @classmethod
+    def task_locality(cls, task):
+        """ Returns the reference and annotation files of a task, tasks sharing them are run on the same nodes. """
+        (core_name, files) = task
+        return (files.contigs, files.annotations)
+
     def process(self, task):  
         (core_name, files) = task
         processing_logger = self.logger_provider.get_logger(core_name, ["processing"])
@@ -0,0 +1,162 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Reader for BGZF (blocked gzip) files, the compression used by BAM.
+
+A BGZF file is a series of gzip members of at most 64 KiB each, with
+the size of every member in a header extra field. The members can
+therefore be split without decompressing them, and are decompressed in
+parallel on a thread pool (zlib releases the GIL while decompressing).
+The results are waited for in the gevent threadpool, so that other
+greenlets keep running meanwhile.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+from multiprocessing.pool import ThreadPool
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+from gevent_utils import wait_for_result
+
+# Fixed part of a BGZF member header: gzip magic, CM=8 (deflate), FLG=4 (FEXTRA)
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+BGZF_HEADER = struct.Struct("<4sIBBH")
+# Number of members handed to the thread pool at a time
+BLOCKS_PER_CHUNK = 64
+
+def is_bgzf(filename):
+    """ Returns True if the file starts with a BGZF member header. """
+    with open(filename, "rb") as f:
+        return f.read(4) == BGZF_MAGIC
+
+
+def read_blocks(f):
+    """
+    Yields the compressed members of a BGZF stream as strings.
+
+    Raises:
+        BGZFError: if the stream is not valid BGZF.
+    """
+    while True:
+        header = f.read(BGZF_HEADER.size)
+        if not header:
+            return
+        if len(header) < BGZF_HEADER.size:
+            raise BGZFError("Truncated BGZF block header")
+        magic, mtime, xfl, os_, xlen = BGZF_HEADER.unpack(header)
+        if magic != BGZF_MAGIC:
+            raise BGZFError("Not a BGZF block (magic {!r})".format(magic))
+        extra = f.read(xlen)
+        block_size = None
+        position = 0
+        while position < xlen:
+            si1, si2, slen = struct.unpack_from("<BBH", extra, position)
+            if si1 == 66 and si2 == 67:
+                block_size = struct.unpack_from("<H", extra, position+4)[0] + 1
+            position += 4 + slen
+        if block_size is None:
+            raise BGZFError("BGZF block without BC extra field")
+        rest = f.read(block_size - BGZF_HEADER.size - xlen)
+        yield header + extra + rest
+
+
+def decompress_block(block):
+    """ Decompresses a single BGZF member. """
+    xlen = struct.unpack_from("<H", block, 10)[0]
+    # Skip header and extra field, the last 8 bytes are CRC32 and ISIZE.
+    data = zlib.decompress(block[12+xlen:-8], -15)
+    crc, isize = struct.unpack_from("<II", block, len(block)-8)
+    if len(data) != isize:
+        raise BGZFError("BGZF block decompressed to {} bytes, expected {}".format(len(data), isize))
+    return data
+
+
+def iter_decompressed(filename, threads=4):
+    """
+    Yields the decompressed contents of a BGZF file in chunks of
+    BLOCKS_PER_CHUNK members per thread, in file order.
+
+    The next chunk is read from the file while the previous one is
+    being decompressed.
+
+    Input:
+        filename  path to the BGZF file (may be a FIFO).
+        threads   number of decompression threads.
+    """
+    pool = ThreadPool(threads)
+    try:
+        with open(filename, "rb") as f:
+            pending = None
+            chunk = []
+            blocks = read_blocks(f)
+            while True:
+                block = next(blocks, None)
+                if block is not None:
+                    chunk.append(block)
+                    if len(chunk) < BLOCKS_PER_CHUNK * threads:
+                        continue
+                if chunk:
+                    submitted = pool.map_async(decompress_block, chunk, BLOCKS_PER_CHUNK)
+                    chunk = []
+                else:
+                    submitted = None
+                if pending is not None:
+                    yield "".join(wait_for_result(pending))
+                pending = submitted
+                if block is None and pending is None:
+                    return
+    finally:
+        pool.terminate()
+
+
+###############################################
+#    Exceptions
+###############################################
+
+class BGZFError(Exception):
+    """ Raised when a file is not valid BGZF. """
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_iter_decompressed(unittest.TestCase):
+    @staticmethod
+    def _member(data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        extra = struct.pack("<BBHH", 66, 67, 2, BGZF_HEADER.size + 6 + len(deflated) + 8 - 1)
+        header = BGZF_HEADER.pack(BGZF_MAGIC, 0, 0, 255, len(extra))
+        return header + extra + deflated + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+    def test_decompress(self):
+        members = ["read{}\n".format(i) * 1000 for i in range(BLOCKS_PER_CHUNK * 3)]
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write("".join(self._member(data) for data in members))
+            self.assertTrue(is_bgzf(filename))
+            self.assertEqual("".join(iter_decompressed(filename, threads=2)), "".join(members))
+        finally:
+            os.remove(filename)
@@ -1 +1,2 @@
-from iterable_queue import *
\ No newline at end of file
+from iterable_queue import *
+from async_results import *
@@ -0,0 +1,28 @@
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+import gevent
+
+__all__ = ["wait_for_result"]
+
+def wait_for_result(result):
+    """
+    Returns the value of an AsyncResult, waiting for it in a thread of
+    the gevent threadpool so that other greenlets keep running.
+    """
+    if not result.ready():
+        gevent.get_hub().threadpool.apply(result.wait)
+    return result.get()
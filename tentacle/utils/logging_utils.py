@@ -113,6 +113,56 @@ class LoggerProvider(object):
         return create_file_logger(self.logLevel, self.logNoStdout, file_path)
     
     
+__all__.append("HotPathLogger")
+class HotPathLogger(object):
+    """
+    Debug logging for code that runs once per read or alignment.
+
+    The level is checked once, when the HotPathLogger is created, so a
+    debug call costs a single test when DEBUG is off, and loops can test
+    the enabled attribute before building any arguments. Messages take
+    %-style arguments that are only formatted if the message is logged.
+    With every > 1 only every Nth debug message is logged. Everything
+    else is passed on to the wrapped logger, so a HotPathLogger can be
+    used wherever a logger is expected.
+    """
+
+    def __init__(self, logger, every=1):
+        self.logger = logger
+        self.every = max(1, every)
+        self.enabled = logger.isEnabledFor(logging.DEBUG)
+        self.messages = 0
+
+    def debug(self, msg, *args):
+        """ Logs a debug message if it is one of the sampled ones. """
+        if self.enabled:
+            if self.messages % self.every == 0:
+                self.logger.debug(msg, *args)
+            self.messages += 1
+
+    def sample(self, records):
+        """
+        Counts a debug message for each of a chunk of records and returns
+        the positions (in range(records)) of the ones to log.
+        """
+        if not self.enabled:
+            return xrange(0)
+        first = -self.messages % self.every
+        self.messages += records
+        return xrange(first, records, self.every)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
+__all__.append("hot_path_logger")
+def hot_path_logger(logger, options):
+    """ Returns a HotPathLogger for logger that logs every options.logSampleEvery debug message. """
+    if isinstance(logger, HotPathLogger):
+        return logger
+    return HotPathLogger(logger, options.logSampleEvery)
+
+
 __all__.append("get_std_logger")
 _std_logger=None
 def get_std_logger():
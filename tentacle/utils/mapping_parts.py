@@ -0,0 +1,232 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Mapping of the reads in parts, by several concurrent mapper processes.
+
+For mappers that do not scale well with their own threads, the reads
+are split into parts at record boundaries, and one mapper process is
+run per part. The number of processes that run at the same time is
+limited by the number of CPUs and the available memory. The output of
+each part can be parsed as soon as its mapper has finished.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+from collections import deque
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import gevent
+import gevent.monkey
+import gevent.queue
+from gevent.subprocess import Popen
+import psutil
+
+# Bytes copied at a time when writing the parts
+COPY_SIZE = 4 << 20
+
+def part_filename(filename, part):
+    """ Returns the filename of a part of a reads file, keeping the file ending. """
+    root, ext = os.path.splitext(filename)
+    return "{}.part{}{}".format(root, part, ext)
+
+
+def is_record_start(lines, fastq):
+    """
+    Returns True if the first of lines starts a FASTA/FASTQ record.
+
+    A FASTQ quality line can start with '@', so a FASTQ record start is
+    a line starting with '@' that is followed by a sequence line and a
+    line starting with '+'.
+    """
+    if not fastq:
+        return lines[0].startswith(">")
+    return lines[0].startswith("@") and lines[2].startswith("+")
+
+
+def find_record_start(f, position, fastq):
+    """ Returns the offset of the first record that starts at or after position (or end of file). """
+    if position == 0:
+        return 0
+    f.seek(position-1)
+    f.readline()
+    # (offset, line) of the lines needed to recognize a record start
+    window = []
+    while True:
+        offset = f.tell()
+        window.append((offset, f.readline()))
+        if fastq and len(window) < 3:
+            continue
+        first_offset, first_line = window[0]
+        if not first_line or is_record_start([line for _, line in window], fastq):
+            return first_offset
+        del window[0]
+
+
+def split_reads(filename, parts, logger):
+    """
+    Splits a FASTA/FASTQ reads file into parts of roughly equal size,
+    at record boundaries.
+
+    Input:
+        filename  the reads file (four-line FASTQ or FASTA).
+        parts     the number of parts to create (at most).
+        logger    a logger object.
+    Output:
+        filenames list of the filenames of the parts.
+    """
+    size = os.path.getsize(filename)
+    filenames = []
+    with open(filename, "rb") as f:
+        fastq = f.read(1) == "@"
+        boundaries = [0]
+        for part in xrange(1, parts):
+            boundary = find_record_start(f, size * part // parts, fastq)
+            if boundary > boundaries[-1] and boundary < size:
+                boundaries.append(boundary)
+        boundaries.append(size)
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            part = part_filename(filename, len(filenames))
+            f.seek(start)
+            remaining = end - start
+            with open(part, "wb") as part_file:
+                while remaining > 0:
+                    block = f.read(min(COPY_SIZE, remaining))
+                    part_file.write(block)
+                    remaining -= len(block)
+            filenames.append(part)
+    logger.debug("Split {} into {} parts".format(filename, len(filenames)))
+    return filenames
+
+
+def process_limit(processes, memory_per_process, logger):
+    """
+    Returns the number of mapper processes that can run at the same
+    time: at most one per CPU, and only as many as fit in the available
+    memory.
+
+    Input:
+        processes           the number of processes wanted.
+        memory_per_process  estimated memory use of one process in bytes (0 if unknown).
+        logger              a logger object.
+    """
+    limit = min(processes, psutil.NUM_CPUS)
+    if memory_per_process:
+        available = psutil.virtual_memory().available
+        limit = min(limit, max(1, available // memory_per_process))
+        logger.debug("{} bytes of memory available, {} bytes estimated per mapper process".format(available, memory_per_process))
+    if limit < processes:
+        logger.info("Running at most {} of {} mapper processes at a time".format(limit, processes))
+    return limit
+
+
+class MappingParts(object):
+    """
+    Mapper processes that each map one part of the reads.
+
+    The processes are started with gevent.subprocess and waited for in
+    greenlets, since the subprocess module is patched by gevent in the
+    workers anyway. The mapper stdout/stderr go to files next to the
+    output files.
+    """
+
+    def __init__(self, mapper_calls, concurrency, logger):
+        """
+        Starts the first concurrency mapper processes.
+
+        Input:
+            mapper_calls  list of (mapper_call, output_filename), one per part.
+            concurrency   maximum number of mapper processes running at a time.
+            logger        a logger object.
+        """
+        self.logger = logger
+        self.parts = len(mapper_calls)
+        self.pending = deque(mapper_calls)
+        self.concurrency = concurrency
+        self.running = {}
+        self.finished = gevent.queue.Queue()
+        self._start_processes()
+
+
+    def _start_processes(self):
+        while self.pending and len(self.running) < self.concurrency:
+            mapper_call, output_filename = self.pending.popleft()
+            self.logger.debug("Mapper call: {0}".format(' '.join(mapper_call)))
+            with open(output_filename+".stdout", "w") as mapper_stdout, open(output_filename+".stderr", "w") as mapper_stderr:
+                process = Popen(mapper_call,
+                                stdout=mapper_stdout,
+                                stderr=mapper_stderr,
+                                cwd=os.path.dirname(output_filename))
+            self.running[output_filename] = process
+            gevent.spawn(self._wait, output_filename, process)
+
+
+    def _wait(self, output_filename, process):
+        process.wait()
+        self.finished.put(output_filename)
+
+
+    def completed(self):
+        """
+        Yields (output_filename, returncode, stdout, stderr) for each part
+        as its mapper finishes, starting the mappers of the next parts.
+        """
+        while self.running:
+            output_filename = self.finished.get()
+            process = self.running.pop(output_filename)
+            self._start_processes()
+            with open(output_filename+".stdout") as mapper_stdout, open(output_filename+".stderr") as mapper_stderr:
+                yield (output_filename, process.returncode, mapper_stdout.read(), mapper_stderr.read())
+
+
+    def terminate(self):
+        """ Stops the mappers that are still running and drops the parts not started. """
+        self.pending.clear()
+        for process in self.running.values():
+            try:
+                process.terminate()
+            except OSError:
+                pass
+        for process in self.running.values():
+            process.wait()
+        self.running = {}
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_MappingParts(unittest.TestCase):
+    def setUp(self):
+        # As in the workers, see launching.launchers
+        gevent.monkey.patch_subprocess()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parts_complete(self):
+        calls = [(["sh", "-c", "echo part{}; exit {}".format(part, part)], os.path.join(self.tmpdir, "out{}".format(part)))
+                 for part in range(2)]
+        parts = MappingParts(calls, 1, logging.getLogger(__name__))
+        completed = gevent.with_timeout(10, list, parts.completed())
+        self.assertEqual(sorted(completed), [(calls[0][1], 0, "part0\n", ""), (calls[1][1], 1, "part1\n", "")])
@@ -0,0 +1,220 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Streaming of mapper output through a named pipe (FIFO).
+
+The mapper writes its output to a FIFO at the place of its normal
+output file, so that the output parser can consume the mapping results
+while the mapper is still running and the results never have to be
+written to local disk. Optionally the stream is tee'd into a gzipped
+copy of the mapping results.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+from time import sleep
+import errno
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import gevent
+import gevent.monkey
+from gevent.subprocess import Popen
+
+# Size of the chunks copied from the mapper FIFO when tee'ing the stream.
+TEE_CHUNK_SIZE = 1 << 20
+# Seconds between checks whether the mapper has exited
+EXIT_POLL_INTERVAL = 0.1
+
+def process_exited(pid):
+    """
+    Returns True if the process has exited, i.e. it is a zombie or gone.
+
+    Unlike waiting for the process, this does not reap it, so it can be
+    used from a thread while gevent's child watcher reaps the process.
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat_file:
+            stat = stat_file.read()
+    except IOError:
+        return True
+    # The state follows the parenthesized command name
+    return stat[stat.rindex(")")+2] == "Z"
+
+
+class MappingStream(object):
+    """
+    A mapper process that writes its output into a FIFO.
+
+    The output parser blocks the whole process while it reads the FIFO,
+    so the FIFO is served by separate threads. The mapper is started with
+    gevent.subprocess (the subprocess module is patched by gevent in the
+    workers anyway) and only waited for from greenlets; the threads poll
+    whether it has exited without reaping it.
+    """
+
+    def __init__(self, mapper_call, output_filename, logger, copy_filename=None):
+        """
+        Creates the FIFO(s) and starts the mapper.
+
+        Input:
+            mapper_call      Popen-style list with the mapper call.
+            output_filename  output filename of the mapper, a FIFO is created here.
+            logger           a logger object.
+            copy_filename    if given, the stream is also written to this
+                             gzipped file.
+        """
+        self.logger = logger
+        self.output_filename = output_filename
+        self.copy_filename = copy_filename
+        self.stdout_filename = output_filename+".stdout"
+        self.stderr_filename = output_filename+".stderr"
+        self.consumer_done = threading.Event()
+        self.tee_error = None
+
+        os.mkfifo(output_filename)
+        if copy_filename:
+            self.filename = output_filename+".stream"
+            os.mkfifo(self.filename)
+            logger.debug("Streaming mapper output through {}, saving a copy to {}".format(self.filename, copy_filename))
+        else:
+            self.filename = output_filename
+            logger.debug("Streaming mapper output through {}".format(self.filename))
+
+        # Mapper stdout/stderr go to files, nobody reads pipes until the mapper is done.
+        with open(self.stdout_filename, "w") as mapper_stdout, open(self.stderr_filename, "w") as mapper_stderr:
+            self.process = Popen(mapper_call,
+                                 stdout=mapper_stdout,
+                                 stderr=mapper_stderr,
+                                 cwd=os.path.dirname(output_filename))
+
+        self.threads = [threading.Thread(target=self._unblock_reader_on_exit)]
+        if copy_filename:
+            self.threads.append(threading.Thread(target=self._tee))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+
+    def _unblock_reader_on_exit(self):
+        """
+        Makes sure that the reader of the mapper FIFO sees end of file.
+
+        If the mapper exits without ever opening its output file, the
+        reader would otherwise wait forever in open() for a writer.
+        """
+        while not process_exited(self.process.pid):
+            if self.consumer_done.is_set():
+                return
+            sleep(EXIT_POLL_INTERVAL)
+        while not self.consumer_done.is_set():
+            try:
+                fd = os.open(self.output_filename, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # No reader has opened the FIFO yet
+                sleep(0.1)
+            else:
+                os.close(fd)
+                return
+
+
+    def _tee(self):
+        """
+        Copies the mapper FIFO into the parser FIFO and a gzipped copy.
+        """
+        parser_fifo = None
+        try:
+            with open(self.output_filename, "rb") as mapper_fifo:
+                parser_fifo = open(self.filename, "wb")
+                copy = gzip.open(self.copy_filename, "wb")
+                try:
+                    while True:
+                        chunk = mapper_fifo.read(TEE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        parser_fifo.write(chunk)
+                        copy.write(chunk)
+                finally:
+                    copy.close()
+        except Exception, e:
+            self.tee_error = e
+        finally:
+            self.consumer_done.set()
+            if parser_fifo is None:
+                # Give the parser an end of file
+                parser_fifo = open(self.filename, "wb")
+            parser_fifo.close()
+
+
+    def wait(self):
+        """
+        Waits for the mapper to finish, call after consuming the stream.
+
+        Returns:
+            (returncode, stdout, stderr) of the mapper.
+        Raises:
+            IOError: if the gzipped copy of the stream could not be written.
+        """
+        self.consumer_done.set()
+        self.process.wait()
+        for thread in self.threads:
+            thread.join()
+        if self.tee_error is not None:
+            raise self.tee_error
+        with open(self.stdout_filename) as mapper_stdout, open(self.stderr_filename) as mapper_stderr:
+            return (self.process.returncode, mapper_stdout.read(), mapper_stderr.read())
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_MappingStream(unittest.TestCase):
+    def setUp(self):
+        # As in the workers, see launching.launchers
+        gevent.monkey.patch_subprocess()
+        self.tmpdir = tempfile.mkdtemp()
+        self.output_filename = os.path.join(self.tmpdir, "mapped")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _stream(self, command, copy_filename=None):
+        stream = MappingStream(["sh", "-c", command], self.output_filename, logging.getLogger(__name__), copy_filename)
+        with open(stream.filename) as f:
+            output = f.read()
+        return output, gevent.with_timeout(10, stream.wait)
+
+    def test_stream(self):
+        self.assertEqual(self._stream("echo hit > mapped"), ("hit\n", (0, "", "")))
+
+    def test_mapper_never_opens_output(self):
+        self.assertEqual(self._stream("echo failed >&2; exit 3"), ("", (3, "", "failed\n")))
+
+    def test_copy(self):
+        copy_filename = os.path.join(self.tmpdir, "mapped.gz")
+        self.assertEqual(self._stream("echo hit > mapped", copy_filename), ("hit\n", (0, "", "")))
+        self.assertEqual(gzip.open(copy_filename).read(), "hit\n")
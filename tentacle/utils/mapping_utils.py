@@ -24,11 +24,24 @@ import os
 import shutil
 
 from gevent.subprocess import Popen
-#import gevent
+import gevent
 #gevent.monkey.patch_subprocess()
 import psutil
 
 from .. import utils
+from read_source import ReadSource
+
+# Bytes read from a pipeline and written to the reads file at a time
+WRITE_BLOCK_SIZE = 4 << 20
+
+def copy_file(source_file, destination):
+    """
+    Copies a file in a thread of the gevent threadpool, so that other
+    greenlets (e.g. the other staging steps with --parallelStaging)
+    keep running during the copy.
+    """
+    gevent.get_hub().threadpool.apply(shutil.copy, (source_file, destination))
+
 
 def copy_untar_ref_db(source_file, destination, logger):
     """
@@ -41,7 +54,7 @@ def copy_untar_ref_db(source_file, destination, logger):
     if source_file.lower().endswith((".tar.gz", ".tar", ".tgz")):
         logger.info("It appears reference DB '%s' is in tar/gz format", source_file)
         logger.info("Extracting database tarball...")
-        shutil.copy(source_file, destination)
+        copy_file(source_file, destination)
         tar = Popen(tar_call, stdout=PIPE, stderr=PIPE, cwd=workdir)
         logger.debug("tar call:{}".format(tar_call))
         tar_stream_data = tar.communicate()
@@ -54,7 +67,7 @@ def copy_untar_ref_db(source_file, destination, logger):
     elif source_file.lower().endswith((".gz")):
         logger.info("It appears reference DB '%s' is in gz format", source_file)
         logger.info("Gunzipping database file...")
-        shutil.copy(source_file, destination)
+        copy_file(source_file, destination)
         gunzip_call = [utils.resolve_executable("gunzip"), source_file]
         gunzip = Popen(gunzip_call, stdout=PIPE, stderr=PIPE, cwd=workdir)
         logger.debug("gunzip call:{}".format(tar_call))
@@ -98,7 +111,7 @@ def gunzip_copy(source_file, destination, logger):
     else: # It is probably not compressed (at least not with gzip)
         try:
             logger.info("Copying %s to node...", source_file)
-            shutil.copy(source_file, destination)
+            copy_file(source_file, destination)
             logger.info("Successfully copied %s to node.", source_file)
         except OSError, message:
             logger.error("File copy error: %s", message)
@@ -106,56 +119,39 @@ def gunzip_copy(source_file, destination, logger):
     return destination 
 
 
-def uncompress_into_Popen(filename, logger):
+def open_reads(filename, threads, logger):
     """
-    Determine filetype based on file name ending and start a Popen 
-    object with gunzip stream output, otherwise cat into a pipe.
+    Opens a reads file as a ReadSource that decompresses gzipped
+    files in-process, BGZF files using threads threads.
     """
-    
-    if filename.lower().endswith((".gz")):
-        logger.debug("File %s seems gzipped, uncompressing.", filename)
-        gunzip_call = [utils.resolve_executable("gunzip"), "-c", filename]
-        uncompressed_data = Popen(gunzip_call, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+    source = ReadSource(filename, threads)
+    if source.compression:
+        logger.debug("File %s seems gzipped (%s), uncompressing.", filename, source.compression)
     else:
         logger.debug("File %s does not seem gzipped.", filename)
-        cat_call = [utils.resolve_executable("cat"), filename]
-        uncompressed_data = Popen(cat_call, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    return uncompressed_data
-
-
-def create_new_pipe(firstchar, source, logger):
-    """
-    Creates a new source pipe from a string and a Popen object.
-    Inserts firstchar into the new stream and then appends the content
-    of source via external program 'cat'.
-    """
-
-    new_source = Popen([r"(printf '\x%02x' && cat)" % ord(firstchar)], 
-                       shell=True, stdin=source.stdout, stdout=PIPE)
-    return new_source
+    return source
 
 
 def determine_format(source, logger):
     """
-    Reads the first byte of the stream to determine file format
-    (FASTA or FASTQ) and returns a new pipe with the data along
-    with a format description (True for FASTQ, False for FASTA).
+    Peeks at the first byte of a ReadSource to determine file format
+    (FASTA or FASTQ) and returns the source along with a format
+    description (True for FASTQ, False for FASTA).
     """
 
-    firstchar = source.stdout.read(1)
+    firstchar = source.peek(1)
     if firstchar == "@":
         logger.info("Reads appear to be in FASTQ format.")
         fastq = True
-        new_source = create_new_pipe(firstchar, source, logger)
     elif firstchar == ">":
         logger.info("Reads appear to be in FASTA format, cannot perform quality control.")
         fastq = False
-        new_source = create_new_pipe(firstchar, source, logger)
     else:
         logger.error("Reads file not in FASTQ or FASTA format")
         raise FileFormatError("Reads file not in FASTQ or FASTA format")
 
-    return (new_source, fastq)
+    return (source, fastq)
 
 
 def filtered_call(logger, source, program, arguments):
@@ -164,7 +160,9 @@ def filtered_call(logger, source, program, arguments):
     Calls PROGRAM with OPTIONS given as keyword arguments to this function
     which are supplied as command line options to the PROGRAM.
     The function assumes the PROGRAM takes the SOURCE as input on stdin
-    and returns its output on stdout.
+    and returns its output on stdout. SOURCE is either a ReadSource,
+    which is fed to the program from a greenlet, or the Popen object
+    of the previous program in the pipeline.
     """
 
     filter_call = [utils.resolve_executable(program)]
@@ -172,23 +170,36 @@ def filtered_call(logger, source, program, arguments):
     filter_call.extend(args)
 
     logger.debug("{} call: {}".format(program, ' '.join(filter_call)))
-    result = Popen(filter_call, stdin=source.stdout, stdout=PIPE, stderr=PIPE)
+    # close_fds keeps later programs in the pipeline from inheriting
+    # the write end of the first program's stdin, which would keep it
+    # from seeing the end of the reads.
+    if isinstance(source, ReadSource):
+        result = Popen(filter_call, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
+        source.feed(result)
+    else:
+        result = Popen(filter_call, stdin=source.stdout, stdout=PIPE, stderr=PIPE, close_fds=True)
     return result
 
 
 def write_reads(source, destination, logger):
     """
-    Takes a Popen object and writes its content to file.
+    Writes the contents of a ReadSource, or the output of the last
+    Popen object of a pipeline, to file in large blocks. Returns the
+    number of bytes written.
     """
 
-    # TODO: Create a thread that writes the source.stdout to a file
-    # instead.
-    destination_file = open(destination, "w")
-    write = Popen([utils.resolve_executable("cat")], stdin=source.stdout, stdout=destination_file)
-    return write
-    
+    if isinstance(source, ReadSource):
+        blocks = source
+    else:
+        blocks = iter(lambda: source.stdout.read(WRITE_BLOCK_SIZE), "")
+    written = 0
+    with open(destination, "wb", WRITE_BLOCK_SIZE) as destination_file:
+        for block in blocks:
+            destination_file.write(block)
+            written += len(block)
+    logger.debug("Wrote {} bytes of reads to {}".format(written, destination))
+    return written
 
-        
 
 def filter_human_reads_bowtie2(reads, options, logger):
     """
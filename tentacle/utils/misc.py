@@ -14,7 +14,10 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # 
+import hashlib
 import os
+import tempfile
+import unittest
 
 __all__ = list()
 
@@ -58,5 +61,65 @@ def assert_file_exists(fileDesc, fileName):
         raise FileNotFound(fileName)
 
 
+__all__.append("file_checksum")
+# Files up to this size are hashed in full, larger files are hashed from
+# SAMPLE_COUNT evenly spaced blocks of SAMPLE_SIZE bytes (and their size,
+# modification time and inode).
+FULL_HASH_LIMIT = 64 << 20
+SAMPLE_COUNT = 64
+SAMPLE_SIZE = 1 << 20
+def file_checksum(filename):
+    """
+    Returns a SHA-1 hex digest identifying the contents of a file.
+
+    Small files are hashed in full, so copies of a small file get the
+    same checksum. Large files (e.g. multi-GB references) are identified
+    by their size, modification time and inode and a sample of blocks
+    spread over the file, so that computing the checksum takes well
+    under a second. The sample alone would miss changes between the
+    blocks, the modification time and inode change with any rewrite of
+    the file, so a changed file is never taken for the old one.
+    """
+    stat = os.stat(filename)
+    size = stat.st_size
+    digest = hashlib.sha1(str(size))
+    with open(filename, "rb") as f:
+        if size <= FULL_HASH_LIMIT:
+            for block in iter(lambda: f.read(SAMPLE_SIZE), ""):
+                digest.update(block)
+        else:
+            digest.update("{!r}:{}".format(stat.st_mtime, stat.st_ino))
+            step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+            for sample in xrange(SAMPLE_COUNT):
+                f.seek(sample * step)
+                digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
 #def call(o, arguments):
 #    o.__call__(*arguments.get('args',list()), **arguments.get('kwargs',dict()))
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_file_checksum(unittest.TestCase):
+    def test_large_file_changed_between_samples(self):
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.seek(FULL_HASH_LIMIT)
+                f.write("A")
+            os.utime(filename, (1000000000, 1000000000))
+            checksum = file_checksum(filename)
+            self.assertEqual(file_checksum(filename), checksum)
+            # Rewrite a byte between the first two sampled blocks
+            with open(filename, "r+b") as f:
+                f.seek(SAMPLE_SIZE + 100)
+                f.write("C")
+            os.utime(filename, (1000000001, 1000000001))
+            self.assertNotEqual(file_checksum(filename), checksum)
+        finally:
+            os.remove(filename)
@@ -22,6 +22,7 @@
 from sys import argv, exit, path
 from os.path import join, abspath, dirname
 from datetime import datetime
+import re
 
 def compute_runtime(start_time, end_time):
     """ Computes the time difference between two string representations of datetime objects."""
@@ -30,6 +31,43 @@ def compute_runtime(start_time, end_time):
     etime = datetime.strptime(end_time, time_format)
     return etime - stime
 
+def format_job_summary(job):
+    """ Returns the summary of a job, see write_jobs_summary. """
+    # Convenience
+    basename = job["description"][0]
+    attempts = job["attempts"]
+    start_time = job["start_time"]
+    end_time = job["end_time"]
+    worker_name = job["worker_name"]
+    result = job["result"]
+    reads_file = job["description"][1][1] 
+    reference_file = job["description"][1][0]
+
+    jobinfo = [] 
+    jobinfo.append("Job: {}".format(basename))
+    jobinfo.append("  Filename: {}".format(reads_file))
+    jobinfo.append("  Reference: {}".format(reference_file))
+    if start_time:
+        jobinfo.append("  Started:   {}".format(start_time))
+        if end_time:
+            jobinfo.append("  Completed: {}".format(end_time))
+            jobinfo.append("  Runtime:               {}".format(compute_runtime(start_time, end_time)))
+            jobinfo.append("  Completed by worker: {}.".format(worker_name))
+        elif len(attempts) > 0:
+            jobinfo.append("  Incomplete. ERROR(S).")
+            jobinfo.append("  Retried {} times.".format(len(attempts)))
+        else:
+            jobinfo.append("  Incomplete.")
+            jobinfo.append("  Run by {}.".format(worker_name))
+    elif len(attempts) > 0:
+        jobinfo.append("  Incomplete. ERROR(S).")
+        jobinfo.append("  Retried {} times.".format(len(attempts)))
+    else:
+        jobinfo.append("  Not started.")
+
+    jobinfo.append("\n") #The final newline after each job listing
+    return '\n'.join(jobinfo)
+
 def write_jobs_summary(job_descriptions, filename):
     """ Writes status of all jobs in the list of currently registered jobs.
 
@@ -53,38 +91,69 @@ def write_jobs_summary(job_descriptions, filename):
 
         printouts = 0 
         for job in job_descriptions[0]:
-            # Convenience
-            basename = job["description"][0]
-            attempts = job["attempts"]
-            start_time = job["start_time"]
-            end_time = job["end_time"]
-            worker_name = job["worker_name"]
-            result = job["result"]
-            reads_file = job["description"][1][1] 
-
-            jobinfo = [] 
-            jobinfo.append("Job: {}".format(basename))
-            jobinfo.append("  Filename: {}".format(reads_file))
-            if start_time:
-                jobinfo.append("  Started:   {}".format(start_time))
-                if end_time:
-                    jobinfo.append("  Completed: {}".format(end_time))
-                    jobinfo.append("  Runtime:               {}".format(compute_runtime(start_time, end_time)))
-                    jobinfo.append("  Completed by worker: {}.".format(worker_name))
-                elif len(attempts) > 0:
-                    jobinfo.append("  Incomplete. ERROR(S).")
-                    jobinfo.append("  Retried {} times.".format(len(attempts)))
-                else:
-                    jobinfo.append("  Incomplete.")
-                    jobinfo.append("  Run by {}.".format(worker_name))
-            elif len(attempts) > 0:
-                jobinfo.append("  Incomplete. ERROR(S).")
-                jobinfo.append("  Retried {} times.".format(len(attempts)))
-            else:
-                jobinfo.append("  Not started.")
-
-            jobinfo.append("\n") #The final newline after each job listing
-            file.write('\n'.join(jobinfo))
+            file.write(format_job_summary(job))
             printouts+=1
         file.write("-------------------------------------------------------------------------------------\n")
         file.write("{}: Listed {} jobs\n".format(datetime.now(), printouts))
+
+
+def start_jobs_summary(filename):
+    """ Starts a summary that jobs are appended to as they complete, see append_job_summary. """
+    with open(filename, "w") as file:
+        file.write("{}: Listing jobs as they complete.\n".format(datetime.now()))
+        file.write("-------------------------------------------------------------------------------------\n")
+
+def append_job_summary(job, filename):
+    """ Appends the summary of a completed job (a dictionary, see write_jobs_summary). """
+    with open(filename, "a") as file:
+        file.write(format_job_summary(job))
+
+def finish_jobs_summary(filename, count):
+    """ Ends a summary started with start_jobs_summary. """
+    with open(filename, "a") as file:
+        file.write("-------------------------------------------------------------------------------------\n")
+        file.write("{}: Listed {} jobs\n".format(datetime.now(), count))
+
+def start_results_index(filename):
+    """ Starts a tab separated index of the results files, see append_results_index. """
+    with open(filename, "w") as file:
+        file.write("\t".join(["job", "status", "reads", "results", "runtime"]) + "\n")
+
+def append_results_index(job, filename):
+    """ Appends the results file of a job (a dictionary, see write_jobs_summary) to a results index. """
+    if job["end_time"]:
+        status, runtime = "completed", compute_runtime(job["start_time"], job["end_time"])
+    else:
+        status, runtime = "failed", ""
+    with open(filename, "a") as file:
+        file.write("\t".join(str(field) for field in [job["description"][0], status, job["description"][1][1], job["description"][1][3], runtime]) + "\n")
+
+
+def parse_runtime(runtime):
+    """ Parses the string representation of a timedelta (e.g. '1 day, 2:03:04.5') into seconds. """
+    match = re.match(r"(?:(-?\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d*)?)$", runtime.strip())
+    if not match:
+        raise ValueError("Cannot parse runtime '{}'".format(runtime))
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0)*86400 + int(hours)*3600 + int(minutes)*60 + float(seconds)
+
+def read_jobs_runtimes(filename):
+    """ Reads the runtimes of the completed jobs in a summary written by write_jobs_summary.
+
+    Returns a list of (reads_file, reference_file, seconds) tuples, the
+    reference_file is None for summaries written before it was listed.
+    """
+    runtimes = []
+    reads_file = reference_file = None
+    with open(filename) as file:
+        for line in file:
+            field, _, value = line.strip().partition(": ")
+            if field == "Job":
+                reads_file = reference_file = None
+            elif field == "Filename":
+                reads_file = value.strip()
+            elif field == "Reference":
+                reference_file = value.strip()
+            elif field == "Runtime" and reads_file:
+                runtimes.append((reads_file, reference_file, parse_runtime(value)))
+    return runtimes
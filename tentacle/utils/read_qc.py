@@ -0,0 +1,395 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Single pass FASTQ quality control and FASTA conversion.
+
+Replaces the fastq_quality_filter | fastq_quality_trimmer | seqtk seq -A
+pipeline with vectorized NumPy operations on chunks of complete FASTQ
+records, using the same rules as the FASTX-Toolkit programs:
+
+ * filter: a read is kept if at least min_proportion percent of its
+   bases have a quality of at least min_quality,
+ * trim: bases with a quality below threshold are removed from the 3'
+   end, and reads shorter than min_length after trimming are discarded,
+ * convert: the remaining reads are written as FASTA (header line with
+   '>' instead of '@', and the sequence on one line).
+
+The filtering statistics are reported in the same format as the -v
+output of the FASTX-Toolkit programs. Records must be four lines each
+(no line-wrapped sequences), as required by the FASTX-Toolkit.
+
+Each chunk is processed independently by process_fastq_chunk, and
+prepare_fastq can process the chunks in a pool of worker processes.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+from collections import deque, namedtuple
+from multiprocessing import Pool
+from time import time
+import unittest
+import numpy as np
+from gevent_utils import wait_for_result
+
+NEWLINE = ord("\n")
+HEADER_CHAR = ord("@")
+PLUS_CHAR = ord("+")
+# Bytes written to the prepared reads file at a time
+WRITE_BUFFER_SIZE = 4 << 20
+# Chunks handed to each worker process at a time, more chunks keep the
+# processes busy while chunks are read and written, fewer limit memory use.
+CHUNKS_PER_PROCESS = 2
+
+# Quality thresholds are stored as quality characters, i.e. with the
+# quality offset added.
+QCSettings = namedtuple("QCSettings", ["quality_control", "min_quality", "min_proportion",
+                                       "threshold", "min_length", "fasta"])
+
+def qc_settings(options, fasta):
+    """
+    Creates QCSettings from the Tentacle command line options.
+
+    Input:
+        options  options namespace, with qualityControl, fastqMinQ,
+                 fastqProportion, fastqThreshold, fastqMinLength and
+                 fastqQualityOffset.
+        fasta    True to convert the reads to FASTA.
+    """
+    offset = options.fastqQualityOffset
+    return QCSettings(quality_control=options.qualityControl,
+                      min_quality=options.fastqMinQ + offset,
+                      min_proportion=options.fastqProportion,
+                      threshold=options.fastqThreshold + offset,
+                      min_length=options.fastqMinLength,
+                      fasta=fasta)
+
+
+class QCStatistics(object):
+    """
+    Number of reads input to, and output from, the filtering and
+    trimming steps, and the time spent on each chunk of reads.
+    """
+
+    def __init__(self, processes=1):
+        self.input = 0
+        self.filtered = 0
+        self.trimmed = 0
+        self.processes = processes
+        self.chunk_times = []
+
+    def add(self, counts, chunk_time=None):
+        """ Adds the (input, filtered, trimmed) counts of a chunk, and the time it took. """
+        reads, filtered, trimmed = counts
+        self.input += reads
+        self.filtered += filtered
+        self.trimmed += trimmed
+        if chunk_time is not None:
+            self.chunk_times.append(chunk_time)
+
+    def timing_report(self):
+        """ Returns a one line summary of the time spent per chunk, or "" if no chunks were processed. """
+        if not self.chunk_times:
+            return ""
+        return "chunks: {}, processes: {}, min/mean/max per chunk: {:.3f}/{:.3f}/{:.3f} s, total: {:.3f} s".format(
+                len(self.chunk_times), self.processes, min(self.chunk_times),
+                sum(self.chunk_times) / len(self.chunk_times), max(self.chunk_times),
+                sum(self.chunk_times))
+
+    def filter_report(self, options):
+        """ Returns the statistics of the filtering step, formatted as by fastq_quality_filter -v. """
+        return ("Quality cut-off: {}\n"
+                "Minimum percentage: {}\n"
+                "Input: {} reads.\n"
+                "Output: {} reads.\n"
+                "discarded {} ({}%) low-quality reads.\n").format(
+                options.fastqMinQ, options.fastqProportion, self.input, self.filtered,
+                self.input - self.filtered, percentage(self.input - self.filtered, self.input))
+
+    def trim_report(self, options):
+        """ Returns the statistics of the trimming step, formatted as by fastq_quality_trimmer -v. """
+        return ("Minimum Quality Threshold: {}\n"
+                "Minimum Length: {}\n"
+                "Input: {} reads.\n"
+                "Output: {} reads.\n"
+                "discarded {} ({}%) too-short reads.\n").format(
+                options.fastqThreshold, options.fastqMinLength, self.filtered, self.trimmed,
+                self.filtered - self.trimmed, percentage(self.filtered - self.trimmed, self.filtered))
+
+
+def percentage(part, total):
+    """ Integer percentage, as printed by the FASTX-Toolkit. """
+    if not total:
+        return 0
+    return part * 100 // total
+
+
+def iter_record_chunks(blocks):
+    """
+    Yields chunks of complete FASTQ records (sets of four lines) from
+    an iterable of blocks of FASTQ data.
+    """
+    rest = ""
+    for block in blocks:
+        data = rest + block
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == NEWLINE)
+        complete_lines = len(newlines) - len(newlines) % 4
+        if not complete_lines:
+            rest = data
+            continue
+        end = newlines[complete_lines-1] + 1
+        yield data[:end]
+        rest = data[end:]
+    # Trailing empty lines are ignored, a missing final newline is added
+    rest = rest.rstrip("\n")
+    if rest:
+        yield rest + "\n"
+
+
+def join_ranges(data, starts, ends):
+    """
+    Returns the concatenation of data[starts[i]:ends[i]] for ranges in
+    increasing order, merging adjacent ranges first.
+    """
+    if not len(starts):
+        return ""
+    separate = starts[1:] != ends[:-1]
+    starts = starts[np.concatenate(([True], separate))]
+    ends = ends[np.concatenate((separate, [True]))]
+    return "".join([data[start:end] for start, end in zip(starts.tolist(), ends.tolist())])
+
+
+def interleave(*columns):
+    """ Returns the elements of equally long arrays interleaved: a[0], b[0], a[1], b[1], ... """
+    return np.column_stack(columns).ravel()
+
+
+def process_fastq_chunk(chunk, settings):
+    """
+    Filters, trims and optionally converts a chunk of complete FASTQ
+    records.
+
+    Input:
+        chunk     string with complete four-line FASTQ records.
+        settings  QCSettings.
+    Output:
+        output    string with the records that pass, as FASTQ or FASTA.
+        counts    tuple with the number of (input, filtered, trimmed) reads.
+    Raises:
+        FastqFormatError  if the chunk is not four-line FASTQ.
+    """
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    newlines = np.flatnonzero(data == NEWLINE)
+    if len(newlines) % 4 or (len(chunk) and chunk[-1] != "\n"):
+        raise FastqFormatError("Incomplete FASTQ record at the end of the reads")
+    line_ends = newlines.reshape(-1, 4)
+    line_starts = np.empty_like(line_ends)
+    line_starts.flat[0] = 0
+    line_starts.flat[1:] = newlines[:-1] + 1
+    header_starts, seq_starts, plus_starts, qual_starts = line_starts.T
+    header_ends, seq_ends, plus_ends, qual_ends = line_ends.T
+    reads = len(header_starts)
+    if (data[header_starts] != HEADER_CHAR).any() or (data[plus_starts] != PLUS_CHAR).any():
+        raise FastqFormatError("Reads are not in four-line FASTQ format")
+    lengths = seq_ends - seq_starts
+    if (qual_ends - qual_starts != lengths).any():
+        raise FastqFormatError("Sequence and quality lengths differ in FASTQ records")
+
+    trimmed_lengths = lengths
+    if settings.quality_control and reads:
+        # Number of bases with at least min_quality in each read. The
+        # newline after an empty quality line is never counted.
+        passing = np.add.reduceat(data >= settings.min_quality,
+                                  interleave(qual_starts, qual_ends), dtype=np.int32)[::2]
+        keep = passing * 100 >= settings.min_proportion * lengths
+        filtered = np.count_nonzero(keep)
+        # Trim low quality bases from the 3' end of the reads that end
+        # with one, the quality characters below the threshold are
+        # stripped from the quality string.
+        low_qualities = "".join(chr(quality) for quality in xrange(min(settings.threshold, 256)))
+        trimmed_lengths = lengths.copy()
+        for read in np.flatnonzero(keep & (data[qual_ends-1] < settings.threshold) & (lengths > 0)).tolist():
+            trimmed_lengths[read] = len(chunk[qual_starts[read]:qual_ends[read]].rstrip(low_qualities))
+        keep &= trimmed_lengths >= settings.min_length
+        trimmed = np.count_nonzero(keep)
+        if trimmed < reads:
+            header_starts = header_starts[keep]
+            seq_starts = seq_starts[keep]
+            seq_ends = seq_ends[keep]
+            qual_starts = qual_starts[keep]
+            qual_ends = qual_ends[keep]
+            lengths = lengths[keep]
+            trimmed_lengths = trimmed_lengths[keep]
+    else:
+        filtered = trimmed = reads
+    counts = (reads, filtered, trimmed)
+
+    untrimmed = (trimmed_lengths == lengths).all()
+    if settings.fasta:
+        # Header line and sequence, and the newline after the sequence.
+        # The headers are the only lines that start with '@'.
+        output = join_ranges(chunk, interleave(header_starts, seq_ends),
+                             interleave(seq_starts + trimmed_lengths, seq_ends + 1))
+        if output:
+            output = ">" + output[1:].replace("\n@", "\n>")
+        return output, counts
+    elif trimmed == reads and untrimmed:
+        return chunk, counts
+    # Header line and sequence, newline and '+' line and quality, and
+    # the newline after the quality
+    return join_ranges(chunk, interleave(header_starts, seq_ends, qual_ends),
+                       interleave(seq_starts + trimmed_lengths,
+                                  qual_starts + trimmed_lengths,
+                                  qual_ends + 1)), counts
+
+
+def timed_process_fastq_chunk(args):
+    """ Runs process_fastq_chunk on a (chunk, settings) tuple and also returns the time it took. """
+    chunk, settings = args
+    chunk_time = time()
+    output, counts = process_fastq_chunk(chunk, settings)
+    return output, counts, time() - chunk_time
+
+
+def prepare_fastq(source, destination, settings, logger, processes=1):
+    """
+    Runs quality control and/or FASTA conversion on FASTQ reads and
+    writes the result to destination.
+
+    With processes > 1 the chunks of records are processed in a pool
+    of worker processes. At most CHUNKS_PER_PROCESS chunks per process
+    are in flight at a time, and the processed chunks are written in
+    their original order.
+
+    Input:
+        source       iterable of blocks of FASTQ data (e.g. a ReadSource).
+        destination  path to the prepared reads file.
+        settings     QCSettings.
+        logger       a logger object.
+        processes    number of processes to use.
+    Output:
+        statistics   QCStatistics.
+    """
+    statistics = QCStatistics(processes)
+    pool = None
+    if processes > 1:
+        pool = Pool(processes)
+    try:
+        with open(destination, "wb", WRITE_BUFFER_SIZE) as destination_file:
+            def write(output, counts, chunk_time):
+                destination_file.write(output)
+                statistics.add(counts, chunk_time)
+                logger.debug("Prepared chunk {} with {} of {} reads in {:.3f} s".format(
+                    len(statistics.chunk_times), counts[2], counts[0], chunk_time))
+
+            pending = deque()
+            for chunk in iter_record_chunks(source):
+                if pool is None:
+                    write(*timed_process_fastq_chunk((chunk, settings)))
+                    continue
+                pending.append(pool.apply_async(timed_process_fastq_chunk, ((chunk, settings),)))
+                while len(pending) >= processes * CHUNKS_PER_PROCESS or (pending and pending[0].ready()):
+                    write(*wait_for_result(pending.popleft()))
+            while pending:
+                write(*wait_for_result(pending.popleft()))
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    logger.debug("Prepared {} of {} reads into {}".format(statistics.trimmed, statistics.input, destination))
+    return statistics
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_process_fastq_chunk(unittest.TestCase):
+    """ The rules of fastq_quality_filter, fastq_quality_trimmer and seqtk seq -A. """
+    offset = 33
+
+    def _settings(self, quality_control=True, min_quality=20, min_proportion=0, threshold=0, min_length=0, fasta=False):
+        return QCSettings(quality_control, min_quality + self.offset, min_proportion,
+                          threshold + self.offset, min_length, fasta)
+
+    def _record(self, name, qualities, length=None):
+        sequence = "ACGT" * (len(qualities) // 4 + 1)
+        return "@{}\n{}\n+\n{}\n".format(name, sequence[:len(qualities) if length is None else length],
+                                        "".join(chr(q + self.offset) for q in qualities)[:length])
+
+    def test_proportion_boundary(self):
+        reads = [self._record("r1", [30, 30, 30, 10]), self._record("r2", [30, 30, 10, 10]),
+                 self._record("r3", [20, 20, 20, 19])]
+        output, counts = process_fastq_chunk("".join(reads), self._settings(min_proportion=75))
+        self.assertEqual(output, reads[0] + reads[2])
+        self.assertEqual(counts, (3, 2, 2))
+        output, counts = process_fastq_chunk("".join(reads), self._settings(min_proportion=76))
+        self.assertEqual((output, counts), ("", (3, 0, 0)))
+
+    def test_trim_to_threshold(self):
+        reads = [self._record("r1", [30, 10, 30, 19, 5]), self._record("r2", [30, 20, 20])]
+        output, counts = process_fastq_chunk("".join(reads), self._settings(threshold=20))
+        self.assertEqual(output, self._record("r1", [30, 10, 30]) + reads[1])
+        self.assertEqual(counts, (2, 2, 2))
+
+    def test_min_length_after_trimming(self):
+        reads = [self._record("r1", [30, 30, 30, 10]), self._record("r2", [30, 30, 10, 10]),
+                 self._record("r3", [10] * 5), self._record("r4", [30, 30])]
+        output, counts = process_fastq_chunk("".join(reads), self._settings(threshold=20, min_length=3))
+        self.assertEqual(output, self._record("r1", [30, 30, 30]))
+        self.assertEqual(counts, (4, 4, 1))
+
+    def test_fasta_conversion(self):
+        # A quality line starting with '@' (31 + 33) is not a header
+        reads = [self._record("r1", [31, 30, 30, 30]), self._record("r2", [31, 31, 10])]
+        output, counts = process_fastq_chunk("".join(reads), self._settings(quality_control=False, fasta=True))
+        self.assertEqual(output, ">r1\nACGT\n>r2\nACG\n")
+        self.assertEqual(counts, (2, 2, 2))
+        output, counts = process_fastq_chunk("".join(reads), self._settings(threshold=20, fasta=True))
+        self.assertEqual(output, ">r1\nACGT\n>r2\nAC\n")
+
+    def test_chunk_counts(self):
+        random = np.random.RandomState(0)
+        settings = self._settings(min_proportion=60, threshold=15, min_length=10)
+        reads = [[int(q) for q in random.randint(2, 41, random.randint(0, 40))] for _ in xrange(500)]
+        chunks = [reads[:1], reads[1:200], reads[200:]]
+        for chunk in chunks:
+            output, counts = process_fastq_chunk("".join(self._record(i, qualities) for i, qualities in enumerate(chunk)), settings)
+            # One read at a time, as the FASTX-Toolkit programs do
+            filtered = [(i, qualities) for i, qualities in enumerate(chunk)
+                        if sum(q >= 20 for q in qualities) * 100 >= 60 * len(qualities)]
+            trimmed = []
+            for i, qualities in filtered:
+                length = len(qualities)
+                while length and qualities[length-1] < 15:
+                    length -= 1
+                if length >= 10:
+                    trimmed.append(self._record(i, qualities, length))
+            self.assertEqual(counts, (len(chunk), len(filtered), len(trimmed)))
+            self.assertEqual(output, "".join(trimmed))
+
+
+
+###############################################
+#    Exceptions
+###############################################
+
+class FastqFormatError(Exception):
+    """ Raised when reads are not in four-line FASTQ format. """
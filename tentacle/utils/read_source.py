@@ -0,0 +1,188 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Streaming, in-process decompression of (gzipped) sequence files.
+
+A ReadSource yields the decompressed contents of a reads file in large
+blocks. Gzip files, including multi-member files, are decompressed with
+zlib in the reading process instead of by a gunzip subprocess, and BGZF
+files can be decompressed by several threads (see bgzf). The first bytes
+can be peeked at to determine the file format without losing them, and
+the contents are written directly to a file or to the stdin of the
+first program of a filtering pipeline.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+import errno
+import zlib
+
+import gevent
+
+import bgzf
+
+# Bytes of decompressed data handed on at a time
+BLOCK_SIZE = 4 << 20
+GZIP_MAGIC = "\x1f\x8b"
+
+def compression(filename):
+    """ Returns the compression of a file: "bgzf", "gzip" or None. """
+    with open(filename, "rb") as f:
+        magic = f.read(len(bgzf.BGZF_MAGIC))
+    if magic == bgzf.BGZF_MAGIC:
+        return "bgzf"
+    elif magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    return None
+
+
+def iter_blocks(filename, block_size=BLOCK_SIZE, threads=1):
+    """
+    Yields the contents of a file in large blocks.
+
+    Gzipped files (including multi-member files such as BGZF) are
+    decompressed on the fly. BGZF files are decompressed by a pool of
+    threads if threads > 1.
+    """
+    if threads > 1 and compression(filename) == "bgzf":
+        for block in bgzf.iter_decompressed(filename, threads):
+            yield block
+        return
+    with open(filename, "rb") as f:
+        data = f.read(max(block_size, len(GZIP_MAGIC)))
+        if not data.startswith(GZIP_MAGIC):
+            while data:
+                yield data
+                data = f.read(block_size)
+            return
+        # Compressed data is read in smaller pieces, it expands several times
+        block_size = max(1, block_size // 4)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while data:
+            block = decompressor.decompress(data)
+            if block:
+                yield block
+            if decompressor.unused_data:
+                # Start of the next gzip member
+                data = decompressor.unused_data
+                block = decompressor.flush()
+                if block:
+                    yield block
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = f.read(block_size)
+        # The last member is complete if a byte past its end is left unused
+        decompressor.decompress("\0")
+        if not decompressor.unused_data:
+            raise zlib.error("Truncated gzip file {}".format(filename))
+        block = decompressor.flush()
+        if block:
+            yield block
+
+
+class ReadSource(object):
+    """ The decompressed contents of a reads file, read once from start to end. """
+
+    def __init__(self, filename, threads=1):
+        """
+        Input:
+            filename  path to the reads file, may be gzipped.
+            threads   number of threads used to decompress BGZF files.
+        """
+        self.filename = filename
+        self.compression = compression(filename)
+        self.blocks = iter_blocks(filename, BLOCK_SIZE, threads)
+        self.head = ""
+        self.feeder = None
+
+
+    def peek(self, size):
+        """ Returns the first size bytes (or fewer, at end of file) without consuming them. """
+        while len(self.head) < size:
+            block = self._next_block()
+            if block is None:
+                break
+            self.head += block
+        return self.head[:size]
+
+
+    def _next_block(self):
+        try:
+            return next(self.blocks, None)
+        except (zlib.error, bgzf.BGZFError), e:
+            raise ReadSourceError("Cannot decompress {}: {}".format(self.filename, e))
+
+
+    def __iter__(self):
+        """ Yields the remaining contents in blocks. """
+        if self.head:
+            head, self.head = self.head, ""
+            yield head
+        while True:
+            block = self._next_block()
+            if block is None:
+                return
+            yield block
+            # Let other greenlets run between blocks
+            gevent.sleep(0)
+
+
+    def write_to(self, f):
+        """ Writes the remaining contents to a file object, returns the number of bytes written. """
+        written = 0
+        for block in self:
+            f.write(block)
+            written += len(block)
+        return written
+
+
+    def feed(self, process):
+        """
+        Writes the contents to the stdin of a (gevent) Popen object in a
+        separate greenlet, and closes it at the end. Call wait() to
+        check that all data was written.
+        """
+        def write():
+            try:
+                self.write_to(process.stdin)
+            except IOError, e:
+                # The process exited before reading all data, its
+                # return code tells why.
+                if e.errno != errno.EPIPE:
+                    raise
+            finally:
+                try:
+                    process.stdin.close()
+                except IOError:
+                    pass
+        self.feeder = gevent.spawn(write)
+
+
+    def wait(self):
+        """ Waits until the contents have been fed to a process, raising any error from doing so. """
+        if self.feeder is not None:
+            self.feeder.get()
+
+
+
+###############################################
+#    Exceptions
+###############################################
+
+class ReadSourceError(Exception):
+    """ Raised when a reads file cannot be decompressed. """
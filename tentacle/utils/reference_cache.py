@@ -0,0 +1,199 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Node-local cache of extracted reference databases.
+
+Every task of a worker used to copy and extract the reference database
+into its own temporary directory. With a ReferenceCache the database is
+extracted once per node into a cache directory named after the checksum
+of the database file, and tasks link the extracted files into their
+temporary directories.
+
+Concurrent tasks, in the same or in different processes, coordinate
+with flock(2) locks on a lock file per cache entry:
+
+ * a task that uses an entry holds a shared lock on it (the lock file
+   is the reference count of the entry, and locks held by a process
+   that dies are released by the kernel),
+ * an entry is extracted while holding an exclusive lock, into a
+   temporary directory that is renamed into place when complete,
+ * an entry is only evicted if an exclusive lock can be taken, i.e. if
+   no task uses it.
+
+When the cache grows beyond its disk quota, the least recently used
+entries that are not in use are evicted before a new entry is extracted.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+
+from gevent import sleep
+
+from misc import file_checksum
+
+# Seconds between attempts to take a lock held by another task. Locks are
+# polled rather than waited for so that other greenlets keep running.
+LOCK_POLL_INTERVAL = 1.0
+CACHE_LOCK = ".cache.lock"
+
+def directory_size(path):
+    """ Returns the total size of the files in a directory tree (not following links). """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def acquire_lock(lock_file, operation):
+    """ Takes a flock on an open file, polling while another task holds a conflicting lock. """
+    while True:
+        try:
+            fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+            return
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        sleep(LOCK_POLL_INTERVAL)
+
+
+class CachedReference(object):
+    """ A reference database in the cache, in use by a task until released. """
+
+    def __init__(self, path, lock_file):
+        self.path = path
+        self.lock_file = lock_file
+
+    def link_into(self, directory):
+        """ Creates symbolic links in directory to all files of the cached reference. """
+        for name in os.listdir(self.path):
+            link = os.path.join(directory, name)
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(self.path, name), link)
+
+    def release(self):
+        """ Releases the reference, after which it may be evicted. """
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class ReferenceCache(object):
+    """ A node-local cache directory of extracted reference databases. """
+
+    def __init__(self, cache_dir, quota, logger):
+        """
+        Input:
+            cache_dir  the cache directory, created if needed.
+            quota      maximum total size of the cache in bytes (0 for no limit).
+            logger     a logger object.
+        """
+        self.cache_dir = cache_dir
+        self.quota = quota
+        self.logger = logger
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+
+    def acquire(self, source_file, extract):
+        """
+        Returns the cached copy of a reference database, extracting it if needed.
+
+        Input:
+            source_file  the reference database file (e.g. a tarball).
+            extract      function extract(source_file, directory) that
+                         copies and extracts source_file into directory.
+        Output:
+            reference    a CachedReference, call its release() method
+                         when the task no longer uses the database.
+        """
+        key = file_checksum(source_file)
+        path = os.path.join(self.cache_dir, key)
+        lock_file = open(path+".lock", "a")
+        try:
+            while True:
+                acquire_lock(lock_file, fcntl.LOCK_SH)
+                if os.path.isdir(path):
+                    # Mark the entry as recently used
+                    os.utime(path, None)
+                    self.logger.info("Using cached reference DB {} for {}".format(path, source_file))
+                    return CachedReference(path, lock_file)
+                acquire_lock(lock_file, fcntl.LOCK_EX)
+                if not os.path.isdir(path):
+                    self._extract(source_file, path, extract)
+                # Loop to downgrade to a shared lock and check the entry again
+        except:
+            lock_file.close()
+            raise
+
+
+    def _extract(self, source_file, path, extract):
+        """ Extracts a reference into the cache, must hold an exclusive lock on the entry. """
+        self.evict(os.path.getsize(source_file))
+        staging_dir = tempfile.mkdtemp(prefix=".tmp", dir=self.cache_dir)
+        try:
+            self.logger.info("Extracting reference DB {} into cache {}".format(source_file, path))
+            extract(source_file, staging_dir)
+            os.chmod(staging_dir, 0755)
+            os.rename(staging_dir, path)
+        except:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+
+    def evict(self, needed):
+        """
+        Evicts least recently used entries that are not in use until
+        needed bytes fit within the quota, or no more entries can be
+        evicted.
+        """
+        if not self.quota:
+            return
+        with open(os.path.join(self.cache_dir, CACHE_LOCK), "a") as cache_lock:
+            acquire_lock(cache_lock, fcntl.LOCK_EX)
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if not name.startswith(".") and os.path.isdir(path):
+                    entries.append((os.path.getmtime(path), path, directory_size(path)))
+            total = sum(size for _, _, size in entries)
+            for _, path, size in sorted(entries):
+                if total + needed <= self.quota:
+                    break
+                with open(path+".lock", "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        continue # In use by another task
+                    # Rename first so that the entry disappears at once
+                    evicted = tempfile.mkdtemp(prefix=".evicted", dir=self.cache_dir)
+                    os.rename(path, os.path.join(evicted, "entry"))
+                shutil.rmtree(evicted, ignore_errors=True)
+                total -= size
+                self.logger.info("Evicted reference DB {} ({} bytes) from cache".format(path, size))
+            if total + needed > self.quota:
+                self.logger.warning("Reference DB cache {} will exceed its quota of {} bytes, the remaining entries are in use".format(self.cache_dir, self.quota))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+#  Copyright (C) 2014  Fredrik Boulund and Anders Sjögren
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Estimated runtimes of mapping tasks, used to queue the longest tasks
+first.
+
+The work of a task is the size of its reads file plus the size of its
+reference. Runtimes of earlier runs are read from their run_summary.txt
+files: a task whose reads file (and reference) has run before is
+expected to take as long again, and other tasks are expected to take
+their work times the seconds per byte of the earlier tasks whose files
+still exist. Without earlier runs a nominal throughput is assumed, so
+the estimates order the tasks correctly but are rough in seconds.
+
+.. moduleauthor:: Fredrik Boulund <fredrik.boulund@chalmers.se>
+
+"""
+import os
+import tempfile
+import unittest
+
+from query_jobs_utils import read_jobs_runtimes
+
+# Assumed mapping throughput without runtimes of earlier runs
+NOMINAL_SECONDS_PER_BYTE = 1.0 / (1 << 20)
+
+def file_size(filename):
+    """ Returns the size of a file, or 0 if it does not exist. """
+    try:
+        return os.path.getsize(filename)
+    except (OSError, TypeError):
+        return 0
+
+
+def task_work(reads_file, reference_file):
+    """ Returns the work of a task in bytes: the size of its reads plus its reference. """
+    return file_size(reads_file) + file_size(reference_file)
+
+
+class TaskCostModel(object):
+    """ Estimates the runtime in seconds of a task from its files and earlier runs. """
+
+    def __init__(self, summary_filenames, logger):
+        """
+        Input:
+            summary_filenames  run_summary.txt files of earlier runs.
+            logger             a logger object.
+        """
+        self.logger = logger
+        self.runtimes = {}
+        for filename in summary_filenames:
+            try:
+                for reads_file, reference_file, seconds in read_jobs_runtimes(filename):
+                    self.runtimes[(reads_file, reference_file)] = seconds
+            except (IOError, ValueError), e:
+                logger.warning("Cannot read runtimes from {}: {}".format(filename, e))
+        self.seconds_per_byte = self._fit_seconds_per_byte()
+
+
+    def _fit_seconds_per_byte(self):
+        work, seconds = 0, 0.0
+        for (reads_file, reference_file), runtime in self.runtimes.iteritems():
+            if not os.path.exists(reads_file):
+                continue
+            work += task_work(reads_file, reference_file)
+            seconds += runtime
+        if not work:
+            self.logger.info("No runtimes of earlier tasks with existing files, assuming a nominal throughput")
+            return NOMINAL_SECONDS_PER_BYTE
+        self.logger.info("Earlier tasks took {:.3g} seconds per MiB of reads and reference".format(seconds * (1 << 20) / work))
+        return seconds / work
+
+
+    def cost(self, reads_file, reference_file):
+        """ Returns the estimated runtime in seconds of mapping reads_file to reference_file. """
+        for key in ((reads_file, reference_file), (reads_file, None)):
+            if key in self.runtimes:
+                return self.runtimes[key]
+        return task_work(reads_file, reference_file) * self.seconds_per_byte
+
+
+
+############################################
+#       UNIT TESTS
+############################################
+
+class Test_TaskCostModel(unittest.TestCase):
+    class _Logger(object):
+        def info(self, msg): pass
+        def warning(self, msg): pass
+
+    def test_costs(self):
+        tmpdir = tempfile.mkdtemp()
+        def write(name, size):
+            with open(os.path.join(tmpdir, name), "w") as f:
+                f.write("A" * size)
+            return os.path.join(tmpdir, name)
+        reads, other_reads, reference = write("r1", 300), write("r2", 900), write("ref", 100)
+        summary = os.path.join(tmpdir, "run_summary.txt")
+        with open(summary, "w") as f:
+            f.write("Job: r1\n  Filename: {}\n  Reference: {}\n  Runtime:               0:00:08\n".format(reads, reference))
+            f.write("Job: gone\n  Filename: /nonexistent\n  Runtime:               1 day, 0:00:00.5\n")
+        model = TaskCostModel([summary], self._Logger())
+        self.assertEqual(model.runtimes[("/nonexistent", None)], 86400.5)
+        self.assertEqual(model.cost(reads, reference), 8)
+        self.assertEqual(model.cost(other_reads, reference), 20)
+        self.assertEqual(TaskCostModel([], self._Logger()).cost(other_reads, reference), 1000 * NOMINAL_SECONDS_PER_BYTE)